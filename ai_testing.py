@@ -1,42 +1,313 @@
-import sys
 import time
 import math
+import threading
 import torch
 import numpy as np
+from contextlib import contextmanager
+from functools import partial, wraps
 
+import torch.nn.functional as F
 import torchvision.models as m
 import torchvision.transforms as T
 from torchvision.transforms import v2
+from torchvision.ops.misc import FrozenBatchNorm2d
+from torchvision.models import mobilenet_v3_large
 from torchvision.models.detection import fasterrcnn_mobilenet_v3_large_320_fpn, \
 fasterrcnn_resnet50_fpn, retinanet_resnet50_fpn, ssdlite320_mobilenet_v3_large, ssd300_vgg16
+from torchvision.models.detection import _utils as det_utils
+from torchvision.models.detection.anchor_utils import DefaultBoxGenerator
 from torchvision.models.detection.faster_rcnn import FastRCNNPredictor
+from torchvision.models.detection.ssd import SSD
+from torchvision.models.detection.ssdlite import SSDLiteHead, _mobilenet_extractor
+
+import telemetry
+# the model selection and settings, shared with processes that don't run the models
+from model_registry import input_sizes, fixed_size_models, input_scale_applies, speed_order, default_settings, \
+backends, artifact_path, ModelRegistry, registry, set_model, set_backend, set_variant, set_detector_settings
 
 
 augsDL = [v2.PILToTensor(), v2.ToDtype(torch.float, scale=True), v2.ToPureTensor()]
 
-# load in some model to test, see DemoModelTrainEval.ipynb for examples of other architectures 
-model2 = fasterrcnn_resnet50_fpn()
 num_classes = 2  # 1 class (lesion) + background
-in_features = model2.roi_heads.box_predictor.cls_score.in_features
-model2.roi_heads.box_predictor = FastRCNNPredictor(in_features, num_classes)
-model2.load_state_dict(torch.load('fasterrcnn_resnet50_fpn.pth', map_location=torch.device('cpu')))
-model2.eval()
 
+# swaps BatchNorm2d for the FrozenBatchNorm2d that the pretrained backbones were fine-tuned with,
+# so the saved weights load strictly without downloading the backbone weights first
+def _freeze_batchnorm(module):
+    for name, child in module.named_children():
+        if isinstance(child, torch.nn.BatchNorm2d):
+            setattr(module, name, FrozenBatchNorm2d(child.num_features, child.eps))
+        else:
+            _freeze_batchnorm(child)
+    return module
+
+# ssdlite320_mobilenet_v3_large() switches to a reduced-tail backbone when no backbone weights are
+# given, so this follows its builder with the full tail the phantom models were fine-tuned from
+def _ssdlite320_mobilenet_v3_large():
+    norm_layer = partial(torch.nn.BatchNorm2d, eps=0.001, momentum=0.03)
+    backbone = _mobilenet_extractor(mobilenet_v3_large(norm_layer=norm_layer), 6, norm_layer)
+    size = (320, 320)
+    anchor_generator = DefaultBoxGenerator([[2, 3] for _ in range(6)], min_ratio=0.2, max_ratio=0.95)
+    out_channels = det_utils.retrieve_out_channels(backbone, size)
+    num_anchors = anchor_generator.num_anchors_per_location()
+    return SSD(backbone, anchor_generator, size, num_classes,
+               head=SSDLiteHead(out_channels, num_anchors, num_classes, norm_layer),
+               score_thresh=0.001, nms_thresh=0.55, detections_per_img=300, topk_candidates=300,
+               image_mean=[0.5, 0.5, 0.5], image_std=[0.5, 0.5, 0.5])
+
+# torch.nn.init functions the modules are randomly initialised with, see _skip_init
+_init_functions = ['uniform_', 'normal_', 'trunc_normal_', 'constant_', 'ones_', 'zeros_', 'xavier_uniform_',
+                   'xavier_normal_', 'kaiming_uniform_', 'kaiming_normal_', 'orthogonal_']
+
+_init_skipped = threading.local()
+_init_lock = threading.Lock()
+_init_wrapped = False
+
+# wraps an init function so it leaves the tensor as it is on a thread inside _skip_init
+def _skippable(function):
+    @wraps(function)
+    def init(tensor, *args, **kwargs):
+        if getattr(_init_skipped, 'active', False):
+            return tensor
+        return function(tensor, *args, **kwargs)
+    return init
+
+# builds modules without randomly initialising them, which takes most of the time to build the ResNet-50
+# models and is wasted when every weight is about to be loaded; only the calling thread is affected, modules
+# built on other threads meanwhile (another model, training) are initialised as usual
+# building on the meta device instead would leave the anchor generators' tensors, which aren't in the state
+# dict, without data
+@contextmanager
+def _skip_init():
+    global _init_wrapped
+    with _init_lock:
+        if not _init_wrapped:
+            for name in _init_functions:
+                setattr(torch.nn.init, name, _skippable(getattr(torch.nn.init, name)))
+            _init_wrapped = True
+    _init_skipped.active = True
+    try:
+        yield
+    finally:
+        _init_skipped.active = False
+
+# builds an architecture with the same layout as get_pretrained_model in DemoModelTrainEval.ipynb,
+# ready for the fine-tuned phantom weights to be loaded into it
+def build_model(model_name):
+    if model_name == 'ssdlite320_mobilenet_v3_large':
+        return _ssdlite320_mobilenet_v3_large()
+    elif model_name == 'ssd300_vgg16':
+        return ssd300_vgg16(weights_backbone=None, num_classes=num_classes)
+    elif model_name == 'retinanet_resnet50_fpn':
+        return _freeze_batchnorm(retinanet_resnet50_fpn(weights_backbone=None, num_classes=num_classes))
+    elif model_name == 'fasterrcnn_mobilenet_v3_large_320_fpn':
+        return _freeze_batchnorm(fasterrcnn_mobilenet_v3_large_320_fpn(weights_backbone=None, num_classes=num_classes))
+    elif model_name == 'fasterrcnn_resnet50_fpn':
+        return _freeze_batchnorm(fasterrcnn_resnet50_fpn(weights_backbone=None, num_classes=num_classes))
+    raise ValueError(f"unknown model '{model_name}', expected one of {list(input_sizes)}")
+
+# runs a TorchScript detector, which returns (losses, detections) when scripted, like an eager one
+class ScriptedDetector:
+    def __init__(self, path):
+        self.module = torch.jit.load(path, map_location=torch.device('cpu'))
+
+    def __call__(self, images):
+        return self.module(images)[1]
+
+# runs an exported ONNX detector with ONNX Runtime, one image at a time like the exported graph expects
+class OnnxDetector:
+    def __init__(self, path):
+        import onnxruntime  # only needed for the 'onnxruntime' backend
+        options = onnxruntime.SessionOptions()
+        # follow torch's thread setting so both runtimes use the same number of cores
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+
+    def __call__(self, images):
+        outputs = []
+        for image in images:
+            boxes, labels, scores = self.session.run(None, {'image': image.contiguous().numpy()})
+            outputs.append({'boxes': torch.from_numpy(boxes), 'labels': torch.from_numpy(labels),
+                            'scores': torch.from_numpy(scores)})
+        return outputs
+
+# loads a model ready for inference; 'eager' reads the fine-tuned weights '<model_name>.pth' from weights_dir
+# into a fresh model, the other backends read their exported artifact
+def load_model(model_name, weights_dir='.', backend='eager', variant=None):
+    path = artifact_path(model_name, backend, weights_dir, variant)
+    if backend in ('torchscript', 'int8'):
+        return ScriptedDetector(path)
+    elif backend == 'onnxruntime':
+        return OnnxDetector(path)
+    with _skip_init():
+        model = build_model(model_name)
+    # the weights are memory-mapped rather than read up front, and replace the model's own tensors instead of
+    # being copied into them, so loading costs little more than building the modules
+    state_dict = torch.load(path, map_location=torch.device('cpu'), mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    return model
+
+# eager R-CNN and RetinaNet detectors resize their input to min_size (800) internally, which would scale the
+# frames prepare_frame makes back up from input_sizes; this has them run at that size, which tune_model scales
+# with input_scale; SSD detectors and exported backends keep the size they were built or exported with
+# 'size' runs it at another size instead, e.g. to see what input_sizes costs in accuracy (see evaluation.py)
+def match_input_size(model, model_name, size=None):
+    if isinstance(model, torch.nn.Module) and model.transform.fixed_size is None:
+        size = size or input_sizes[model_name]
+        model.transform.min_size = (size,)
+        model.transform.max_size = size
+    return model
+
+# applies detector settings to an eager torchvision detector, remembering the model's own values so they
+# can be restored; exported backends have theirs frozen in and only get their output filtered
+def tune_model(model, settings):
+    if not isinstance(model, torch.nn.Module):
+        return
+    defaults = getattr(model, '_default_settings', None)
+    if defaults is None:
+        if hasattr(model, 'rpn'):
+            defaults = {'pre_nms_top_n': model.rpn._pre_nms_top_n['testing'],
+                        'post_nms_top_n': model.rpn._post_nms_top_n['testing'],
+                        'detections_per_img': model.roi_heads.detections_per_img,
+                        'score_thresh': model.roi_heads.score_thresh}
+        else:
+            defaults = {'pre_nms_top_n': model.topk_candidates, 'detections_per_img': model.detections_per_img,
+                        'score_thresh': model.score_thresh}
+        # SSD architectures are trained at a fixed size, the others resize internally between min and max size
+        if model.transform.fixed_size is None:
+            defaults['min_size'] = model.transform.min_size
+            defaults['max_size'] = model.transform.max_size
+        model._default_settings = defaults
+    # settings only ever turn a detector down, e.g. a proposal count above the model's own isn't applied
+    def value(key):
+        if settings[key] is None:
+            return defaults[key]
+        return max(defaults[key], settings[key]) if key == 'score_thresh' else min(defaults[key], settings[key])
+    if hasattr(model, 'rpn'):
+        model.rpn._pre_nms_top_n['testing'] = value('pre_nms_top_n')
+        model.rpn._post_nms_top_n['testing'] = min(defaults['post_nms_top_n'], value('pre_nms_top_n'))
+        model.roi_heads.detections_per_img = value('detections_per_img')
+        model.roi_heads.score_thresh = value('score_thresh')
+    else:
+        model.topk_candidates = value('pre_nms_top_n')
+        model.detections_per_img = value('detections_per_img')
+        model.score_thresh = value('score_thresh')
+    if 'min_size' in defaults:
+        scale = settings['input_scale']
+        model.transform.min_size = tuple(int(size * scale) for size in defaults['min_size'])
+        model.transform.max_size = int(defaults['max_size'] * scale)
+
+# drops detections below the score threshold and beyond the detection limit of the settings
+def filter_detections(output, settings):
+    if settings['score_thresh'] is not None:
+        keep = output['scores'] >= settings['score_thresh']
+        output = {k: v[keep] for k, v in output.items()}
+    if settings['detections_per_img'] is not None:
+        output = {k: v[:settings['detections_per_img']] for k, v in output.items()}
+    return output
+
+test_augs = v2.Compose(augsDL)
+
+# runs the selected model on a single PIL image, see batch_predict.py for running it over whole clips
 def predict_with_model(pil_image):
-    test_augs = v2.Compose(augsDL)
     try: 
         augmented_im = test_augs(pil_image)
+        model_name, model2 = registry.active()
         output2 = model2([augmented_im])
     except Exception as e:
-        print('exception: ', e)
-        sys.exit(1)
+        telemetry.pipeline.error(e)
+        raise
     return output2
 
+# finds the (x0, y0, x1, y1) bounds of the ultrasound sector inside the black margins of a frame,
+# sampling every 'step' pixels so the cost stays small at large display sizes
+def sector_bounds(frame, threshold=8, step=4):
+    # the green channel is enough to tell the grayscale sector from the black background
+    lum = frame[::step, ::step, 1] if frame.ndim == 3 else frame[::step, ::step]
+    mask = lum > threshold
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    height, width = frame.shape[:2]
+    if len(rows) == 0:
+        return 0, 0, width, height
+    return (max(int(cols[0]) * step - step, 0), max(int(rows[0]) * step - step, 0),
+            min(int(cols[-1]) * step + step, width), min(int(rows[-1]) * step + step, height))
+
+# crops a frame to the ultrasound sector and resizes it once to the model's square input size
+# returns the input tensor and the (x0, y0, scale_x, scale_y) needed to map boxes back onto the frame
+def prepare_frame(frame, size):
+    x0, y0, x1, y1 = sector_bounds(frame)
+    crop = torch.from_numpy(frame[y0:y1, x0:x1])
+    # resize while still uint8, so only the small model input is ever converted to float
+    crop = crop.permute(2, 0, 1) if crop.dim() == 3 else crop.unsqueeze(0)
+    small = F.interpolate(crop.unsqueeze(0), size=(size, size), mode='bilinear', antialias=True)[0]
+    if small.shape[0] == 1:
+        tensor = small.to(torch.float).div_(255).expand(3, -1, -1)
+    else:
+        tensor = small[[2, 1, 0]].to(torch.float).div_(255)
+    return tensor, (x0, y0, (x1 - x0) / size, (y1 - y0) / size)
+
+# maps boxes predicted on the model input back onto the frame they were cropped from
+def map_boxes(boxes, transform):
+    x0, y0, scale_x, scale_y = transform
+    scale = boxes.new_tensor([scale_x, scale_y, scale_x, scale_y])
+    offset = boxes.new_tensor([x0, y0, x0, y0])
+    return boxes * scale + offset
+
+# runs the selected model on a frame; still_valid, if given, is checked once the frame has been read and
+# should return False if the frame was overwritten while being read, in which case None is returned
+def predict_with_frame(frame, still_valid=None):
+    outputs = predict_with_frames([frame], None if still_valid is None else lambda i: still_valid())
+    return None if outputs[0] is None else outputs
+
+# runs the selected model on several frames in one call, e.g. the newest frame of each connected probe
+# (see inference_server.py); still_valid, if given, is called with each frame's index once the frames have
+# been read, and frames it rejects get None instead of their detections
+def predict_with_frames(frames, still_valid=None):
+    try:
+        model_name, model2 = registry.active()
+        settings = registry.settings
+        tune_model(model2, settings)
+        outputs = [None] * len(frames)
+        scale = settings['input_scale'] if input_scale_applies(model_name, registry.backend) else 1.0
+        with torch.inference_mode():
+            size = int(input_sizes[model_name] * scale)
+            with telemetry.pipeline.timed('preprocess'):
+                prepared = [prepare_frame(frame, size) for frame in frames]
+            keep = [i for i in range(len(frames)) if still_valid is None or still_valid(i)]
+            if not keep:
+                return outputs
+            # every frame is resized to the same input size, so they run as one batch
+            with telemetry.pipeline.timed('forward'):
+                output2 = model2([prepared[i][0] for i in keep])
+            for i, output in zip(keep, output2):
+                output = filter_detections(output, settings)
+                output['boxes'] = map_boxes(output['boxes'], prepared[i][1])
+                outputs[i] = output
+    except Exception as e:
+        # the traceback is logged and dumped with the telemetry, see telemetry.py, and the caller decides whether
+        # to carry on without these predictions
+        telemetry.pipeline.error(e)
+        raise
+    return outputs
+
+# runs the selected model on a few blank frames of the given shape, so the one-off costs of its first calls
+# (allocator growth, kernel selection) are paid before the first real frame; nothing is recorded in telemetry
+def warm_up(shape, runs=2):
+    model_name, model2 = registry.active()
+    settings = registry.settings
+    tune_model(model2, settings)
+    scale = settings['input_scale'] if input_scale_applies(model_name, registry.backend) else 1.0
+    frame = np.zeros(shape, dtype=np.uint8)
+    with torch.inference_mode():
+        for _ in range(runs):
+            tensor, _ = prepare_frame(frame, int(input_sizes[model_name] * scale))
+            model2([tensor])
+
 def test_augmentations(pil_image):
-    test_augs = v2.Compose(augsDL)
     try: 
         test_augs(pil_image)
     except Exception as e:
-        print(e)
-        sys.exit(1)
+        telemetry.pipeline.error(e)
+        raise
     return "1"
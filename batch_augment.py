@@ -0,0 +1,160 @@
+import math
+import torch
+import torch.nn.functional as F
+
+from torch.nn.utils.rnn import pad_sequence
+
+
+# collates variable-size uint8 samples into one zero-padded batch, images padded at the bottom and right
+# returns the (B, C, H, W) batch, the (B, 2) height and width of each image, and the list of targets
+def pad_collate(batch):
+    imgs, targets = zip(*batch)
+    sizes = torch.tensor([img.shape[-2:] for img in imgs])
+    height, width = sizes.max(dim=0).values.tolist()
+    images = imgs[0].new_zeros((len(imgs), imgs[0].shape[0], height, width))
+    for i, img in enumerate(imgs):
+        images[i, :, :img.shape[-2], :img.shape[-1]] = img
+    return images, sizes, list(targets)
+
+
+# runs the notebook's augmentations on a whole padded batch at once, after the per-sample crop
+# resize and horizontal flip are one grid sample, followed by the photometric distortion and gaussian blur,
+# each drawn per sample with its own parameters, so the work is a handful of batched ops per batch
+class BatchAugment:
+    # @param size square size images are resized to
+    # @param p_photometric probability of each photometric distortion, as RandomPhotometricDistort
+    # @param p_blur probability of a 3x3 gaussian blur with sigma in [0.1, 2]
+    # @param p_flip probability of a horizontal flip
+    def __init__(self, size=512, p_photometric=0.5, p_blur=0.5, p_flip=0.5, brightness=(0.875, 1.125),
+                 contrast=(0.5, 1.5), saturation=(0.5, 1.5), hue=(-0.05, 0.05), sigma=(0.1, 2.0)):
+        self.size = size
+        self.p_photometric = p_photometric
+        self.p_blur = p_blur
+        self.p_flip = p_flip
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.hue = hue
+        self.sigma = sigma
+
+    def __call__(self, images, sizes, targets):
+        flip = torch.rand(len(images)) < self.p_flip
+        images = self.resize_flip(images.float().div_(255), sizes, flip)
+        targets = self.transform_boxes(targets, sizes, flip)
+        if images.shape[1] == 3:
+            images = self.photometric(images)
+        images = self.blur(images)
+        return images.clamp_(0, 1), targets
+
+    # resamples each image's unpadded region to size x size, mirrored where flipped
+    def resize_flip(self, images, sizes, flip):
+        height, width = images.shape[-2:]
+        scale_x = sizes[:, 1].float() / width
+        scale_y = sizes[:, 0].float() / height
+        theta = torch.zeros(len(images), 2, 3)
+        theta[:, 0, 0] = torch.where(flip, -scale_x, scale_x)
+        theta[:, 0, 2] = scale_x - 1
+        theta[:, 1, 1] = scale_y
+        theta[:, 1, 2] = scale_y - 1
+        grid = F.affine_grid(theta, (len(images), images.shape[1], self.size, self.size), align_corners=False)
+        return F.grid_sample(images, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+    # scales and flips the boxes of every sample together, as one padded (B, N, 4) tensor
+    def transform_boxes(self, targets, sizes, flip):
+        counts = [len(t['boxes']) for t in targets]
+        boxes = pad_sequence([torch.as_tensor(t['boxes'], dtype=torch.float).reshape(-1, 4) for t in targets],
+                             batch_first=True)
+        if boxes.numel() == 0:
+            return targets
+        scale_x = (self.size / sizes[:, 1].float())[:, None]
+        scale_y = (self.size / sizes[:, 0].float())[:, None]
+        x0, y0, x1, y1 = boxes.unbind(-1)
+        x0, x1 = x0 * scale_x, x1 * scale_x
+        x0, x1 = torch.where(flip[:, None], self.size - x1, x0), torch.where(flip[:, None], self.size - x0, x1)
+        boxes = torch.stack([x0, y0 * scale_y, x1, y1 * scale_y], dim=-1)
+        areas = (scale_x * scale_y)[:, 0]
+        out = []
+        for i, (target, count) in enumerate(zip(targets, counts)):
+            target = dict(target)
+            target['boxes'] = boxes[i, :count]
+            if 'area' in target:
+                target['area'] = torch.as_tensor(target['area'], dtype=torch.float) * areas[i]
+            out.append(target)
+        return out
+
+    # per-sample uniform draws in [low, high], left at 'identity' for samples the distortion isn't applied to
+    def draw(self, n, bounds, p, identity):
+        values = torch.empty(n).uniform_(*bounds)
+        return torch.where(torch.rand(n) < p, values, torch.full((n,), float(identity)))
+
+    # brightness, contrast, saturation and hue jitter followed by a channel shuffle, each with probability p,
+    # with contrast before or after the colour changes like RandomPhotometricDistort
+    def photometric(self, images):
+        n = len(images)
+        p = self.p_photometric
+        brightness = self.draw(n, self.brightness, p, 1.0)[:, None, None, None]
+        contrast = self.draw(n, self.contrast, p, 1.0)[:, None, None, None]
+        saturation = self.draw(n, self.saturation, p, 1.0)[:, None, None, None]
+        hue = self.draw(n, self.hue, p, 0.0)
+        contrast_first = (torch.rand(n) < 0.5)[:, None, None, None]
+
+        images = (images * brightness).clamp_(0, 1)
+        images = torch.where(contrast_first, self.adjust_contrast(images, contrast), images)
+        gray = self.grayscale(images)
+        images = (gray + saturation * (images - gray)).clamp_(0, 1)
+        images = self.rotate_hue(images, hue)
+        images = torch.where(contrast_first, images, self.adjust_contrast(images, contrast))
+
+        shuffle = torch.rand(n) < p
+        if shuffle.any():
+            order = torch.stack([torch.randperm(3) if s else torch.arange(3) for s in shuffle])
+            images = images.gather(1, order[:, :, None, None].expand_as(images))
+        return images
+
+    def grayscale(self, images):
+        weights = images.new_tensor([0.2989, 0.587, 0.114])[None, :, None, None]
+        return (images * weights).sum(dim=1, keepdim=True)
+
+    def adjust_contrast(self, images, contrast):
+        mean = self.grayscale(images).mean(dim=(1, 2, 3), keepdim=True)
+        return (mean + contrast * (images - mean)).clamp_(0, 1)
+
+    # hue rotation as a per-sample 3x3 colour matrix, the YIQ approximation of a shift around the HSV hue circle
+    def rotate_hue(self, images, hue):
+        angle = hue * 2 * math.pi
+        cos, sin = torch.cos(angle)[:, None, None], torch.sin(angle)[:, None, None]
+        to_yiq = images.new_tensor([[0.299, 0.587, 0.114], [0.596, -0.274, -0.322], [0.211, -0.523, 0.312]])
+        rotate = torch.zeros(len(images), 3, 3)
+        rotate[:, 0, 0] = 1
+        rotate[:, 1:, 1:] = torch.cat([torch.cat([cos, -sin], dim=2), torch.cat([sin, cos], dim=2)], dim=1)
+        matrix = torch.linalg.inv(to_yiq) @ rotate @ to_yiq
+        return torch.einsum('bij,bjhw->bihw', matrix, images).clamp_(0, 1)
+
+    # 3x3 gaussian blur with a per-sample sigma as one separable grouped convolution over the batch
+    def blur(self, images):
+        n, c, h, w = images.shape
+        sigma = torch.empty(n).uniform_(*self.sigma)
+        kernel = torch.exp(-torch.tensor([1.0, 0.0, 1.0])[None, :] / (2 * sigma[:, None] ** 2))
+        kernel = kernel / kernel.sum(dim=1, keepdim=True)
+        # samples that aren't blurred get the identity kernel
+        kernel = torch.where((torch.rand(n) < self.p_blur)[:, None], kernel, torch.tensor([0.0, 1.0, 0.0]))
+        kernel = kernel.repeat_interleave(c, dim=0)
+        x = F.pad(images.reshape(1, n * c, h, w), (1, 1, 1, 1), mode='reflect')
+        x = F.conv2d(x, kernel[:, None, None, :], groups=n * c)
+        x = F.conv2d(x, kernel[:, None, :, None], groups=n * c)
+        return x.reshape(n, c, h, w)
+
+
+# wraps a DataLoader collating with pad_collate so it yields augmented (images, targets) batches,
+# running the batched augmentations in the training process on each batch as it arrives
+class AugmentedLoader:
+    def __init__(self, loader, augment):
+        self.loader = loader
+        self.augment = augment
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        for images, sizes, targets in self.loader:
+            yield self.augment(images, sizes, targets)
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import itertools
+import json
+import os
+import sys
+import time
+import torch
+
+from torch.utils.data import DataLoader, IterableDataset, get_worker_info
+from torchvision.io import read_image, ImageReadMode
+
+import ai_testing
+import recorder
+
+
+# frame files in a directory as (frame number, path), numbered like PhantomDataset where '<n>.jpg' is frame n + 1
+def frame_paths(frame_dir):
+    paths = sorted(glob.glob(os.path.join(frame_dir, "*.jpg")) + glob.glob(os.path.join(frame_dir, "*.png")),
+                   key=lambda p: (len(p), p))
+    frames = []
+    for i, path in enumerate(paths):
+        stem = os.path.splitext(os.path.basename(path))[0]
+        frames.append((int(stem) + 1 if stem.isdigit() else i + 1, path))
+    return frames
+
+
+# frames of a directory, video clip or pysidecaster recording as (frame number, uint8 RGB image, error), split
+# between DataLoader workers; a frame that can't be read is yielded with no image and the reason, so one bad
+# frame doesn't stop the clip
+class ClipFrames(IterableDataset):
+    def __init__(self, source, done=()):
+        self.source = source
+        self.done = set(done)
+        self.recording = recorder.Recording(source) if recorder.is_recording(source) else None
+        self.paths = frame_paths(source) if os.path.isdir(source) and self.recording is None else None
+
+    def __iter__(self):
+        info = get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        if self.recording is not None:
+            yield from self.recording_frames(worker, workers)
+            return
+        if self.paths is None:
+            yield from self.video_frames(worker, workers)
+            return
+        for number, path in self.paths[worker::workers]:
+            if number in self.done:
+                continue
+            try:
+                yield number, read_image(path, ImageReadMode.RGB), None
+            except Exception as e:
+                yield number, None, str(e)
+
+    # each worker decompresses whole chunks of the recording, frames are numbered in recording order from 1
+    def recording_frames(self, worker, workers):
+        chunks = self.recording.chunks
+        starts = list(itertools.accumulate([len(self.recording.timestamps(i)) for i in range(len(chunks))],
+                                           initial=0))
+        for i in range(worker, len(chunks), workers):
+            try:
+                frames = self.recording.chunk(i)['frames']
+            except Exception as e:
+                for number in range(starts[i] + 1, starts[i + 1] + 1):
+                    yield number, None, str(e)
+                continue
+            for j, frame in enumerate(frames):
+                number = starts[i] + j + 1
+                if number in self.done:
+                    continue
+                yield number, torch.from_numpy(self.recording.rgb(frame)).permute(2, 0, 1).contiguous(), None
+
+    # each worker decodes a contiguous run of the video, so it only has to seek once
+    def video_frames(self, worker, workers):
+        import cv2  # only needed for video clips
+        video = cv2.VideoCapture(self.source)
+        count = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+        if count <= 0:
+            # the container doesn't know its length, the first worker reads it all
+            start, stop = (0, sys.maxsize) if worker == 0 else (0, 0)
+        else:
+            chunk = -(-count // workers)
+            start, stop = worker * chunk, min((worker + 1) * chunk, count)
+            video.set(cv2.CAP_PROP_POS_FRAMES, start)
+        for index in range(start, stop):
+            ok, bgr = video.read()
+            number = index + 1
+            if not ok:
+                if count <= 0:
+                    break
+                yield number, None, "could not decode frame"
+                continue
+            if number in self.done:
+                continue
+            rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
+            yield number, torch.from_numpy(rgb).permute(2, 0, 1).contiguous(), None
+        video.release()
+
+
+# one NDJSON line in the annotation schema PhantomDataset reads, holding a single frame
+def frame_record(source, number, objects, error=None):
+    frame = {"objects": objects}
+    if error is not None:
+        frame["error"] = error
+    return {"data_row": {"external_id": os.path.basename(os.path.normpath(source))},
+            "projects": {"predictions": {"labels": [{"annotations": {"frames": {str(number): frame}}}]}}}
+
+
+# detections above the score threshold as VideoBoundingBox annotation objects
+def prediction_objects(output, score_threshold):
+    objects = {}
+    for i, (box, score) in enumerate(zip(output["boxes"].tolist(), output["scores"].tolist())):
+        if score < score_threshold:
+            continue
+        x0, y0, x1, y1 = box
+        objects[str(i)] = {"annotation_kind": "VideoBoundingBox", "score": score,
+                           "bounding_box": {"top": y0, "left": x0, "height": y1 - y0, "width": x1 - x0}}
+    return objects
+
+
+# frames already written to a predictions file, so an interrupted run picks up where it stopped
+# a line cut short by the interruption is removed so new lines are appended after the last complete one
+def completed_frames(path):
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "rb+") as f:
+        end = 0
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            end += len(line)
+            for project in record["projects"].values():
+                done.update(int(n) for n in project["labels"][0]["annotations"]["frames"])
+        f.truncate(end)
+    return done
+
+
+# runs the model on a batch of uint8 images, falling back to one image at a time if the batch fails
+# so a frame the model can't handle only loses that frame; returns (output, error) per image
+def predict_batch(model, images):
+    with torch.inference_mode():
+        try:
+            return [(output, None) for output in model([image.float().div_(255) for image in images])]
+        except Exception:
+            if len(images) == 1:
+                raise
+        results = []
+        for image in images:
+            try:
+                results.append((model([image.float().div_(255)])[0], None))
+            except Exception as e:
+                results.append((None, str(e)))
+        return results
+
+
+# streams a clip through the model in batches, appending each batch's predictions to out_path as NDJSON
+# returns the number of frames predicted and the number that failed
+def predict_clip(model, source, out_path, batch_size=8, workers=2, score_threshold=0.5):
+    done = completed_frames(out_path)
+    loader = DataLoader(ClipFrames(source, done), batch_size=batch_size, num_workers=workers, collate_fn=list)
+    predicted = failed = 0
+    with open(out_path, "a") as out:
+        for batch in loader:
+            records = [frame_record(source, number, {}, error) for number, image, error in batch if image is None]
+            failed += len(records)
+            good = [(number, image) for number, image, error in batch if image is not None]
+            if good:
+                try:
+                    results = predict_batch(model, [image for _, image in good])
+                except Exception as e:
+                    results = [(None, str(e))]
+                for (number, _), (output, error) in zip(good, results):
+                    if output is None:
+                        records.append(frame_record(source, number, {}, error))
+                        failed += 1
+                    else:
+                        records.append(frame_record(source, number, prediction_objects(output, score_threshold)))
+                        predicted += 1
+            for record in records:
+                out.write(json.dumps(record) + "\n")
+            # every batch is on disk before the next one starts, it is the checkpoint for resuming
+            out.flush()
+    return predicted, failed
+
+
+# folds a predictions NDJSON file into a single annotation file PhantomDataset can load, leaving out failed frames
+def merge_predictions(path, out_path):
+    frames = {}
+    external_id = None
+    with open(path) as f:
+        for line in f:
+            record = json.loads(line)
+            external_id = record["data_row"]["external_id"]
+            for number, frame in record["projects"]["predictions"]["labels"][0]["annotations"]["frames"].items():
+                if "error" not in frame:
+                    frames[number] = frame
+    frames = {str(n): frames[str(n)] for n in sorted(int(n) for n in frames)}
+    merged = {"data_row": {"external_id": external_id},
+              "projects": {"predictions": {"labels": [{"annotations": {"frames": frames}}]}}}
+    with open(out_path, "w") as f:
+        f.write(json.dumps(merged) + "\n")
+
+
+## main function
+def main():
+    parser = argparse.ArgumentParser(description="Batched offline inference on recorded clips and frame directories.")
+    parser.add_argument("sources", nargs="+",
+                        help="directories of frames (.jpg/.png), video files or pysidecaster .cine recordings")
+    parser.add_argument("--model", default=ai_testing.registry.model_name, choices=list(ai_testing.input_sizes))
+    parser.add_argument("--backend", default="eager", choices=ai_testing.backends)
+    parser.add_argument("--weights-dir", default=".")
+    parser.add_argument("--out-dir", default=".", help="where '<clip>.predictions.ndjson' files are written")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 4),
+                        help="DataLoader processes decoding frames, the rest of the cores run the model")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads, all cores by default")
+    parser.add_argument("--score-threshold", type=float, default=0.5)
+    parser.add_argument("--merge", action="store_true",
+                        help="also write '<clip>.predictions.json' with every frame in one annotation file")
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = ai_testing.load_model(args.model, args.weights_dir, args.backend)
+    os.makedirs(args.out_dir, exist_ok=True)
+    for source in args.sources:
+        name = os.path.splitext(os.path.basename(os.path.normpath(source)))[0]
+        out_path = os.path.join(args.out_dir, name + ".predictions.ndjson")
+        start = time.perf_counter()
+        predicted, failed = predict_clip(model, source, out_path, args.batch_size, args.workers,
+                                         args.score_threshold)
+        elapsed = time.perf_counter() - start
+        print("{0}: {1} frames predicted, {2} failed, {3:.1f} fps -> {4}".format(
+            source, predicted, failed, (predicted + failed) / elapsed if elapsed else 0.0, out_path))
+        if args.merge:
+            merge_predictions(out_path, os.path.join(args.out_dir, name + ".predictions.json"))
+
+
+if __name__ == "__main__":
+    main()
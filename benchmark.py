@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import argparse
+import csv
+import glob
+import json
+import os
+import sys
+import time
+import numpy as np
+import torch
+
+# headless, the overlay is drawn onto an offscreen image
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+from PySide6 import QtGui
+
+import ai_testing
+from frame_ring import FrameRing
+
+# stages a frame goes through between the cast callback and the overlay in pysidecaster
+stages = ["convert", "preprocess", "forward", "postprocess", "draw"]
+
+
+# loads recorded frames as the window-sized ARGB32 images the cast callback delivers
+def load_frames(frame_dir, width, height, limit=None):
+    paths = sorted(glob.glob(os.path.join(frame_dir, "*.jpg")) + glob.glob(os.path.join(frame_dir, "*.png")))
+    frames = []
+    for path in paths[:limit]:
+        image = QtGui.QImage(path).scaled(width, height)
+        frames.append(image.convertToFormat(QtGui.QImage.Format_ARGB32))
+    return frames
+
+
+# percentiles and mean of a list of durations, in milliseconds
+def summarize(seconds):
+    ms = np.asarray(seconds) * 1000.0
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99), "mean_ms": float(ms.mean())}
+
+
+# replays the frames through one model/backend, timing every stage of every frame
+# the first 'warmup' frames are reported separately and left out of the percentiles
+def run_trial(model, model_name, frames, iterations, warmup, n_objects=2):
+    size = ai_testing.input_sizes[model_name]
+    ring = FrameRing()
+    canvas = QtGui.QImage(frames[0].width(), frames[0].height(), QtGui.QImage.Format_ARGB32)
+    pen = QtGui.QColor("yellow")
+    times = {stage: [] for stage in stages + ["total"]}
+    warmup_ms = []
+    start = None
+    for i in range(warmup + iterations):
+        if i == warmup:
+            start = time.perf_counter()
+        image = frames[i % len(frames)]
+        t0 = time.perf_counter()
+        # the callback's single copy of the frame into the ring
+        frame = ring.write(image.constBits(), image.width(), image.height(), 4, i)
+        t1 = time.perf_counter()
+        with torch.inference_mode():
+            tensor, transform = ai_testing.prepare_frame(frame.data, size)
+            t2 = time.perf_counter()
+            output = model([tensor])
+            t3 = time.perf_counter()
+            boxes = ai_testing.map_boxes(output[0]["boxes"], transform)[:n_objects, :].int()
+            scores = output[0]["scores"][:n_objects]
+        t4 = time.perf_counter()
+        # mirrors ImageView.drawForeground
+        painter = QtGui.QPainter(canvas)
+        painter.drawImage(0, 0, image)
+        painter.setPen(pen)
+        for j in range(len(scores)):
+            painter.drawRect(boxes[j, 0], boxes[j, 1], (boxes[j, 2] - boxes[j, 0]), (boxes[j, 3] - boxes[j, 1]))
+        painter.end()
+        t5 = time.perf_counter()
+        if i < warmup:
+            warmup_ms.append((t5 - t0) * 1000.0)
+            continue
+        for stage, duration in zip(stages + ["total"], [t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t5 - t0]):
+            times[stage].append(duration)
+    elapsed = time.perf_counter() - start
+    return {
+        "iterations": iterations,
+        "throughput_fps": iterations / elapsed,
+        "warmup_ms": warmup_ms,
+        "stages": {stage: summarize(durations) for stage, durations in times.items()},
+    }
+
+
+# writes one row per (model, backend, threads, stage)
+def write_csv(results, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["model", "backend", "threads", "stage", "p50_ms", "p95_ms", "p99_ms", "mean_ms",
+                         "throughput_fps"])
+        for result in results:
+            for stage, stats in result["stages"].items():
+                writer.writerow([result["model"], result["backend"], result["threads"], stage, stats["p50_ms"],
+                                 stats["p95_ms"], stats["p99_ms"], stats["mean_ms"], result["throughput_fps"]])
+
+
+## main function
+def main():
+    parser = argparse.ArgumentParser(description="Per-stage latency benchmark of the scanning pipeline.")
+    parser.add_argument("frames", help="directory of recorded frames (.jpg/.png)")
+    parser.add_argument("--models", nargs="+", default=list(ai_testing.input_sizes),
+                        choices=list(ai_testing.input_sizes))
+    parser.add_argument("--backends", nargs="+", default=["eager"], choices=ai_testing.backends)
+    parser.add_argument("--threads", nargs="+", type=int, default=[torch.get_num_threads()],
+                        help="torch intra-op thread counts to sweep")
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--size", default="640x480", help="display size frames are delivered at, WxH")
+    parser.add_argument("--limit", type=int, help="maximum number of frames to load")
+    parser.add_argument("--weights-dir", default=".")
+    parser.add_argument("--json", help="write the full results to this file")
+    parser.add_argument("--csv", help="write per-stage percentiles to this file")
+    args = parser.parse_args()
+
+    app = QtGui.QGuiApplication.instance() or QtGui.QGuiApplication(sys.argv)
+    width, height = (int(x) for x in args.size.lower().split("x"))
+    frames = load_frames(args.frames, width, height, args.limit)
+    if not frames:
+        sys.exit("no frames found in {0}".format(args.frames))
+
+    results = []
+    for model_name in args.models:
+        for backend in args.backends:
+            if not os.path.exists(ai_testing.artifact_path(model_name, backend, args.weights_dir)):
+                print("{0} [{1}]: no weights, skipped".format(model_name, backend))
+                continue
+            for threads in args.threads:
+                torch.set_num_threads(threads)
+                # loaded per thread count, ONNX Runtime sizes its thread pool when the session is created
+                model = ai_testing.match_input_size(ai_testing.load_model(model_name, args.weights_dir, backend),
+                                                    model_name)
+                result = {"model": model_name, "backend": backend, "threads": threads,
+                          "size": [width, height]}
+                result.update(run_trial(model, model_name, frames, args.iterations, args.warmup))
+                results.append(result)
+                total = result["stages"]["total"]
+                print("{0} [{1}, {2} threads]: {3:.1f} fps, p50 {4:.1f} ms, p95 {5:.1f} ms, p99 {6:.1f} ms, "
+                      "first frame {7:.1f} ms".format(model_name, backend, threads, result["throughput_fps"],
+                                                      total["p50_ms"], total["p95_ms"], total["p99_ms"],
+                                                      result["warmup_ms"][0] if result["warmup_ms"] else 0.0))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.csv:
+        write_csv(results, args.csv)
+
+
+if __name__ == "__main__":
+    main()
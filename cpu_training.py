@@ -0,0 +1,105 @@
+import itertools
+import math
+import sys
+import time
+import warnings
+import torch
+
+from torch.utils.data import DataLoader
+
+
+# DataLoader for training with workers kept alive across epochs, so worker startup is paid once
+# memory is only pinned when there is a GPU to copy batches to, pinning does nothing for CPU training
+def make_loader(dataset, batch_size, collate_fn, workers=4, shuffle=True, prefetch_factor=4):
+    return DataLoader(dataset=dataset, shuffle=shuffle, batch_size=batch_size, collate_fn=collate_fn,
+                      num_workers=workers, persistent_workers=workers > 0,
+                      prefetch_factor=prefetch_factor if workers > 0 else None,
+                      pin_memory=torch.cuda.is_available())
+
+
+# convolutions run fastest on CPU in channels_last, the backbone is handed its input in that format
+def _to_channels_last(module, args):
+    return (args[0].contiguous(memory_format=torch.channels_last),) + args[1:]
+
+
+# readies a detection model for fast CPU training: channels_last weights and activations and a compiled
+# backbone; only the backbone is compiled, the rest of the detection models is data dependent (proposals,
+# NMS, target matching) and would break the graph on every batch
+# @param example_images a batch of images like the training ones, used to look for graph breaks
+def prepare_model(model, example_images, channels_last=True, compile=True, name=None):
+    name = name or type(model).__name__
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
+        model.backbone.register_forward_pre_hook(_to_channels_last)
+    if not compile:
+        return model
+    if not hasattr(model.backbone, 'compile'):
+        warnings.warn(f"{name}: compiling modules in place needs torch 2.2, training without torch.compile")
+        return model
+    with torch.no_grad():
+        features = model.transform(list(example_images))[0].tensors
+        try:
+            explanation = torch._dynamo.explain(model.backbone)(features)
+        except Exception as e:
+            warnings.warn(f"{name}: the backbone can't be compiled ({e}), training without torch.compile")
+            return model
+        finally:
+            torch._dynamo.reset()
+    if explanation.graph_break_count:
+        reasons = "; ".join(sorted({str(b.reason) for b in explanation.break_reasons}))
+        warnings.warn(f"{name}: {explanation.graph_break_count} graph breaks in the compiled backbone: {reasons}")
+    # compiled in place, so the state dict keeps the keys ai_testing.load_model expects
+    model.backbone.compile()
+    return model
+
+
+# trains for one epoch like engine.train_one_epoch, under bf16 autocast and stepping the optimizer every
+# 'accumulate' batches to emulate a batch that many times larger
+# returns the mean loss and the images/sec trained at
+def train_one_epoch(model, optimizer, data_loader, epoch, accumulate=1, bf16=True, print_freq=10, max_steps=None):
+    model.train()
+    optimizer.zero_grad(set_to_none=True)
+    steps = len(data_loader) if max_steps is None else min(max_steps, len(data_loader))
+    seen = 0
+    total_loss = 0.0
+    start = time.perf_counter()
+    for i, (images, targets) in enumerate(itertools.islice(data_loader, steps)):
+        with torch.autocast('cpu', dtype=torch.bfloat16, enabled=bf16):
+            loss_dict = model(list(images), targets)
+        losses = sum(loss for loss in loss_dict.values())
+        loss_value = losses.item()
+        if not math.isfinite(loss_value):
+            print(f"Loss is {loss_value}, stopping training")
+            print(loss_dict)
+            sys.exit(1)
+        (losses / accumulate).backward()
+        if (i + 1) % accumulate == 0 or i + 1 == steps:
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+        seen += len(images)
+        total_loss += loss_value
+        if i % print_freq == 0:
+            print("Epoch: [{0}] [{1}/{2}] loss: {3:.4f} ({4:.1f} images/s)".format(
+                epoch, i, steps, loss_value, seen / (time.perf_counter() - start)))
+    elapsed = time.perf_counter() - start
+    return {"loss": total_loss / max(steps, 1), "images_per_sec": seen / elapsed}
+
+
+# trains each architecture for a few batches with the fast settings and reports the images/sec it reached
+# @param build function returning a fresh model for an architecture name, e.g. get_pretrained_model
+def compare_architectures(build, data_loader, model_names, steps=20, accumulate=1, bf16=True, compile=True,
+                          lr=0.005):
+    example_images, _ = next(iter(data_loader))
+    results = {}
+    for model_name in model_names:
+        model = prepare_model(build(model_name), example_images, compile=compile, name=model_name)
+        params = [p for p in model.parameters() if p.requires_grad]
+        optimizer = torch.optim.SGD(params, lr=lr, momentum=0.9, weight_decay=0.0005)
+        # the first batches include compilation and are left out of the rate
+        warmup = min(3, steps - 1)
+        train_one_epoch(model, optimizer, data_loader, 0, accumulate, bf16, print_freq=steps, max_steps=warmup)
+        result = train_one_epoch(model, optimizer, data_loader, 0, accumulate, bf16, print_freq=steps,
+                                 max_steps=steps - warmup)
+        results[model_name] = result["images_per_sec"]
+        print("{0}: {1:.1f} images/s".format(model_name, result["images_per_sec"]))
+    return results
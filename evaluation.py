@@ -0,0 +1,218 @@
+import json
+import os
+import numpy as np
+import torch
+
+from torchvision.ops import batched_nms
+
+import ai_testing
+
+# thresholds swept by default, every 0.01 from 0 to 1
+default_thresholds = np.linspace(0.0, 1.0, 101)
+
+
+# the raw predictions of a model on a split, padded to (images, predictions per image) so every image is
+# evaluated at once; predictions are sorted by score within each image and padding has a score of -inf
+class Predictions:
+    def __init__(self, boxes, scores, gt_boxes, gt_valid, image_ids):
+        self.boxes = boxes
+        self.scores = scores
+        self.gt_boxes = gt_boxes
+        self.gt_valid = gt_valid
+        self.image_ids = image_ids
+
+    # pads per-image lists of predicted and ground truth boxes
+    @classmethod
+    def from_lists(cls, boxes, scores, gt_boxes, image_ids):
+        n = len(boxes)
+        p = max([len(b) for b in boxes] + [1])
+        g = max([len(b) for b in gt_boxes] + [1])
+        padded = cls(np.zeros((n, p, 4), np.float32), np.full((n, p), -np.inf, np.float32),
+                     np.zeros((n, g, 4), np.float32), np.zeros((n, g), bool), np.asarray(image_ids))
+        for i in range(n):
+            order = np.argsort(-scores[i], kind='stable')
+            padded.boxes[i, :len(order)] = boxes[i][order]
+            padded.scores[i, :len(order)] = scores[i][order]
+            padded.gt_boxes[i, :len(gt_boxes[i])] = gt_boxes[i]
+            padded.gt_valid[i, :len(gt_boxes[i])] = True
+        return padded
+
+    def save(self, path, stamp):
+        np.savez(path, boxes=self.boxes, scores=self.scores, gt_boxes=self.gt_boxes, gt_valid=self.gt_valid,
+                 image_ids=self.image_ids, stamp=json.dumps(stamp))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            return cls(f['boxes'], f['scores'], f['gt_boxes'], f['gt_valid'], f['image_ids']), json.loads(str(f['stamp']))
+
+    # a stricter NMS than the model's own, applied to every image in one batched call
+    def nms(self, iou_threshold):
+        image, rank = np.nonzero(np.isfinite(self.scores))
+        keep = batched_nms(torch.from_numpy(self.boxes[image, rank]), torch.from_numpy(self.scores[image, rank]),
+                           torch.from_numpy(image), iou_threshold).numpy()
+        n = len(self.scores)
+        boxes = [self.boxes[i, rank[keep][image[keep] == i]] for i in range(n)]
+        scores = [self.scores[i, rank[keep][image[keep] == i]] for i in range(n)]
+        gt_boxes = [self.gt_boxes[i, self.gt_valid[i]] for i in range(n)]
+        return Predictions.from_lists(boxes, scores, gt_boxes, self.image_ids)
+
+
+# runs a model over a loader of (images, targets) batches, keeping every prediction the model makes
+def collect_predictions(model, data_loader):
+    # keep low scoring boxes too, so thresholds can be swept afterwards
+    ai_testing.tune_model(model, dict(ai_testing.default_settings, score_thresh=0.001))
+    boxes, scores, gt_boxes, image_ids = [], [], [], []
+    with torch.inference_mode():
+        for images, targets in data_loader:
+            for output, target in zip(model(list(images)), targets):
+                boxes.append(output['boxes'].float().numpy())
+                scores.append(output['scores'].float().numpy())
+                gt_boxes.append(torch.as_tensor(target['boxes']).float().reshape(-1, 4).numpy())
+                image_ids.append(int(target['image_id']))
+    return Predictions.from_lists(boxes, scores, gt_boxes, image_ids)
+
+
+# identifies the weights predictions were made with
+def _weights_stamp(path):
+    stat = os.stat(path)
+    return {'weights': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# the predictions of a model on a split at the input size the app runs it at (or at input_size), made once and
+# cached in cache_dir as '<model>.<backend>.<split>.<size>.npz'; they are made again if the weights have changed
+def cached_predictions(model_name, split, data_loader, weights_dir='.', backend='eager', cache_dir='eval_cache',
+                       input_size=None):
+    size = input_size or ai_testing.input_sizes[model_name]
+    stamp = dict(_weights_stamp(ai_testing.artifact_path(model_name, backend, weights_dir)), input_size=size)
+    path = os.path.join(cache_dir, "{0}.{1}.{2}.{3}.npz".format(model_name, backend, split, size))
+    if os.path.exists(path):
+        predictions, cached = Predictions.load(path)
+        if cached == stamp:
+            return predictions
+    model = ai_testing.match_input_size(ai_testing.load_model(model_name, weights_dir, backend), model_name, size)
+    predictions = collect_predictions(model, data_loader)
+    os.makedirs(cache_dir, exist_ok=True)
+    predictions.save(path, stamp)
+    return predictions
+
+
+# AP of an eager R-CNN or RetinaNet model at the app's input size next to other sizes, by default the 800 it was
+# trained at, to check what running it smaller costs; the predictions at every size are cached
+def compare_input_sizes(model_name, split, data_loader, sizes=(800,), weights_dir='.', cache_dir='eval_cache',
+                        iou_threshold=0.5, n_objects=None):
+    base = ai_testing.input_sizes[model_name]
+    results = {}
+    for size in [base] + [size for size in sizes if size != base]:
+        predictions = cached_predictions(model_name, split, data_loader, weights_dir, cache_dir=cache_dir,
+                                         input_size=size)
+        results[size] = evaluate_predictions(predictions, iou_threshold, n_objects=n_objects)
+        print("{0} at {1}: AP {2:.3f} ({3:+.3f})".format(model_name, size, results[size]['ap'],
+                                                          results[size]['ap'] - results[base]['ap']))
+    return results
+
+
+# (images, predictions, ground truths) IoU of every prediction with every ground truth box of its image
+def iou_matrix(boxes, gt_boxes):
+    x0 = np.maximum(boxes[:, :, None, 0], gt_boxes[:, None, :, 0])
+    y0 = np.maximum(boxes[:, :, None, 1], gt_boxes[:, None, :, 1])
+    x1 = np.minimum(boxes[:, :, None, 2], gt_boxes[:, None, :, 2])
+    y1 = np.minimum(boxes[:, :, None, 3], gt_boxes[:, None, :, 3])
+    inter = np.clip(x1 - x0, 0, None) * np.clip(y1 - y0, 0, None)
+    area = (boxes[..., 2] - boxes[..., 0]) * (boxes[..., 3] - boxes[..., 1])
+    gt_area = (gt_boxes[..., 2] - gt_boxes[..., 0]) * (gt_boxes[..., 3] - gt_boxes[..., 1])
+    return inter / np.maximum(area[:, :, None] + gt_area[:, None, :] - inter, 1e-9)
+
+
+# greedy COCO-style matching of every image at once, going down the predictions in score order and matching
+# each to the unmatched ground truth it overlaps most; as matching goes in score order, the matches of the
+# predictions above any score threshold (or within the top n of each image) are the same as for the
+# predictions cut at that threshold, so one matching serves every threshold
+def match(iou, valid, gt_valid, iou_threshold):
+    n, p, _ = iou.shape
+    matched = np.zeros((n, p), bool)
+    taken = ~gt_valid.copy()
+    rows = np.arange(n)
+    for r in range(p):
+        candidates = np.where(taken | (iou[:, r] < iou_threshold), -1.0, iou[:, r])
+        best = candidates.argmax(axis=1)
+        hit = valid[:, r] & (candidates[rows, best] >= 0)
+        matched[:, r] = hit
+        taken[rows[hit], best[hit]] = True
+    return matched
+
+
+# precision, recall, F1, lesion sensitivity and false positives per image at every score threshold, and AP
+# @param iou_threshold IoU a prediction needs with a lesion to count as finding it
+# @param n_objects only the top n predictions of each image are kept, like ImageView.n_objects
+def evaluate_predictions(predictions, iou_threshold=0.5, thresholds=default_thresholds, n_objects=None):
+    valid = np.isfinite(predictions.scores)
+    if n_objects is not None:
+        valid[:, n_objects:] = False
+    iou = iou_matrix(predictions.boxes, predictions.gt_boxes)
+    iou = np.where(predictions.gt_valid[:, None, :], iou, 0.0)
+    matched = match(iou, valid, predictions.gt_valid, iou_threshold)
+    n_images = len(predictions.scores)
+    n_gt = int(predictions.gt_valid.sum())
+
+    # true and false positives at every threshold from one sort of all the scores
+    scores = predictions.scores[valid]
+    order = np.argsort(-scores, kind='stable')
+    scores, tp = scores[order], matched[valid][order]
+    tp_cum = np.cumsum(tp)
+    fp_cum = np.cumsum(~tp)
+    # number of predictions at or above each threshold, and how many of them are true positives
+    count = np.searchsorted(-scores, -np.asarray(thresholds), side='right')
+    tp_at = np.concatenate([[0], tp_cum])[count]
+    fp_at = np.concatenate([[0], fp_cum])[count]
+    precision = np.where(count > 0, tp_at / np.maximum(count, 1), 1.0)
+    recall = tp_at / max(n_gt, 1)
+    f1 = 2 * precision * recall / np.maximum(precision + recall, 1e-9)
+
+    # a lesion is found at a threshold if any kept prediction above it overlaps it enough, matched or not
+    hit_scores = np.where((iou >= iou_threshold) & valid[:, :, None], predictions.scores[:, :, None], -np.inf)
+    best = hit_scores.max(axis=1)[predictions.gt_valid]
+    sensitivity = (best[None, :] >= np.asarray(thresholds)[:, None]).sum(axis=1) / max(n_gt, 1)
+
+    # 101-point interpolated AP over the full precision/recall curve
+    ap = 0.0
+    if len(tp_cum):
+        curve_recall = tp_cum / max(n_gt, 1)
+        # precision envelope, the best precision reachable at each recall or beyond
+        curve_precision = np.maximum.accumulate((tp_cum / np.arange(1, len(tp_cum) + 1))[::-1])[::-1]
+        points = np.searchsorted(curve_recall, np.linspace(0, 1, 101), side='left')
+        reached = points < len(curve_precision)
+        ap = float(np.where(reached, curve_precision[np.minimum(points, len(curve_precision) - 1)], 0.0).mean())
+
+    return {'thresholds': np.asarray(thresholds), 'precision': precision, 'recall': recall, 'f1': f1,
+            'sensitivity': sensitivity, 'fp_per_image': fp_at / max(n_images, 1), 'ap': ap}
+
+
+# the threshold to deploy at: the highest one that keeps lesion sensitivity at min_sensitivity,
+# or the one with the best F1 if no sensitivity is asked for
+def operating_point(result, min_sensitivity=None):
+    if min_sensitivity is None:
+        i = int(np.argmax(result['f1']))
+    else:
+        ok = np.flatnonzero(result['sensitivity'] >= min_sensitivity)
+        if len(ok) == 0:
+            return None
+        i = int(ok[-1])
+    return {key: float(value[i]) if isinstance(value, np.ndarray) else value for key, value in result.items()}
+
+
+# evaluates the cached predictions of several models and prints each one's AP and operating point
+def sweep(predictions_by_model, iou_threshold=0.5, thresholds=default_thresholds, n_objects=None,
+          min_sensitivity=None):
+    results = {}
+    for model_name, predictions in predictions_by_model.items():
+        result = evaluate_predictions(predictions, iou_threshold, thresholds, n_objects)
+        results[model_name] = result
+        point = operating_point(result, min_sensitivity)
+        if point is None:
+            print("{0}: AP {1:.3f}, sensitivity {2} not reached".format(model_name, result['ap'], min_sensitivity))
+            continue
+        print("{0}: AP {1:.3f}, threshold {2:.2f}: precision {3:.3f}, recall {4:.3f}, sensitivity {5:.3f}, "
+              "{6:.2f} FP/image".format(model_name, result['ap'], point['thresholds'], point['precision'],
+                                        point['recall'], point['sensitivity'], point['fp_per_image']))
+    return results
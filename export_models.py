@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import argparse
+import glob
+import inspect
+import os
+import sys
+import torch
+import torch.nn.functional as F
+
+from torchvision.io import read_image, ImageReadMode
+from torchvision.ops import box_iou
+
+import ai_testing
+
+
+# scripts a model and freezes its weights into the graph
+def export_torchscript(model, path):
+    scripted = torch.jit.freeze(torch.jit.script(model))
+    scripted.save(path)
+    return True
+
+
+# dynamic int8 quantization of the Linear layers, which for the FasterRCNN architectures is the large box head
+# convolutions stay fp32, so architectures without Linear layers (RetinaNet, SSD, SSDLite) are skipped
+def export_int8(model, path):
+    if not any(isinstance(module, torch.nn.Linear) for module in model.modules()):
+        return False
+    quantized = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return export_torchscript(quantized, path)
+
+
+# exports a single-image ONNX graph for ONNX Runtime, taking a (3, height, width) float image
+def export_onnx(model, path, size):
+    image = torch.rand(3, size, size)
+    # the TorchScript-based exporter handles the detection models' control flow, newer torch defaults to dynamo
+    kwargs = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    torch.onnx.export(model, ([image],), path, opset_version=17, input_names=['image'],
+                      output_names=['boxes', 'labels', 'scores'],
+                      dynamic_axes={'image': {1: 'height', 2: 'width'}}, **kwargs)
+    return True
+
+
+# writes the artifact a backend loads, returns False if the architecture doesn't support it; the eager model
+# is resized to the app's input size first so the exported transform resizes frames the same way
+def export_model(model_name, backend, weights_dir='.', out_dir='.'):
+    model = ai_testing.match_input_size(ai_testing.load_model(model_name, weights_dir), model_name)
+    path = ai_testing.artifact_path(model_name, backend, out_dir)
+    if backend == 'torchscript':
+        return export_torchscript(model, path)
+    elif backend == 'int8':
+        return export_int8(model, path)
+    elif backend == 'onnxruntime':
+        return export_onnx(model, path, ai_testing.input_sizes[model_name])
+    raise ValueError(f"nothing to export for backend '{backend}'")
+
+
+# loads held-out frames as model input tensors at the architecture's input size
+def load_frames(frame_dir, size, limit=None):
+    paths = sorted(glob.glob(os.path.join(frame_dir, "*.jpg")) + glob.glob(os.path.join(frame_dir, "*.png")))
+    for path in paths[:limit]:
+        image = read_image(path, ImageReadMode.RGB).unsqueeze(0)
+        image = F.interpolate(image, size=(size, size), mode='bilinear', antialias=True)[0]
+        yield image.to(torch.float).div_(255)
+
+
+# compares an exported backend against the eager model on held-out frames; every eager box above
+# score_threshold is matched to the backend's best overlapping box at IoU >= 0.5; the eager reference runs
+# at the same input size as the exported backend
+def check_parity(model_name, backend, frame_dir, weights_dir='.', artifact_dir=None, limit=50, score_threshold=0.5):
+    eager = ai_testing.match_input_size(ai_testing.load_model(model_name, weights_dir), model_name)
+    other = ai_testing.load_model(model_name, artifact_dir or weights_dir, backend)
+    frames, reference, matched, extra = 0, 0, 0, 0
+    ious, score_diffs = [], []
+    with torch.inference_mode():
+        for image in load_frames(frame_dir, ai_testing.input_sizes[model_name], limit):
+            frames += 1
+            ref = eager([image])[0]
+            out = other([image])[0]
+            ref_keep = ref['scores'] >= score_threshold
+            out_keep = out['scores'] >= score_threshold
+            ref_boxes, ref_scores = ref['boxes'][ref_keep], ref['scores'][ref_keep]
+            out_boxes, out_scores = out['boxes'][out_keep], out['scores'][out_keep]
+            reference += len(ref_boxes)
+            if len(ref_boxes) == 0 or len(out_boxes) == 0:
+                extra += len(out_boxes)
+                continue
+            best, idx = box_iou(ref_boxes, out_boxes).max(dim=1)
+            hit = best >= 0.5
+            matched += int(hit.sum())
+            extra += len(out_boxes) - len(idx[hit].unique())
+            ious.append(best[hit])
+            score_diffs.append((ref_scores[hit] - out_scores[idx[hit]]).abs())
+    ious = torch.cat(ious) if ious else torch.zeros(0)
+    score_diffs = torch.cat(score_diffs) if score_diffs else torch.zeros(0)
+    return {
+        'model': model_name,
+        'backend': backend,
+        'frames': frames,
+        'boxes': reference,
+        'recall': matched / reference if reference else 1.0,
+        'extra_boxes': extra,
+        'mean_iou': ious.mean().item() if len(ious) else 1.0,
+        'max_score_diff': score_diffs.max().item() if len(score_diffs) else 0.0,
+    }
+
+
+## main function
+def main():
+    parser = argparse.ArgumentParser(description="Export trained models to optimized CPU backends.")
+    parser.add_argument("--models", nargs="+", default=list(ai_testing.input_sizes),
+                        choices=list(ai_testing.input_sizes))
+    parser.add_argument("--backends", nargs="+", default=['torchscript', 'int8', 'onnxruntime'],
+                        choices=['torchscript', 'int8', 'onnxruntime'])
+    parser.add_argument("--weights-dir", default=".", help="directory with the '<model>.pth' weights")
+    parser.add_argument("--out-dir", default=".", help="directory the artifacts are written to")
+    parser.add_argument("--parity-frames", help="directory of held-out frames to check each artifact against eager")
+    parser.add_argument("--parity-limit", type=int, default=50)
+    parser.add_argument("--min-iou", type=float, default=0.9)
+    parser.add_argument("--min-recall", type=float, default=0.95)
+    args = parser.parse_args()
+
+    failed = False
+    for model_name in args.models:
+        for backend in args.backends:
+            if not export_model(model_name, backend, args.weights_dir, args.out_dir):
+                print(f"{model_name} [{backend}]: not supported by this architecture, skipped")
+                continue
+            print(f"{model_name} [{backend}]: wrote {ai_testing.artifact_path(model_name, backend, args.out_dir)}")
+            if args.parity_frames:
+                report = check_parity(model_name, backend, args.parity_frames, args.weights_dir, args.out_dir,
+                                      args.parity_limit)
+                ok = report['mean_iou'] >= args.min_iou and report['recall'] >= args.min_recall
+                failed = failed or not ok
+                print("  parity {0}: recall {1:.3f}, mean IoU {2:.3f}, max score diff {3:.3f}, "
+                      "{4} extra boxes over {5} frames".format("ok" if ok else "FAILED", report['recall'],
+                                                               report['mean_iou'], report['max_score_diff'],
+                                                               report['extra_boxes'], report['frames']))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import threading
+from collections import namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+
+# a frame held in the ring, 'seq' increases by one for every frame written and 'timestamp' is
+# the probe's image timestamp in nanoseconds
+Frame = namedtuple("Frame", ["seq", "timestamp", "data"])
+
+
+# preallocated ring of uint8 frames, the cast callback copies each new image into it exactly once
+# readers get views into the ring, which stay valid until 'slots' newer frames have been written
+class FrameRing:
+    def __init__(self, slots=4):
+        self.slots = slots
+        self.frames = None
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    # copy a callback image buffer into the next slot and return it as a Frame
+    # @param image the image data from the callback (any buffer-protocol object)
+    # @param width width of the image in pixels
+    # @param height height of the image in pixels
+    # @param bpp bytes per pixel, 4 for ARGB32 and 1 for grayscale
+    # @param timestamp the image timestamp in nanoseconds
+    def write(self, image, width, height, bpp, timestamp):
+        shape = (height, width, bpp) if bpp > 1 else (height, width)
+        src = np.frombuffer(image, dtype=np.uint8, count=int(np.prod(shape)))
+        return self.write_array(src.reshape(shape), timestamp)
+
+    # copy a uint8 image array into the next slot and return it as a Frame, any view (e.g. a transposed one)
+    # is copied into a contiguous frame
+    def write_array(self, array, timestamp):
+        shape = array.shape
+        with self.lock:
+            # the ring is only reallocated when the output size changes, readers holding views into
+            # the old array keep it alive
+            if self.frames is None or self.frames.shape[1:] != shape:
+                self.frames = self._allocate(shape)
+            self.seq += 1
+            seq = self.seq
+            data = self.frames[seq % self.slots]
+            self._claim(seq)
+        np.copyto(data, array)
+        return Frame(seq, timestamp, data)
+
+    def _allocate(self, shape):
+        return np.empty((self.slots,) + shape, dtype=np.uint8)
+
+    # called with the lock held just before the slot of frame 'seq' is written
+    def _claim(self, seq):
+        pass
+
+    # true while the frame written as 'seq' has not been overwritten by a newer one
+    def is_live(self, seq):
+        return self.seq - seq < self.slots
+
+    # releases the ring's memory, only needed for a SharedFrameRing
+    def close(self):
+        pass
+
+
+# FrameRing held in shared memory, so another process can read the frames without a copy (see inference_server.py)
+# the segment starts with the int64 seq of the frame in each slot, set before the slot is written, so a reader
+# in another process can tell whether a frame has been overwritten while it was reading it
+class SharedFrameRing(FrameRing):
+    def __init__(self, slots=4):
+        FrameRing.__init__(self, slots)
+        self.seqs = None
+        # (first seq, segment, shape) of every segment, a new one is made whenever the output size changes
+        self.segments = []
+
+    def _allocate(self, shape):
+        header = 8 * self.slots
+        shm = shared_memory.SharedMemory(create=True, size=header + self.slots * int(np.prod(shape)))
+        self.seqs = np.ndarray((self.slots,), dtype=np.int64, buffer=shm.buf)
+        self.seqs[:] = 0
+        self.segments.append((self.seq + 1, shm, shape))
+        # a segment already handed out stays mapped by its readers, but can't be found by name anymore
+        if len(self.segments) > 1:
+            self.segments[-2][1].unlink()
+        return np.ndarray((self.slots,) + shape, dtype=np.uint8, buffer=shm.buf, offset=header)
+
+    def _claim(self, seq):
+        self.seqs[seq % self.slots] = seq
+        if len(self.segments) > 1:
+            self._release()
+
+    # unmaps the segments from before the last resize once no frame points into them anymore, their memory is
+    # freed when the server has let go of them too
+    def _release(self):
+        kept = []
+        for segment in self.segments[:-1]:
+            try:
+                segment[1].close()
+            except BufferError:
+                kept.append(segment)
+        self.segments = kept + self.segments[-1:]
+
+    # where another process finds a frame: the segment name, its layout, and the frame's slot and seq
+    def location(self, frame):
+        with self.lock:
+            first, shm, shape = next(segment for segment in reversed(self.segments) if segment[0] <= frame.seq)
+        return {'name': shm.name, 'slots': self.slots, 'shape': shape, 'slot': frame.seq % self.slots,
+                'seq': frame.seq}
+
+    # unmaps and removes the shared memory, frames still referenced keep their segment mapped
+    def close(self):
+        with self.lock:
+            self.frames = None
+            self.seqs = None
+            for i, (first, shm, shape) in enumerate(self.segments):
+                if i == len(self.segments) - 1:
+                    shm.unlink()
+                try:
+                    shm.close()
+                except BufferError:
+                    pass
+            self.segments = []
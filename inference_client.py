@@ -0,0 +1,118 @@
+import os
+import secrets
+import time
+from multiprocessing.connection import Client
+
+import model_registry
+
+# the viewer's side of inference_server.py, which doesn't import torch, so a viewer using a server doesn't either
+
+# where the key shared by the server and its clients is kept when $PORTABLE_BUS_AUTHKEY isn't set
+authkey_path = os.path.join(os.path.expanduser('~'), '.portable-bus', 'authkey')
+
+
+# the key a client needs to connect; messages are pickled, so anyone holding it can run code in the server or the
+# viewer. $PORTABLE_BUS_AUTHKEY if set, otherwise the key in authkey_path, generated the first time and only
+# readable by its owner, so a server and viewers run by the same user on one machine share it
+def load_authkey(path=authkey_path):
+    key = os.environ.get('PORTABLE_BUS_AUTHKEY')
+    if key:
+        return key.encode()
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        with open(path, 'rb') as f:
+            return f.read().strip()
+    key = secrets.token_hex(32).encode()
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
+    return key
+
+
+default_address = 'localhost:6001'
+
+
+# 'host:port' for a local TCP socket, anything else is a unix socket path or a windows pipe name
+def parse_address(address):
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit():
+        return host, int(port)
+    return address
+
+
+# a request the server refused or failed, e.g. 'select' for a model it has no artifact for; 'request' is the
+# kind of message, and the connection stays usable
+class ServerError(Exception):
+    def __init__(self, request, message):
+        Exception.__init__(self, message)
+        self.request = request
+
+
+# a viewer's connection to an InferenceServer, for the frames of one probe held in a SharedFrameRing
+# on connecting, the model and backend the server is running are selected in model_registry; from then on the
+# selection and detector settings are sent along whenever they change, so the model menu and the latency
+# controller work as they do in-process
+class InferenceClient:
+    # 'timeout' is how long a frame's predictions may take, 'select_timeout' how long when the server first has to
+    # load a newly selected model
+    def __init__(self, frames, address=default_address, authkey=None, timeout=5.0, select_timeout=60.0):
+        self.frames = frames
+        self.conn = Client(parse_address(address), authkey=authkey or load_authkey())
+        self.timeout = timeout
+        self.select_timeout = select_timeout
+        # frames sent so far, every reply carries the number of the frame it is for
+        self.requests = 0
+        if not self.conn.poll(timeout):
+            self.conn.close()
+            raise TimeoutError("the inference server didn't answer in {0:.0f} s".format(timeout))
+        kind, model_name, backend, variant = self.conn.recv()
+        model_registry.registry.select(model_name, backend)
+        # the variant follows the viewer's input, it is sent with the first frame if it differs
+        self.selected = (model_name, backend, variant)
+        self.settings = None
+
+    # predictions for a frame in the same format as ai_testing.predict_with_frame but as numpy arrays, None if the
+    # frame was overwritten before the server read it; 'frames' is the ring the frame is in if not the client's own
+    # raises EOFError or OSError if the server has gone away, TimeoutError if it doesn't answer in time (the frame
+    # is then dropped, its late reply is discarded), and ServerError if it failed this frame or the selection or
+    # settings sent with it
+    def predict(self, frame, frames=None):
+        registry = model_registry.registry
+        timeout = self.timeout
+        if self.selected != (registry.model_name, registry.backend, registry.variant):
+            self.selected = (registry.model_name, registry.backend, registry.variant)
+            self.conn.send(('select',) + self.selected)
+            timeout = self.select_timeout
+        if self.settings != registry.settings:
+            self.settings = dict(registry.settings)
+            self.conn.send(('settings', self.settings))
+        self.requests += 1
+        self.conn.send(('frame', dict((frames or self.frames).location(frame), request=self.requests)))
+        # the frame's predictions come after any errors for it; replies to frames that timed out are skipped
+        deadline = time.monotonic() + timeout
+        errors = []
+        while True:
+            if not self.conn.poll(max(deadline - time.monotonic(), 0)):
+                raise TimeoutError("no predictions from the inference server in {0:.0f} s".format(timeout))
+            reply = self.conn.recv()
+            if reply[0] == 'predictions':
+                if reply[1] == self.requests:
+                    break
+            elif reply[1] != 'frame' or reply[3] == self.requests:
+                errors.append(reply)
+        if errors:
+            request, message = errors[0][1:3]
+            # what was refused is sent again once it changes, e.g. when the viewer goes back to the last selection
+            if request == 'select':
+                self.selected = None
+            elif request == 'settings':
+                self.settings = None
+            raise ServerError(request, message)
+        kind, request, objects = reply
+        if objects is None:
+            return None
+        return [objects]
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+import argparse
+import sys
+import threading
+import time
+import numpy as np
+import torch
+from collections import OrderedDict
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Listener
+
+import ai_testing
+import telemetry
+from inference_client import default_address, load_authkey, parse_address
+
+# maps a client's ring without taking ownership of it, the client unlinks it when it is done
+def _attach(name):
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13 attaching registers the segment to be removed when this process exits
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+# a client's SharedFrameRing as mapped by the server
+class RingView:
+    def __init__(self, location):
+        self.name = location['name']
+        self.shm = _attach(self.name)
+        slots = location['slots']
+        self.seqs = np.ndarray((slots,), dtype=np.int64, buffer=self.shm.buf)
+        self.frames = np.ndarray((slots,) + tuple(location['shape']), dtype=np.uint8, buffer=self.shm.buf,
+                                 offset=8 * slots)
+
+    # true while the frame at a location hasn't been overwritten by a newer one
+    def is_live(self, location):
+        return self.seqs[location['slot']] == location['seq']
+
+    def close(self):
+        self.seqs = None
+        self.frames = None
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+
+
+# hosts the AI models in their own process for any number of viewers, one per probe
+# each client sends the location of its newest frame in its shared memory ring and gets the boxes back on its
+# connection; frames waiting from different clients are run through the model together, waiting up to
+# batch_window_ms after the first one for the other streams to catch up
+# the model and detector settings are shared, the last client to change them sets them for every stream
+class InferenceServer:
+    def __init__(self, address=default_address, max_batch=4, batch_window_ms=5.0, authkey=None):
+        self.listener = Listener(parse_address(address), authkey=authkey or load_authkey())
+        self.max_batch = max_batch
+        self.batch_window = batch_window_ms / 1000.0
+        self.cond = threading.Condition()
+        # newest frame location of each connection, a newer frame replaces one that hasn't been run yet
+        self.pending = OrderedDict()
+        self.streams = set()
+        self.closed = []
+        # replies go out from the batching loop and, for failed requests, the receive threads
+        self.send_lock = threading.Lock()
+        # one client's model switch at a time, so a failed one restores the selection it replaced
+        self.select_lock = threading.Lock()
+        # only touched by the batching loop
+        self.rings = {}
+        self.batches = 0
+        self.processed = 0
+        self.superseded = 0
+
+    # accepts clients in the background and batches their frames on the calling thread; a batch the model fails
+    # on is answered with errors and a model that can't be loaded is refused, so the server keeps serving
+    def serve_forever(self):
+        threading.Thread(target=self.accept, daemon=True).start()
+        while True:
+            self.run_batch(self.next_batch())
+
+    # a new client is told what the server is running, which it adopts rather than selecting its own default
+    def accept(self):
+        while True:
+            conn = self.listener.accept()
+            registry = ai_testing.registry
+            self.send(conn, ('selected', registry.model_name, registry.backend, registry.variant))
+            with self.cond:
+                self.streams.add(conn)
+            threading.Thread(target=self.receive, args=(conn,), daemon=True).start()
+
+    # reads one client's messages until it disconnects
+    # a request that fails, e.g. selecting a model there is no artifact for or that doesn't load, is answered
+    # with ('error', kind, message) and changes nothing, the client stays connected; a failed frame's error
+    # also carries the client's number for it
+    def receive(self, conn):
+        try:
+            while True:
+                message = conn.recv()
+                try:
+                    if message[0] == 'frame':
+                        with self.cond:
+                            if conn in self.pending:
+                                self.superseded += 1
+                                telemetry.pipeline.count("superseded")
+                            self.pending[conn] = message[1]
+                            self.cond.notify()
+                    elif message[0] == 'select':
+                        self.select(*message[1:])
+                    elif message[0] == 'settings':
+                        ai_testing.set_detector_settings(**message[1])
+                except Exception as e:
+                    self.send(conn, ('error', message[0], str(e) or type(e).__name__))
+        except (EOFError, OSError):
+            pass
+        with self.cond:
+            self.streams.discard(conn)
+            self.pending.pop(conn, None)
+            self.closed.append(conn)
+            self.cond.notify()
+
+    # selects a model for every stream and loads it here, so a model that can't be loaded is refused (and the
+    # model that was running stays selected) instead of failing every frame after it
+    def select(self, model_name, backend, variant):
+        registry = ai_testing.registry
+        with self.select_lock:
+            previous = (registry.model_name, registry.backend, registry.variant)
+            try:
+                registry.select(model_name, backend)
+                ai_testing.set_variant(variant)
+                registry.active()
+            except Exception:
+                registry.select(*previous[:2])
+                ai_testing.set_variant(previous[2])
+                raise
+
+    # waits for frames, then briefly for every other stream to send one too, so they share one model call
+    def next_batch(self):
+        with self.cond:
+            while not self.pending:
+                self.cond.wait()
+            deadline = time.monotonic() + self.batch_window
+            while len(self.pending) < min(len(self.streams), self.max_batch):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = [self.pending.popitem(last=False) for _ in range(min(len(self.pending), self.max_batch))]
+            closed, self.closed = self.closed, []
+        for conn in closed:
+            ring = self.rings.pop(conn, None)
+            if ring is not None:
+                ring.close()
+            conn.close()
+        return batch
+
+    # the client's ring a location is in, mapping it again when the client has reallocated it
+    def ring(self, conn, location):
+        ring = self.rings.get(conn)
+        if ring is None or ring.name != location['name']:
+            if ring is not None:
+                ring.close()
+            ring = self.rings[conn] = RingView(location)
+        return ring
+
+    # runs a batch straight from the clients' rings and answers every client in it, with None for frames
+    # that were overwritten before or while they were read, or that the model failed on
+    def run_batch(self, batch):
+        replies = []
+        live = []
+        for conn, location in batch:
+            try:
+                ring = self.ring(conn, location)
+            except FileNotFoundError:
+                # the ring was reallocated and removed after this frame was sent
+                ring = None
+            if ring is not None and ring.is_live(location):
+                live.append((conn, location, ring))
+            else:
+                replies.append((conn, location, None))
+        if live:
+            try:
+                outputs = ai_testing.predict_with_frames(
+                    [ring.frames[location['slot']] for _, location, ring in live],
+                    lambda i: live[i][2].is_live(live[i][1]))
+                self.batches += 1
+                self.processed += len(live)
+            except Exception as e:
+                # logged by ai_testing; only this batch fails, its clients are told and the server keeps serving
+                for conn, location, _ in live:
+                    self.send(conn, ('error', 'frame', str(e) or type(e).__name__, location['request']))
+                outputs = [None] * len(live)
+            replies.extend((conn, location, output) for (conn, location, _), output in zip(live, outputs))
+        for conn, location, output in replies:
+            objects = None if output is None else {k: v.detach().numpy() for k, v in output.items()}
+            self.send(conn, ('predictions', location['request'], objects))
+
+    def send(self, conn, message):
+        with self.send_lock:
+            try:
+                conn.send(message)
+            except (EOFError, OSError):
+                pass
+
+
+## main function
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve AI lesion detection to pysidecaster.py viewers over shared memory.")
+    parser.add_argument("--address", default=default_address,
+                        help="host:port, or a unix socket path / pipe name; viewers elsewhere also need the same "
+                             "$PORTABLE_BUS_AUTHKEY")
+    parser.add_argument("--model", default=ai_testing.registry.model_name, choices=list(ai_testing.input_sizes))
+    parser.add_argument("--backend", default=ai_testing.registry.backend, choices=ai_testing.backends)
+    parser.add_argument("--weights-dir", default=".", help="directory with the model weights and artifacts")
+    parser.add_argument("--max-batch", type=int, default=4, help="most frames run through the model at once")
+    parser.add_argument("--batch-window", type=float, default=5.0,
+                        help="ms to wait for the other streams' frames before running a batch")
+    parser.add_argument("--threads", type=int, help="torch intra-op threads")
+    parser.add_argument("--telemetry", help="periodically dump preprocess/forward telemetry here, a Prometheus "
+                                            "textfile if it ends in .prom and CSV otherwise")
+    parser.add_argument("--telemetry-interval", type=float, default=10.0, help="seconds between telemetry dumps")
+    args = parser.parse_args()
+
+    if args.telemetry:
+        telemetry.pipeline.start_dump(args.telemetry, args.telemetry_interval)
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    ai_testing.registry.weights_dir = args.weights_dir
+    try:
+        ai_testing.registry.select(args.model, args.backend)
+    except FileNotFoundError as e:
+        sys.exit(str(e))
+    # load and warm up the model before the first client connects, rather than on its first frames
+    ai_testing.registry.active()
+    ai_testing.warm_up((480, 640, 4))
+    server = InferenceServer(args.address, args.max_batch, args.batch_window)
+    print("serving {0} ({1}) on {2}, ready in {3:.1f} s".format(args.model, args.backend, args.address,
+                                                                telemetry.pipeline.mark("model_ready")))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("{0} frames in {1} batches ({2:.2f} per batch), {3} frames superseded".format(
+            server.processed, server.batches, server.processed / max(server.batches, 1), server.superseded))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+from collections import deque
+
+import numpy as np
+
+import model_registry
+
+# settings the controller steps through as inference falls behind the budget, each cheaper than the last
+# 'skip' runs the detector on every n-th frame only, 'fallback' switches to the next lighter architecture
+_reduced = {'score_thresh': 0.3, 'detections_per_img': 10, 'pre_nms_top_n': 300}
+levels = [
+    {},
+    _reduced,
+    dict(_reduced, input_scale=0.75),
+    dict(_reduced, input_scale=0.75, skip=2),
+    dict(_reduced, input_scale=0.75, skip=2, fallback=True),
+]
+
+
+# next faster architecture that has weights for the selected backend, or None if there is none
+def lighter_model(model_name, backend, weights_dir='.'):
+    for name in model_registry.speed_order[model_registry.speed_order.index(model_name) + 1:]:
+        if os.path.exists(model_registry.artifact_path(name, backend, weights_dir)):
+            return name
+    return None
+
+
+# keeps the per-frame cost of inference within a latency budget by trading detector work for speed
+# the median inference time over a window of frames, spread over the frames skipped, is compared to
+# the budget; over it the next cheaper level is applied, under 'headroom' of it the previous one
+class LatencyController:
+    def __init__(self, budget_ms=66.0, window=10, headroom=0.5):
+        self.budget = budget_ms / 1000.0
+        self.headroom = headroom
+        self.times = deque(maxlen=window)
+        self.level = 0
+        self.skip = 1
+        # model selected before falling back to a lighter one
+        self.model_name = None
+        # windows under budget needed before stepping down, doubled whenever a step down doesn't hold
+        self.hold = 1
+        self.calm = 0
+        self.stepped_down = False
+
+    # go back to full settings; with restore=False a model fallen back from isn't selected again,
+    # e.g. because the user has just picked another one
+    def reset(self, restore=True):
+        if not restore:
+            self.model_name = None
+        self.hold = 1
+        self.stepped_down = False
+        return self.apply(0)
+
+    # record how long an inference took, returns a description of the new settings if they changed
+    def record(self, seconds):
+        self.times.append(seconds)
+        if len(self.times) < self.times.maxlen:
+            return None
+        cost = float(np.median(self.times)) / self.skip
+        if cost > self.budget and self.level + 1 < len(levels):
+            # going straight back up means the cheaper level is still needed, wait longer next time
+            if self.stepped_down:
+                self.hold = min(self.hold * 2, 64)
+            level = self.level + 1
+            while level + 1 < len(levels) and self.redundant(level):
+                level += 1
+            return self.apply(level)
+        if cost < self.headroom * self.budget and self.level > 0:
+            self.calm += 1
+            self.times.clear()
+            if self.calm < self.hold:
+                return None
+            level = self.level - 1
+            while level > 0 and self.redundant(level):
+                level -= 1
+            message = self.apply(level)
+            self.stepped_down = True
+            return message
+        self.stepped_down = False
+        self.calm = 0
+        self.times.clear()
+        return None
+
+    # a level for the selected model, without input_scale where it saves no time
+    def settings(self, level):
+        settings = dict(levels[level])
+        registry = model_registry.registry
+        if not model_registry.input_scale_applies(registry.model_name, registry.backend):
+            settings.pop('input_scale', None)
+        return settings
+
+    # true if a level changes nothing over the one below it for the selected model, so it is stepped over
+    def redundant(self, level):
+        return level > 0 and self.settings(level) == self.settings(level - 1)
+
+    # switch to a level and describe it for the status bar
+    def apply(self, level):
+        self.level = level
+        self.times.clear()
+        self.calm = 0
+        self.stepped_down = False
+        self.skip = levels[level].get('skip', 1)
+        fallback = levels[level].get('fallback', False)
+        registry = model_registry.registry
+        if fallback and self.model_name is None:
+            lighter = lighter_model(registry.model_name, registry.backend, registry.weights_dir)
+            if lighter is not None:
+                self.model_name = registry.model_name
+                model_registry.set_model(lighter)
+        elif not fallback and self.model_name is not None:
+            try:
+                model_registry.set_model(self.model_name)
+            except FileNotFoundError:
+                # a backend picked since has no artifact for it, the lighter model stays
+                pass
+            self.model_name = None
+        # the model may have just changed, input_scale is dropped for the one now selected
+        settings = {k: v for k, v in self.settings(level).items() if k not in ('skip', 'fallback')}
+        model_registry.set_detector_settings(**settings)
+        return self.describe(settings)
+
+    def describe(self, settings):
+        if self.level == 0:
+            return "Latency budget {0:.0f} ms: full detector".format(self.budget * 1000.0)
+        parts = ["score >= {0}".format(settings['score_thresh']), "top {0}".format(settings['detections_per_img']),
+                 "{0} proposals".format(settings['pre_nms_top_n'])]
+        if 'input_scale' in settings:
+            parts.append("{0:.0%} input".format(settings['input_scale']))
+        if self.skip > 1:
+            parts.append("every {0} frames".format(self.skip))
+        if self.model_name is not None:
+            parts.append(model_registry.registry.model_name)
+        return "Latency budget {0:.0f} ms: level {1} ({2})".format(self.budget * 1000.0, self.level, ", ".join(parts))
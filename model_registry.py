@@ -0,0 +1,124 @@
+import os
+import threading
+from collections import OrderedDict
+
+# which detectors there are, how they are run and which one is selected, without importing torch, so that
+# pysidecaster.py can show and change the selection while the models load or run in inference_server.py
+# ai_testing.py loads and runs the models, and re-exports everything here
+
+# square input size each architecture is run at during scanning, independent of the display size
+input_sizes = {
+    'fasterrcnn_mobilenet_v3_large_320_fpn': 320,
+    'fasterrcnn_resnet50_fpn': 512,
+    'retinanet_resnet50_fpn': 512,
+    'ssd300_vgg16': 300,
+    'ssdlite320_mobilenet_v3_large': 320,
+}
+
+# architectures trained at a fixed size, which they resize any input to internally
+fixed_size_models = ['ssd300_vgg16', 'ssdlite320_mobilenet_v3_large']
+
+# whether the input_scale setting makes a model any cheaper; fixed size architectures and exported backends
+# resize a smaller input back up to the size they were built or exported with, losing detail for nothing
+def input_scale_applies(model_name, backend):
+    return backend == 'eager' and model_name not in fixed_size_models
+
+# architectures from slowest to fastest on CPU, the latency controller falls back along this list
+speed_order = ['fasterrcnn_resnet50_fpn', 'retinanet_resnet50_fpn', 'ssd300_vgg16',
+               'fasterrcnn_mobilenet_v3_large_320_fpn', 'ssdlite320_mobilenet_v3_large']
+
+# detector settings that can be turned down at runtime, None keeps the model's own value
+# input_scale shrinks the input size from input_sizes, pre_nms_top_n is the number of proposals
+# (FasterRCNN) or candidates per level (RetinaNet/SSD) kept before NMS
+default_settings = {'input_scale': 1.0, 'pre_nms_top_n': None, 'detections_per_img': None, 'score_thresh': None}
+
+# ways a model can be run, every backend except 'eager' loads an artifact written by export_models.py
+backends = ['eager', 'torchscript', 'int8', 'onnxruntime']
+
+# file a backend's artifact for a model is stored in; a variant is a model fine-tuned for another kind of
+# input, e.g. 'raw' for pre-scan-converted frames in '<model_name>.raw.pth'
+def artifact_path(model_name, backend, weights_dir='.', variant=None):
+    suffixes = {'eager': '.pth', 'torchscript': '.pt', 'int8': '.int8.pt', 'onnxruntime': '.onnx'}
+    if backend not in suffixes:
+        raise ValueError(f"unknown backend '{backend}', expected one of {backends}")
+    name = model_name if variant is None else model_name + '.' + variant
+    return os.path.join(weights_dir, name + suffixes[backend])
+
+# keeps the most recently used models loaded, loading each one lazily the first time it is asked for
+# the selected model can be changed at any time, predictions already running finish on the old model
+class ModelRegistry:
+    def __init__(self, model_name='fasterrcnn_resnet50_fpn', backend='eager', weights_dir='.', max_loaded=2):
+        self.model_name = model_name
+        self.backend = backend
+        self.weights_dir = weights_dir
+        self.max_loaded = max_loaded
+        # weights variant used where a model has it, see set_variant
+        self.variant = None
+        # select refuses models without an artifact in weights_dir for the backend; off in a viewer whose models
+        # run in an inference server, which checks its own
+        self.check_artifacts = True
+        self.settings = dict(default_settings)
+        self.models = OrderedDict()
+        self.lock = threading.Lock()
+
+    # select the model (and optionally backend) used by the next prediction, it is loaded when that prediction runs
+    # raises FileNotFoundError, keeping the current selection, if the backend's artifact for the model is missing
+    def select(self, model_name, backend=None):
+        if model_name not in input_sizes:
+            raise ValueError(f"unknown model '{model_name}', expected one of {list(input_sizes)}")
+        if backend is None:
+            backend = self.backend
+        elif backend not in backends:
+            raise ValueError(f"unknown backend '{backend}', expected one of {backends}")
+        path = artifact_path(model_name, backend, self.weights_dir)
+        if self.check_artifacts and not os.path.exists(path):
+            raise FileNotFoundError(f"no {backend} artifact for '{model_name}' at {path}, see export_models.py")
+        self.model_name = model_name
+        self.backend = backend
+
+    # get a model, loading it and evicting the least recently used one if needed
+    def get(self, model_name, backend='eager', variant=None):
+        key = (model_name, backend, variant)
+        with self.lock:
+            if key in self.models:
+                self.models.move_to_end(key)
+                return self.models[key]
+            # ai_testing imports torch, which only a process that runs the models needs
+            import ai_testing
+            model = ai_testing.match_input_size(
+                ai_testing.load_model(model_name, self.weights_dir, backend, variant), model_name)
+            self.models[key] = model
+            while len(self.models) > self.max_loaded:
+                self.models.popitem(last=False)
+            return model
+
+    # the selected model name along with the model itself
+    def active(self):
+        model_name, backend, variant = self.model_name, self.backend, self.variant
+        # models without weights for the variant run their usual weights on its input
+        if variant is not None and not os.path.exists(artifact_path(model_name, backend, self.weights_dir, variant)):
+            variant = None
+        return model_name, self.get(model_name, backend, variant)
+
+# models used for scanning, see DemoModelTrainEval.ipynb for how each architecture was trained
+registry = ModelRegistry()
+
+# switch the model used for predictions without restarting
+def set_model(model_name):
+    registry.select(model_name)
+
+# switch how the selected model is run, e.g. to 'int8' on slower machines
+def set_backend(backend):
+    registry.select(registry.model_name, backend)
+
+# use the weights fine-tuned for another kind of input where a model has them, e.g. 'raw' while predicting on
+# pre-scan-converted frames, or None for the usual ones
+def set_variant(variant):
+    registry.variant = variant
+
+# change the detector settings used by the next prediction, settings that aren't given are reset to the default
+def set_detector_settings(**settings):
+    unknown = set(settings) - set(default_settings)
+    if unknown:
+        raise ValueError(f"unknown detector settings {sorted(unknown)}, expected {list(default_settings)}")
+    registry.settings = dict(default_settings, **settings)
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import os
+import numpy as np
+
+# arrays an annotation file is compiled into, frame 'frames[i]' has boxes[offsets[i]:offsets[i + 1]]
+# boxes are (x0, y0, x1, y1) float32 and areas are their float32 areas
+arrays = ['frames', 'offsets', 'boxes', 'areas']
+
+# bumped whenever the compiled layout changes, so stale indexes are rebuilt
+version = 1
+
+
+# boxes of a frame's annotation objects, as PhantomDataset builds them from the labeled video data
+def annotation_boxes(objects):
+    boxes = []
+    for feature in objects.values():
+        if feature['annotation_kind'] == 'VideoBoundingBox':
+            top = int(feature['bounding_box']['top'])
+            left = int(feature['bounding_box']['left'])
+            height = int(feature['bounding_box']['height'])
+            width = int(feature['bounding_box']['width'])
+            boxes.append([left, top, left + width, top + height])
+        elif feature['annotation_kind'] == 'VideoPolyline':
+            all_x = [d['x'] for d in feature['line']]
+            all_y = [d['y'] for d in feature['line']]
+            boxes.append([min(all_x), min(all_y), max(all_x), max(all_y)])
+    return boxes
+
+
+# identifies the annotation file an index was compiled from
+def _source_stamp(json_file):
+    stat = os.stat(json_file)
+    return {'version': version, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+# compiles a labeled video's annotation file into the arrays above, one .npy file each in index_dir
+def compile_annotations(json_file, index_dir):
+    with open(json_file) as f:
+        data = json.load(f)
+    project = list(data['projects'].keys())[0]
+    frames = data['projects'][project]['labels'][0]['annotations']['frames']
+
+    numbers = []
+    offsets = [0]
+    boxes = []
+    for key, frame in frames.items():
+        numbers.append(int(key))
+        boxes.extend(annotation_boxes(frame['objects']))
+        offsets.append(len(boxes))
+    boxes = np.asarray(boxes, dtype=np.float32).reshape(-1, 4)
+    compiled = {
+        'frames': np.asarray(numbers, dtype=np.int64),
+        'offsets': np.asarray(offsets, dtype=np.int64),
+        'boxes': boxes,
+        'areas': (boxes[:, 3] - boxes[:, 1]) * (boxes[:, 2] - boxes[:, 0]),
+    }
+
+    os.makedirs(index_dir, exist_ok=True)
+    # each file is written whole before it replaces the old one, and the stamp last, so an interrupted
+    # compile is never mistaken for a valid index
+    for name, array in compiled.items():
+        path = os.path.join(index_dir, name + '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path)
+    stamp = os.path.join(index_dir, 'source.json')
+    with open(stamp + '.tmp', 'w') as f:
+        json.dump(_source_stamp(json_file), f)
+    os.replace(stamp + '.tmp', stamp)
+
+
+# memory-mapped annotation arrays of one labeled video
+# only the index directory is pickled, so DataLoader workers each map the same files instead of copying them
+class AnnotationIndex:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        self.arrays = None
+
+    def __getstate__(self):
+        return {'index_dir': self.index_dir, 'arrays': None}
+
+    def _load(self):
+        if self.arrays is None:
+            self.arrays = {name: np.load(os.path.join(self.index_dir, name + '.npy'), mmap_mode='r')
+                           for name in arrays}
+        return self.arrays
+
+    def __len__(self):
+        return len(self._load()['frames'])
+
+    # the annotated frame numbers, in the order of the annotation file
+    @property
+    def frames(self):
+        return self._load()['frames']
+
+    @property
+    def offsets(self):
+        return self._load()['offsets']
+
+    # boxes and areas of the i-th annotated frame
+    def objects(self, i):
+        a = self._load()
+        start, stop = a['offsets'][i], a['offsets'][i + 1]
+        return a['boxes'][start:stop], a['areas'][start:stop]
+
+
+# the index of an annotation file, compiled to '<json_file>.index' the first time or whenever the file has changed
+def load_index(json_file, index_dir=None):
+    index_dir = index_dir or json_file + '.index'
+    try:
+        with open(os.path.join(index_dir, 'source.json')) as f:
+            fresh = json.load(f) == _source_stamp(json_file)
+    except (OSError, ValueError):
+        fresh = False
+    if not fresh:
+        compile_annotations(json_file, index_dir)
+    return AnnotationIndex(index_dir)
+
+
+
+# decodes the annotated frames of a labeled video once into a single uint8 (frames, channels, height, width)
+# array, 'images.npy' in index_dir, with row i holding the image of the index's i-th annotated frame
+# frames are read the way PhantomDataset reads them, '<image_root><frame - 1>.jpg'
+def pack_frames(json_file, image_root, index_dir):
+    from torchvision.io import read_image  # only needed to pack frames
+    frames = np.array(load_index(json_file, index_dir).frames)
+    path = os.path.join(index_dir, 'images.npy')
+    images = None
+    for i, frame in enumerate(frames):
+        image = read_image(image_root + str(int(frame) - 1) + ".jpg").numpy()
+        if images is None:
+            # written straight to disk, so packing a long video doesn't need it all in memory
+            images = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=np.uint8,
+                                               shape=(len(frames),) + image.shape)
+        elif image.shape != images.shape[1:]:
+            raise ValueError(f"frame {frame} of {json_file} is {image.shape}, expected {images.shape[1:]}")
+        images[i] = image
+    if images is None:
+        raise ValueError(f"{json_file} has no annotated frames to pack")
+    images.flush()
+    del images
+    os.replace(path + '.tmp', path)
+    stamp = os.path.join(index_dir, 'images.json')
+    with open(stamp + '.tmp', 'w') as f:
+        json.dump(_images_stamp(json_file, image_root), f)
+    os.replace(stamp + '.tmp', stamp)
+
+
+# identifies the annotations and image directory a frame store was packed from
+# the images themselves aren't checked, delete 'images.npy' after replacing extracted frames
+def _images_stamp(json_file, image_root):
+    return {'annotations': _source_stamp(json_file), 'image_root': os.path.abspath(image_root)}
+
+
+# memory-mapped decoded frames of one labeled video, indexed like AnnotationIndex
+# the mapping is copy-on-write, so frames can be handed to torch without a copy and without being writable
+# on disk, and only the path is pickled, so DataLoader workers share the page cache
+class FrameStore:
+    def __init__(self, path):
+        self.path = path
+        self.images = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'images': None}
+
+    def _load(self):
+        if self.images is None:
+            self.images = np.load(self.path, mmap_mode='c')
+        return self.images
+
+    def __len__(self):
+        return len(self._load())
+
+    def __getitem__(self, i):
+        return self._load()[i]
+
+
+# the frame store of a labeled video, packed into '<json_file>.index' the first time or whenever the
+# annotation file has changed
+def load_frames(json_file, image_root, index_dir=None):
+    index_dir = index_dir or json_file + '.index'
+    try:
+        with open(os.path.join(index_dir, 'images.json')) as f:
+            fresh = json.load(f) == _images_stamp(json_file, image_root)
+        fresh = fresh and os.path.exists(os.path.join(index_dir, 'images.npy'))
+    except (OSError, ValueError):
+        fresh = False
+    if not fresh:
+        pack_frames(json_file, image_root, index_dir)
+    return FrameStore(os.path.join(index_dir, 'images.npy'))
+
+
+## main function
+def main():
+    parser = argparse.ArgumentParser(description="Compile labeled video annotation files into memory-mapped indexes.")
+    parser.add_argument("json_files", nargs="+", help="labeled video .ndjson files")
+    parser.add_argument("--frames", nargs="+",
+                        help="frame directory of each annotation file, to also pack its decoded frames")
+    args = parser.parse_args()
+    if args.frames and len(args.frames) != len(args.json_files):
+        parser.error("--frames needs one frame directory per annotation file")
+    for i, json_file in enumerate(args.json_files):
+        index = load_index(json_file)
+        print("{0}: {1} frames, {2} boxes -> {3}".format(json_file, len(index), index.offsets[-1],
+                                                        index.index_dir))
+        if args.frames:
+            store = load_frames(json_file, os.path.join(args.frames[i], ''))
+            print("{0}: {1} images {2} -> {3}".format(json_file, len(store), store[0].shape, store.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,581 @@
+import heapq
+import itertools
+import math
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+
+# ---------------- Workday Timeline ---------------- #
+
+# the simulated day, with times as minute offsets from the start of the workday
+WORKDAY_START = datetime(2024, 10, 12, 8, 0)
+BREAK_START = 240   # 12:00 PM
+BREAK_LENGTH = 60
+WORKDAY_END = 480   # 4:00 PM
+
+DISCHARGE, CHARGE = 0, 1
+
+# ---------------- Battery + Temperature Models ---------------- #
+
+
+def discharging_model_battery(t, V0, tau, V_final=6):
+    """
+    Exponential discharge model for battery percentage.
+    Approaches V_final asymptotically.
+    """
+    return V_final + (V0 - V_final) * np.exp(-t / tau)
+
+
+def charging_model_battery(t, V0, tau, V_final=100):
+    """
+    Exponential charging model for battery percentage.
+    Saturates at V_final (default 100%).
+    """
+    return V_final - (V_final - V0) * np.exp(-t / tau)
+
+
+def threshold_crossing_time(T0, tau, delta_T=10, threshold=45):
+    """
+    Minutes into a discharge until the temperature reaches 'threshold', solved from the rise model.
+    0 if it starts at or above the threshold, inf if it never gets there.
+    """
+    T0 = np.asarray(T0, dtype=float)
+    # fraction of the full rise delta_T needed to reach the threshold
+    fraction = (threshold - T0) / delta_T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        crossing = -tau * np.log1p(-fraction)
+    return np.where(fraction <= 0, 0.0, np.where(fraction >= 1, np.inf, crossing))
+
+
+def discharging_model_temp(t, T0, tau, delta_T=10, threshold=45):
+    """
+    Temperature rise model during discharge.
+    - Increases exponentially by delta_T.
+    - Hard capped at 'threshold' (simulates thermal throttling).
+    """
+    temp = T0 + delta_T * (1 - np.exp(-t / tau))
+    # once reached, temperature is fixed at the cap
+    return np.where(t >= threshold_crossing_time(T0, tau, delta_T, threshold), threshold, np.minimum(temp, threshold))
+
+
+def charging_model_temp(t, T0, tau, T_final):
+    """
+    Temperature relaxation during charging.
+    Decays exponentially toward T_final (baseline temperature).
+    """
+    return T_final + (T0 - T_final) * np.exp(-t / tau)
+
+# ---------------- Workday Simulation ---------------- #
+
+
+def workday_phases(discharge_time, charge_time, break_start=BREAK_START):
+    """
+    Splits the workday into phases, as (kind, start minute, length) arrays.
+    - Work cycles → discharge_time minutes discharging then charge_time minutes charging.
+    - The first cycle ending at or after break_start → 1-hour charge from that minute.
+    """
+    kinds, starts, lengths = [], [], []
+    t = 0
+    on_break = False
+    while t < WORKDAY_END:
+        if not on_break and t >= break_start:
+            on_break = True
+            cycle = [(CHARGE, BREAK_LENGTH)]
+        else:
+            cycle = [(DISCHARGE, discharge_time), (CHARGE, charge_time)]
+        for kind, length in cycle:
+            kinds.append(kind)
+            starts.append(t)
+            lengths.append(length)
+            t += length
+    return np.array(kinds), np.array(starts), np.array(lengths)
+
+
+def simulate_workday_with_break(discharge_time, charge_time, initial_battery_percentage, initial_temperature,
+                                tau_discharging, tau_charging, tau_temp_discharge, tau_temp_charge, temp_threshold,
+                                break_start=BREAK_START):
+    """
+    Simulates a full workday at 1-minute resolution:
+    - Work session → battery discharges, temperature rises.
+    - Charging session → battery charges, temperature relaxes.
+    - Midday 1-hour break → battery charges continuously.
+
+    Each phase starts from the state at the last minute of the one before, only that handful of phase
+    boundaries is computed one by one; every minute of the day is then evaluated in one vectorized pass.
+
+    The starting state and time constants may also be arrays of the same shape, one entry per simulated
+    probe-day, which are all simulated at once (see monte_carlo).
+
+    Returns
+    -------
+    minutes : ndarray
+        Minute offsets from the start of the workday (WORKDAY_START).
+    battery_percentage, temperature : ndarray
+        Battery percentage and temperature (°C) at each minute, with the minutes as the last axis.
+    """
+    kinds, starts, lengths = workday_phases(discharge_time, charge_time, break_start)
+    discharging = kinds == DISCHARGE
+
+    # state at the start of each phase, carried over from the last minute of the previous one
+    shape = np.broadcast(initial_battery_percentage, initial_temperature, tau_discharging, tau_charging,
+                         tau_temp_discharge, tau_temp_charge).shape
+    battery0 = np.empty((len(kinds),) + shape)
+    temp0 = np.empty((len(kinds),) + shape)
+    battery, temp = initial_battery_percentage, initial_temperature
+    for i, (kind, length) in enumerate(zip(kinds, lengths)):
+        battery0[i], temp0[i] = battery, temp
+        t = length - 1
+        if kind == DISCHARGE:
+            battery = discharging_model_battery(t, battery, tau_discharging)
+            temp = discharging_model_temp(t, temp, tau_temp_discharge, threshold=temp_threshold)
+        else:
+            battery = np.minimum(charging_model_battery(t, battery, tau_charging), 100)
+            temp = charging_model_temp(t, temp, tau_temp_charge, T_final=initial_temperature)
+
+    # every minute of the day at once, as (minutes, probe-days) before moving the minutes last
+    minutes = np.arange(lengths.sum())
+    column = (slice(None),) + (None,) * len(shape)
+    t = (minutes - np.repeat(starts, lengths))[column]
+    discharge = np.repeat(discharging, lengths)[column]
+    b0 = np.repeat(battery0, lengths, axis=0)
+    T0 = np.repeat(temp0, lengths, axis=0)
+    battery_percentage = np.where(discharge, discharging_model_battery(t, b0, tau_discharging),
+                                  np.minimum(charging_model_battery(t, b0, tau_charging), 100))
+    temperature = np.where(discharge, discharging_model_temp(t, T0, tau_temp_discharge, threshold=temp_threshold),
+                           charging_model_temp(t, T0, tau_temp_charge, T_final=initial_temperature))
+    return minutes, np.moveaxis(battery_percentage, 0, -1), np.moveaxis(temperature, 0, -1)
+
+
+def simulate(params):
+    """
+    Runs simulate_workday_with_break with the parameters of plot_battery_temperature_comparison.
+    """
+    return simulate_workday_with_break(
+        params["discharge_time"], params["charge_time"], params["initial_battery_percentage"],
+        params["initial_temperature"], params["mean_tau_discharging"], params["mean_tau_charging"],
+        params["mean_tau_temp_discharge"], params["mean_tau_temp_charge"], params["temp_threshold"],
+        params.get("break_start", BREAK_START)
+    )
+
+# ---------------- Monte Carlo Fleet Simulation ---------------- #
+
+# parameters sampled per probe-day; the probe starts the day at ambient temperature and cools back to it
+SAMPLED = ["initial_battery_percentage", "initial_temperature", "mean_tau_discharging", "mean_tau_charging",
+           "mean_tau_temp_discharge", "mean_tau_temp_charge"]
+
+# valid range of each sampled parameter, samples outside it are clipped
+LIMITS = {"initial_battery_percentage": (0, 100), "initial_temperature": (-50, None)}
+
+
+def default_distributions(params, tau_cv=0.1, battery_sd=5.0, temperature_sd=2.0):
+    """
+    Normal distributions around the values in params: tau_* with a coefficient of variation of tau_cv,
+    starting battery with a standard deviation of battery_sd (%) and ambient temperature of temperature_sd (°C).
+    """
+    distributions = {name: ("normal", params[name], tau_cv * params[name]) for name in SAMPLED
+                     if name.startswith("mean_tau")}
+    distributions["initial_battery_percentage"] = ("normal", params["initial_battery_percentage"], battery_sd)
+    distributions["initial_temperature"] = ("normal", params["initial_temperature"], temperature_sd)
+    return distributions
+
+
+def sample_parameters(params, n, distributions=None, rng=None):
+    """
+    Draws n probe-days of the SAMPLED parameters.
+
+    Parameters
+    ----------
+    distributions : dict, optional
+        Maps a parameter to ("normal", mean, sd), ("lognormal", mean, sigma) of its logarithm,
+        ("uniform", low, high) or ("triangular", low, mode, high); parameters that aren't listed
+        keep their value from params. Defaults to default_distributions(params).
+    """
+    rng = rng or np.random.default_rng()
+    distributions = default_distributions(params) if distributions is None else distributions
+    samples = {}
+    for name in SAMPLED:
+        if name not in distributions:
+            samples[name] = np.full(n, float(params[name]))
+            continue
+        kind, *args = distributions[name]
+        if kind == "normal":
+            values = rng.normal(args[0], args[1], n)
+        elif kind == "lognormal":
+            values = rng.lognormal(np.log(args[0]), args[1], n)
+        elif kind == "uniform":
+            values = rng.uniform(args[0], args[1], n)
+        elif kind == "triangular":
+            values = rng.triangular(args[0], args[1], args[2], n)
+        else:
+            raise ValueError(f"unknown distribution '{kind}' for {name}")
+        low, high = LIMITS.get(name, (1e-6, None))  # time constants stay positive
+        samples[name] = np.clip(values, low, high)
+    return samples
+
+
+def _process_pool(workers):
+    """
+    Pool of worker processes forked from this one, or None if workers is not set or processes can't be forked
+    (e.g. on Windows), in which case the work runs in this process. This file's name isn't importable, so
+    spawned or forkserver workers couldn't unpickle the functions they are sent; forked ones already have them.
+    """
+    if not workers or "fork" not in multiprocessing.get_all_start_methods():
+        return None
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+
+
+def _simulate_shard(params, distributions, n, seed):
+    """
+    Simulates n sampled probe-days, returning float32 trajectories to keep the fleet's memory down.
+    """
+    samples = sample_parameters(params, n, distributions, np.random.default_rng(seed))
+    _, battery, temperature = simulate(dict(params, **samples))
+    return battery.astype(np.float32), temperature.astype(np.float32)
+
+
+def monte_carlo(params, n=20000, distributions=None, percentiles=(5, 25, 50, 75, 95), exhausted_below=10.0,
+                shard_size=5000, workers=None, seed=None):
+    """
+    Simulates n probe-days with parameters drawn from distributions, all at once in shards of shard_size.
+
+    Parameters
+    ----------
+    exhausted_below : float
+        Battery percentage under which a probe counts as exhausted.
+    workers : int, optional
+        Processes the shards are spread over where processes can be forked; by default they run in this process.
+    seed : int, optional
+        Seed for reproducible fleets, each shard gets an independent stream from it.
+
+    Returns
+    -------
+    dict
+        - minutes: minute offsets from WORKDAY_START.
+        - percentiles, battery_bands, temperature_bands: per-minute percentiles of the fleet, (percentiles, minutes).
+        - p_temp_threshold: probability a probe-day reaches temp_threshold.
+        - p_exhausted: probability a probe-day drops below exhausted_below before the end of the workday.
+    """
+    sizes = [min(shard_size, n - start) for start in range(0, n, shard_size)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = [(params, distributions, size, shard_seed) for size, shard_seed in zip(sizes, seeds)]
+    pool = _process_pool(workers)
+    if pool is not None:
+        with pool:
+            shards = list(pool.map(_simulate_shard, *zip(*args)))
+    else:
+        shards = [_simulate_shard(*a) for a in args]
+    battery = np.concatenate([b for b, _ in shards])
+    temperature = np.concatenate([t for _, t in shards])
+
+    minutes = np.arange(battery.shape[1])
+    workday = minutes < WORKDAY_END
+    return {
+        "minutes": minutes,
+        "percentiles": np.asarray(percentiles),
+        "battery_bands": np.percentile(battery, percentiles, axis=0),
+        "temperature_bands": np.percentile(temperature, percentiles, axis=0),
+        # the thermal cap holds temperatures at exactly temp_threshold once it is reached
+        "p_temp_threshold": float((temperature.max(axis=1) >= params["temp_threshold"] - 1e-4).mean()),
+        "p_exhausted": float((battery[:, workday].min(axis=1) < exhausted_below).mean()),
+    }
+
+# ---------------- Schedule Optimization ---------------- #
+
+# parameters that make up a schedule, the rest describe the probe
+SCHEDULE = ["discharge_time", "charge_time", "break_start"]
+
+# (scan minutes, max temperature, min battery) of every schedule evaluated so far, by probe and schedule
+_schedule_cache = {}
+
+
+def _probe_key(params):
+    return tuple(sorted((name, float(value)) for name, value in params.items() if name not in SCHEDULE))
+
+
+def evaluate_schedule(params, discharge_time, charge_time, break_start=BREAK_START):
+    """
+    Scanning minutes, peak temperature and lowest battery percentage of a schedule over the workday.
+    """
+    schedule = dict(params, discharge_time=discharge_time, charge_time=charge_time, break_start=break_start)
+    minutes, battery, temperature = simulate(schedule)
+    kinds, starts, lengths = workday_phases(discharge_time, charge_time, break_start)
+    workday = minutes < WORKDAY_END
+    scanning = np.repeat(kinds == DISCHARGE, lengths) & workday
+    return int(scanning.sum()), float(temperature[workday].max()), float(battery[workday].min())
+
+
+def _evaluate_schedules(params, schedules):
+    return [evaluate_schedule(params, *schedule) for schedule in schedules]
+
+
+def optimize_schedule(params, discharge_times=range(5, 125, 5), charge_times=range(5, 65, 5),
+                      break_starts=range(180, 315, 15), battery_floor=20.0, workers=None, chunk_size=64):
+    """
+    Searches every combination of discharge time, charge time and break start for the schedules scanning
+    the most minutes per workday while staying below temp_threshold and above battery_floor.
+
+    Evaluated schedules are remembered per probe (the parameters in params other than the schedule),
+    so repeated searches only simulate the schedules they haven't seen.
+
+    Parameters
+    ----------
+    params : dict
+        Probe parameters as for plot_battery_temperature_comparison, the schedule in it is ignored.
+    battery_floor : float
+        Battery percentage the probe must stay above all day.
+    workers : int, optional
+        Processes new schedules are evaluated in where processes can be forked; by default they run in this
+        process.
+
+    Returns
+    -------
+    list of dict
+        The feasible schedules with their scan_minutes, max_temperature and min_battery, best first:
+        most scanning, then the most battery left, then the coolest. Empty if none is feasible.
+    """
+    probe = _probe_key(params)
+    schedules = list(itertools.product(discharge_times, charge_times, break_starts))
+    missing = [schedule for schedule in schedules if (probe, schedule) not in _schedule_cache]
+    chunks = [missing[i:i + chunk_size] for i in range(0, len(missing), chunk_size)]
+    pool = _process_pool(workers) if len(chunks) > 1 else None
+    if pool is not None:
+        with pool:
+            evaluated = list(pool.map(_evaluate_schedules, itertools.repeat(params), chunks))
+    else:
+        evaluated = [_evaluate_schedules(params, chunk) for chunk in chunks]
+    for chunk, results in zip(chunks, evaluated):
+        for schedule, result in zip(chunk, results):
+            _schedule_cache[(probe, schedule)] = result
+
+    feasible = []
+    for schedule in schedules:
+        scan_minutes, max_temperature, min_battery = _schedule_cache[(probe, schedule)]
+        # the thermal cap holds temperatures at exactly temp_threshold once it is reached
+        if max_temperature < params["temp_threshold"] - 1e-4 and min_battery > battery_floor:
+            feasible.append(dict(zip(SCHEDULE, schedule), scan_minutes=scan_minutes,
+                                 max_temperature=max_temperature, min_battery=min_battery))
+    feasible.sort(key=lambda s: (-s["scan_minutes"], -s["min_battery"], s["max_temperature"]))
+    return feasible
+
+# ---------------- Clinic Simulation ---------------- #
+
+DAY = 24 * 60
+
+# the clinic's default breaks, as (start, end) minute offsets from opening
+BREAKS = ((BREAK_START, BREAK_START + BREAK_LENGTH),)
+
+# clinic events, processed in time order
+ARRIVAL, SCAN_END, CHARGE_END, OPEN, CLOSE, BREAK_BEGIN, BREAK_OVER = range(7)
+
+
+def patient_arrivals(days, per_hour, open_minutes=WORKDAY_END, breaks=BREAKS, rng=None):
+    """
+    Poisson patient arrivals at per_hour while the clinic is open, none during breaks.
+    Returns the sorted arrival times as minute offsets from the first opening.
+    """
+    rng = rng or np.random.default_rng()
+    n = rng.poisson(per_hour * open_minutes / 60 * days)
+    arrivals = rng.uniform(0, open_minutes, n)
+    for start, end in breaks:
+        arrivals = arrivals[(arrivals < start) | (arrivals >= end)]
+    return np.sort(arrivals + rng.integers(0, days, len(arrivals)) * DAY)
+
+
+def simulate_clinic(params, arrivals, scan_minutes=20, probes=2, docks=1, breaks=BREAKS, open_minutes=WORKDAY_END,
+                    days=None, charge_below=30.0, charge_to=90.0, cool_above=None, cool_to=None):
+    """
+    Event-driven simulation of a clinic scanning patients with a pool of probes sharing charging docks.
+
+    Patients queue first come first served and are scanned by the idle probe with the most battery while the
+    clinic is open; breaks stop new scans. A probe goes to a dock after a scan that leaves it at or below
+    charge_below or at or above cool_above, at the start of each break and at closing, queueing when every
+    dock is taken, and charges until it is back at charge_to and cooled to cool_to. Probe state only
+    changes at events, from the battery and temperature models over the time since the probe's last event.
+    Patients still waiting at closing aren't seen.
+
+    Only events are simulated, never minutes, so a month of a busy clinic takes a fraction of a second.
+
+    Parameters
+    ----------
+    params : dict
+        Probe parameters as for plot_battery_temperature_comparison, the schedule in it is ignored;
+        initial_temperature is the ambient temperature probes cool to.
+    arrivals : array_like
+        Patient arrival times as minute offsets from the first opening, e.g. from patient_arrivals.
+    scan_minutes : float or array_like
+        Length of every scan, or of each patient's.
+    breaks : sequence of (start, end)
+        Daily breaks as minute offsets from opening.
+    days : int, optional
+        Days simulated, by default up to the last arrival. Each day opens DAY minutes after the one before.
+    cool_above, cool_to : float, optional
+        Default to 1 °C and 5 °C below temp_threshold.
+
+    Returns
+    -------
+    dict
+        Queueing report: patients seen and not seen, wait times (min), each probe's utilization (fraction
+        of open time scanning) and charging time, dock utilization, and contention for the docks: requests,
+        fraction that had to wait, wait times (min) and the longest dock queue.
+    """
+    if not charge_below < charge_to < 100:
+        raise ValueError("charge_to must be between charge_below and 100, a full charge is never reached")
+    arrivals = np.asarray(arrivals, dtype=float)
+    durations = np.broadcast_to(np.asarray(scan_minutes, dtype=float), arrivals.shape)
+    days = days or (int(arrivals.max() // DAY) + 1 if len(arrivals) else 1)
+    threshold = params["temp_threshold"]
+    ambient = params["initial_temperature"]
+    cool_above = threshold - 1 if cool_above is None else cool_above
+    cool_to = threshold - 5 if cool_to is None else cool_to
+    end = days * DAY
+
+    events = []
+    counter = itertools.count()
+
+    def schedule(time, kind, target=None):
+        heapq.heappush(events, (time, next(counter), kind, target))
+
+    for i, arrival in enumerate(arrivals):
+        schedule(arrival, ARRIVAL, i)
+    for day in range(days):
+        schedule(day * DAY, OPEN)
+        schedule(day * DAY + open_minutes, CLOSE)
+        for start, stop in breaks:
+            schedule(day * DAY + start, BREAK_BEGIN)
+            schedule(day * DAY + stop, BREAK_OVER)
+
+    battery = [float(params["initial_battery_percentage"])] * probes
+    temperature = [float(ambient)] * probes
+    since = [0.0] * probes
+    mode = ["idle"] * probes
+    scanning = np.zeros(probes)
+    charging = np.zeros(probes)
+
+    waiting = deque()
+    dock_queue = deque()
+    free_docks = docks
+    waits = []
+    dock_waits = []
+    peak_dock_queue = 0
+    is_open = False
+
+    def advance(p, now):
+        # battery and temperature of probe p from its last event to now
+        t = now - since[p]
+        if t > 0:
+            if mode[p] == "scanning":
+                battery[p] = float(discharging_model_battery(t, battery[p], params["mean_tau_discharging"]))
+                temperature[p] = float(discharging_model_temp(t, temperature[p], params["mean_tau_temp_discharge"],
+                                                              threshold=threshold))
+            elif mode[p] == "charging":
+                battery[p] = min(float(charging_model_battery(t, battery[p], params["mean_tau_charging"])), 100.0)
+                temperature[p] = float(charging_model_temp(t, temperature[p], params["mean_tau_temp_charge"],
+                                                           T_final=ambient))
+            else:
+                # probes off the charger cool the same way
+                temperature[p] = float(charging_model_temp(t, temperature[p], params["mean_tau_temp_charge"],
+                                                           T_final=ambient))
+        since[p] = now
+
+    def request_dock(p, now):
+        nonlocal peak_dock_queue
+        mode[p] = "queued"
+        dock_queue.append((p, now))
+        peak_dock_queue = max(peak_dock_queue, len(dock_queue))
+
+    def charge_time(p):
+        # minutes of charging until probe p is back at charge_to and cooled to cool_to, solved from the models
+        minutes = 0.0
+        if battery[p] < charge_to:
+            minutes = -params["mean_tau_charging"] * math.log((100 - charge_to) / (100 - battery[p]))
+        if temperature[p] > cool_to > ambient:
+            minutes = max(minutes, -params["mean_tau_temp_charge"] *
+                          math.log((cool_to - ambient) / (temperature[p] - ambient)))
+        return minutes
+
+    def dispatch(now):
+        nonlocal free_docks
+        while free_docks and dock_queue:
+            p, requested = dock_queue.popleft()
+            advance(p, now)
+            free_docks -= 1
+            dock_waits.append(now - requested)
+            mode[p] = "charging"
+            schedule(now + charge_time(p), CHARGE_END, p)
+        while is_open and waiting:
+            idle = [p for p in range(probes) if mode[p] == "idle"]
+            if not idle:
+                break
+            p = max(idle, key=lambda q: battery[q])
+            patient = waiting.popleft()
+            advance(p, now)
+            waits.append(now - arrivals[patient])
+            mode[p] = "scanning"
+            schedule(now + durations[patient], SCAN_END, p)
+
+    while events and events[0][0] < end:
+        now, _, kind, target = heapq.heappop(events)
+        if kind == ARRIVAL:
+            waiting.append(target)
+        elif kind == SCAN_END:
+            scanning[target] += now - since[target]
+            advance(target, now)
+            mode[target] = "idle"
+            low = battery[target] <= charge_below or temperature[target] >= cool_above
+            # scans running into a break or closing go to the dock after, like the idle probes did
+            if low or (not is_open and (battery[target] < charge_to or temperature[target] > cool_to)):
+                request_dock(target, now)
+        elif kind == CHARGE_END:
+            charging[target] += now - since[target]
+            advance(target, now)
+            mode[target] = "idle"
+            free_docks += 1
+        elif kind in (OPEN, BREAK_OVER):
+            is_open = True
+        elif kind in (CLOSE, BREAK_BEGIN):
+            is_open = False
+            if kind == CLOSE:
+                waiting.clear()
+            for p in range(probes):
+                if mode[p] == "idle" and (battery[p] < charge_to or temperature[p] > cool_to):
+                    advance(p, now)
+                    request_dock(p, now)
+        dispatch(now)
+
+    open_time = days * (open_minutes - sum(stop - start for start, stop in breaks))
+    waits = np.asarray(waits)
+    dock_waits = np.asarray(dock_waits)
+    return {
+        "patients": len(arrivals),
+        "served": len(waits),
+        "unserved": len(arrivals) - len(waits),
+        "wait_mean": float(waits.mean()) if len(waits) else 0.0,
+        "wait_p50": float(np.percentile(waits, 50)) if len(waits) else 0.0,
+        "wait_p90": float(np.percentile(waits, 90)) if len(waits) else 0.0,
+        "wait_max": float(waits.max()) if len(waits) else 0.0,
+        "probe_utilization": scanning / max(open_time, 1),
+        "probe_charging_minutes": charging,
+        "dock_utilization": float(charging.sum() / (docks * end)),
+        "dock_requests": len(dock_waits),
+        "dock_waited": float((dock_waits > 0).mean()) if len(dock_waits) else 0.0,
+        "dock_wait_mean": float(dock_waits.mean()) if len(dock_waits) else 0.0,
+        "dock_wait_max": float(dock_waits.max()) if len(dock_waits) else 0.0,
+        "peak_dock_queue": peak_dock_queue,
+    }
+
+# ---------------- Plotting ---------------- #
+
+
 def plot_battery_temperature_comparison(params):
     """
-    Simulates and plots battery discharge/charge cycles and corresponding 
+    Simulates and plots battery discharge/charge cycles and corresponding
     temperature changes during a workday with a lunch break.
-    
+
     Parameters
     ----------
     params : dict
@@ -16,150 +589,20 @@ def plot_battery_temperature_comparison(params):
         - discharge_time (int): discharge period per cycle (minutes).
         - charge_time (int): charge period per cycle (minutes).
         - temp_threshold (float): max allowable temperature (°C).
+        - break_start (int, optional): earliest minute of the workday the 1-hour break starts at.
     """
-
-    # ---------------- Battery + Temperature Models ---------------- #
-
-    def discharging_model_battery(t, V0, tau, V_final=6):
-        """
-        Exponential discharge model for battery percentage.
-        Approaches V_final asymptotically.
-        """
-        return V_final + (V0 - V_final) * np.exp(-t / tau)
-
-    def charging_model_battery(t, V0, tau, V_final=100):
-        """
-        Exponential charging model for battery percentage.
-        Saturates at V_final (default 100%).
-        """
-        return V_final - (V_final - V0) * np.exp(-t / tau)
-
-    def discharging_model_temp(t, T0, tau, delta_T=10, threshold=45):
-        """
-        Temperature rise model during discharge.
-        - Increases exponentially by delta_T.
-        - Hard capped at 'threshold' (simulates thermal throttling).
-        """
-        temp = T0 + delta_T * (1 - np.exp(-t / tau))
-        temp_capped = np.minimum(temp, threshold)
-
-        # Apply threshold: once reached, temperature is fixed at cap.
-        for i in range(1, len(temp_capped)):
-            if temp_capped[i] == threshold:
-                temp_capped[i:] = threshold
-                break
-        return temp_capped
-
-    def charging_model_temp(t, T0, tau, T_final):
-        """
-        Temperature relaxation during charging.
-        Decays exponentially toward T_final (baseline temperature).
-        """
-        return T_final + (T0 - T_final) * np.exp(-t / tau)
-
-    # ---------------- Workday Simulation ---------------- #
-
-    def simulate_workday_with_break(discharge_time, charge_time, initial_battery_percentage, initial_temperature,
-                                    tau_discharging, tau_charging, tau_temp_discharge, tau_temp_charge, temp_threshold):
-        """
-        Simulates a full workday:
-        - Work session → battery discharges, temperature rises.
-        - Charging session → battery charges, temperature relaxes.
-        - Midday 1-hour break → battery charges continuously.
-        """
-        # Define time anchors
-        workday_start_time = datetime(2024, 10, 12, 8, 0)
-        break_start_time   = datetime(2024, 10, 12, 12, 0)
-        break_end_time     = datetime(2024, 10, 12, 13, 0)
-        workday_end_time   = datetime(2024, 10, 12, 16, 0)
-
-        battery_percentage, temperature, time = [], [], []
-        current_time = workday_start_time
-
-        # Initialize state
-        battery = initial_battery_percentage
-        temp = initial_temperature
-
-        # Loop through timeline until end of day
-        while current_time < workday_end_time:
-            # Case 1: Lunch break (continuous charging)
-            if break_start_time <= current_time < break_end_time:
-                break_time_points = np.arange(0, 60, 1)  # 60 min resolution
-                charge_during_break = np.minimum(
-                    charging_model_battery(break_time_points, battery, tau_charging), 100
-                )
-                temp_during_break = charging_model_temp(
-                    break_time_points, temp, tau_temp_charge, T_final=params["initial_temperature"]
-                )
-
-                # Update histories
-                battery_percentage.extend(charge_during_break)
-                temperature.extend(temp_during_break)
-                time.extend([current_time + timedelta(minutes=i) for i in range(len(break_time_points))])
-
-                # Update state
-                battery, temp = charge_during_break[-1], temp_during_break[-1]
-                current_time += timedelta(minutes=len(break_time_points))
-
-            # Case 2: Regular work cycle (discharge + recharge)
-            else:
-                # Discharge phase
-                discharge_time_points = np.arange(0, discharge_time, 1)
-                discharge_temp = discharging_model_temp(
-                    discharge_time_points, temp, tau_temp_discharge, threshold=temp_threshold
-                )
-                discharge_battery = discharging_model_battery(discharge_time_points, battery, tau_discharging)
-
-                battery_percentage.extend(discharge_battery)
-                temperature.extend(discharge_temp)
-                time.extend([current_time + timedelta(minutes=i) for i in range(len(discharge_time_points))])
-                battery, temp = discharge_battery[-1], discharge_temp[-1]
-                current_time += timedelta(minutes=len(discharge_time_points))
-
-                # Charge phase
-                charge_time_points = np.arange(0, charge_time, 1)
-                charge_temp = charging_model_temp(
-                    charge_time_points, temp, tau_temp_charge, T_final=params["initial_temperature"]
-                )
-                charge_battery = np.minimum(
-                    charging_model_battery(charge_time_points, battery, tau_charging), 100
-                )
-
-                battery_percentage.extend(charge_battery)
-                temperature.extend(charge_temp)
-                time.extend([current_time + timedelta(minutes=i) for i in range(len(charge_time_points))])
-                battery, temp = charge_battery[-1], charge_temp[-1]
-                current_time += timedelta(minutes=len(charge_time_points))
-
-        return time, battery_percentage, temperature
-
-    # ---------------- Extract Parameters ---------------- #
-
-    initial_battery_percentage = params["initial_battery_percentage"]
-    initial_temperature        = params["initial_temperature"]
-    mean_tau_discharging       = params["mean_tau_discharging"]
-    mean_tau_charging          = params["mean_tau_charging"]
-    mean_tau_temp_discharge    = params["mean_tau_temp_discharge"]
-    mean_tau_temp_charge       = params["mean_tau_temp_charge"]
-    discharge_time             = params["discharge_time"]
-    charge_time                = params["charge_time"]
-    temp_threshold             = params["temp_threshold"]
-
-    # ---------------- Run Simulation ---------------- #
-
-    time, battery, temperature = simulate_workday_with_break(
-        discharge_time, charge_time, initial_battery_percentage,
-        initial_temperature, mean_tau_discharging, mean_tau_charging,
-        mean_tau_temp_discharge, mean_tau_temp_charge, temp_threshold
-    )
-
-    # ---------------- Plot Results ---------------- #
+    minutes, battery, temperature = simulate(params)
+    temp_threshold = params["temp_threshold"]
+    time = np.datetime64(WORKDAY_START) + minutes.astype('timedelta64[m]')
 
     fig, ax1 = plt.subplots(figsize=(12, 6))
 
     # Battery % on primary y-axis
     ax1.plot(time, battery, label="Battery Percentage (%)", color="teal")
-    ax1.axvline(x=datetime(2024, 10, 12, 12, 0), color='blue', linestyle='--', label="1-Hour Break (12 PM)")
+    break_start = params.get("break_start", BREAK_START)
+    break_time = np.datetime64(WORKDAY_START) + np.timedelta64(break_start, 'm')
+    ax1.axvline(x=break_time, color='blue', linestyle='--',
+                label="1-Hour Break ({0})".format(break_time.astype(datetime).strftime('%I:%M %p')))
     ax1.set_xlabel("Time (hours)")
     ax1.set_ylabel("Battery Percentage (%)", color="teal")
     ax1.tick_params(axis='y', labelcolor="teal")
@@ -184,4 +627,40 @@ def plot_battery_temperature_comparison(params):
     plt.grid()
     plt.show()
 
-    plot_battery_temperature_comparison(simulation_params)
+
+def plot_fleet_bands(result, params):
+    """
+    Plots the percentile bands of a monte_carlo fleet, shading between symmetric pairs of percentiles
+    around the median.
+    """
+    time = np.datetime64(WORKDAY_START) + result["minutes"].astype('timedelta64[m]')
+    percentiles = result["percentiles"]
+    median = int(np.argmin(np.abs(percentiles - 50)))
+
+    fig, ax1 = plt.subplots(figsize=(12, 6))
+    ax2 = ax1.twinx()
+    for ax, bands, color, label in [(ax1, result["battery_bands"], "teal", "Battery Percentage (%)"),
+                                    (ax2, result["temperature_bands"], "orange", "Temperature (°C)")]:
+        for low in range(median):
+            high = len(percentiles) - 1 - low
+            ax.fill_between(time, bands[low], bands[high], color=color, alpha=0.15,
+                            label=f"{label} P{percentiles[low]:g}–P{percentiles[high]:g}")
+        ax.plot(time, bands[median], color=color, label=f"{label} median")
+        ax.set_ylabel(label, color=color)
+        ax.tick_params(axis='y', labelcolor=color)
+    ax2.axhline(y=params["temp_threshold"], color='red', linestyle='--',
+                label=f"Temperature Threshold ({params['temp_threshold']}°C)")
+    ax1.set_xlabel("Time (hours)")
+    ax1.set_title("P(threshold reached) = {0:.1%}, P(battery exhausted) = {1:.1%}".format(
+        result["p_temp_threshold"], result["p_exhausted"]))
+
+    # Time axis formatting
+    ax1.xaxis.set_major_formatter(mdates.DateFormatter('%I:%M %p'))
+    ax1.xaxis.set_major_locator(mdates.HourLocator())
+
+    # Layout + legends
+    fig.tight_layout()
+    ax1.legend(loc="upper left", bbox_to_anchor=(0, 1.25))
+    ax2.legend(loc="upper right", bbox_to_anchor=(1, 1.25))
+    plt.grid()
+    plt.show()
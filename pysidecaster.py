@@ -1,23 +1,49 @@
 #!/usr/bin/env python
 
+import argparse
 import ctypes
+import io
 import os.path
 import sys
-import torch
+import threading
+import time
+# startup milestones are timed from here, see telemetry.Telemetry.mark
+launched = time.perf_counter()
 import numpy as np
 import copy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from pathlib import Path
 from PIL import Image
 from typing import Final
 
-if sys.platform.startswith("linux"):
-    libcast_handle = ctypes.CDLL("./libcast.so", ctypes.RTLD_GLOBAL)._handle  # load the libcast.so shared library
-    pyclariuscast = ctypes.cdll.LoadLibrary("./pyclariuscast.so")  # load the pyclariuscast.so shared library
+libcast_handle = None
+try:
+    if sys.platform.startswith("linux"):
+        libcast_handle = ctypes.CDLL("./libcast.so", ctypes.RTLD_GLOBAL)._handle  # load the libcast.so shared library
+        pyclariuscast = ctypes.cdll.LoadLibrary("./pyclariuscast.so")  # load the pyclariuscast.so shared library
+
+    import pyclariuscast
+except (OSError, ImportError):
+    # without the Cast API only recorded frames can be streamed, see --replay
+    pyclariuscast = None
 
-import pyclariuscast
 from PySide6 import QtCore, QtGui, QtWidgets
 from PySide6.QtCore import Qt, Signal, Slot
-import ai_testing # imports the file which loads in the AI models 
+import telemetry
+from frame_ring import FrameRing, SharedFrameRing
+from tracking import BoxTracker
+from latency import LatencyController
+from replaycast import ReplayCaster
+from recorder import Recorder
+from inference_client import InferenceClient, ServerError, default_address
+import model_registry
+
+# the file which loads in the AI models, it imports torch and torchvision, which take seconds, so the
+# inference worker imports it in the background once the window is up, and only when it runs the models
+# itself rather than in an inference server, see InferenceWorker.load
+ai_testing = None
 
 CMD_FREEZE: Final = 1
 CMD_CAPTURE_IMAGE: Final = 2
@@ -47,19 +73,28 @@ class ButtonEvent(QtCore.QEvent):
 
 # custom event for handling new images
 class ImageEvent(QtCore.QEvent):
-    def __init__(self):
+    def __init__(self, frame):
         super().__init__(QtCore.QEvent.Type(QtCore.QEvent.User + 2))
+        self.frame = frame
+        self.posted = time.perf_counter()
+
+
+# custom event for handling new raw images
+class RawImageEvent(QtCore.QEvent):
+    def __init__(self, frame):
+        super().__init__(QtCore.QEvent.Type(QtCore.QEvent.User + 3))
+        self.frame = frame
 
 
 # manages custom events posted from callbacks, then relays as signals to the main widget
 class Signaller(QtCore.QObject):
     freeze = QtCore.Signal(bool)
     button = QtCore.Signal(int, int)
-    image = QtCore.Signal(QtGui.QImage)
+    image = QtCore.Signal(object)
+    raw = QtCore.Signal(object)
 
     def __init__(self):
         QtCore.QObject.__init__(self)
-        self.usimage = QtGui.QImage()
 
     def event(self, evt):
         if evt.type() == QtCore.QEvent.User:
@@ -67,12 +102,317 @@ class Signaller(QtCore.QObject):
         elif evt.type() == QtCore.QEvent.Type(QtCore.QEvent.User + 1):
             self.button.emit(evt.btn, evt.clicks)
         elif evt.type() == QtCore.QEvent.Type(QtCore.QEvent.User + 2):
-            self.image.emit(self.usimage)
+            telemetry.pipeline.record("delivery", time.perf_counter() - evt.posted)
+            self.image.emit(evt.frame)
+        elif evt.type() == QtCore.QEvent.Type(QtCore.QEvent.User + 3):
+            self.raw.emit(evt.frame)
         return True
 
 
-# global required for the cast api callbacks
+# maps boxes found on raw (pre scan-conversion) frames onto the displayed image
+# raw frames are held depth down, (samples, lines), so a box's x is in lines and its y in samples; the
+# display is assumed to be the scan conversion of a linear array, centred horizontally with the skin line
+# at the top, which is how its microns per pixel relate it to the raw frame's axial and lateral spacing
+class RawGeometry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.lines = None
+        self.axial = None
+        self.lateral = None
+        self.width = None
+        self.micronsPerPixel = None
+
+    def updateRaw(self, lines, axial, lateral):
+        with self.lock:
+            self.lines, self.axial, self.lateral = lines, axial, lateral
+
+    def updateDisplay(self, width, micronsPerPixel):
+        with self.lock:
+            self.width, self.micronsPerPixel = width, micronsPerPixel
+
+    # the objects with their boxes moved into display pixels, or None until both streams have been seen
+    def map(self, objects):
+        with self.lock:
+            if self.lines is None or self.width is None:
+                return None
+            scale_x = self.lateral / self.micronsPerPixel
+            scale_y = self.axial / self.micronsPerPixel
+            offset_x = self.width / 2 - self.lines / 2 * scale_x
+        scale = np.array([scale_x, scale_y, scale_x, scale_y], dtype=np.float32)
+        offset = np.array([offset_x, 0.0, offset_x, 0.0], dtype=np.float32)
+        return dict(objects, boxes=objects['boxes'] * scale + offset)
+
+
+# globals required for the cast api callbacks
 signaller = Signaller()
+frames = FrameRing()
+# raw frames and how they map onto the display, for the Raw mode
+raw_frames = FrameRing()
+raw_geometry = RawGeometry()
+
+
+# converts a QImage into a (height, width, 4) numpy array
+def QImageToCVMat(image):
+    incoming_image = image.convertToFormat(QtGui.QImage.Format.Format_RGB32)
+    width = incoming_image.width()
+    height = incoming_image.height()
+    ptr = incoming_image.bits()
+    arr = np.frombuffer(ptr, dtype=np.uint8).reshape(height, width, 4)
+    return arr
+
+
+# copies a frame out of the ring into a new QImage owned by the GUI, returned with a numpy view of its pixels
+def frameToQImage(data):
+    height, width = data.shape[:2]
+    fmt = QtGui.QImage.Format_ARGB32 if data.ndim == 3 else QtGui.QImage.Format_Grayscale8
+    img = QtGui.QImage(width, height, fmt)
+    # grayscale rows are padded to 4 bytes in the QImage
+    pixels = np.ndarray(data.shape, dtype=np.uint8, buffer=img.bits(),
+                        strides=(img.bytesPerLine(),) + data.strides[1:])
+    np.copyto(pixels, data)
+    return img, pixels
+
+
+# small bounded cache of model predictions keyed by frame timestamp, shared by the worker and the view
+class PredictionCache:
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    # predictions for the frame with this timestamp, or None if they aren't cached
+    def get(self, timestamp):
+        with self.lock:
+            objects = self.entries.get(timestamp)
+            if objects is not None:
+                self.entries.move_to_end(timestamp)
+            return objects
+
+    # store predictions, evicting the least recently used frame once full
+    def put(self, timestamp, objects):
+        with self.lock:
+            self.entries[timestamp] = objects
+            self.entries.move_to_end(timestamp)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# runs the AI model off the GUI thread on the newest frame it has been handed
+class InferenceWorker(QtCore.QThread):
+    predictions = QtCore.Signal(object, object)
+    status = QtCore.Signal(str)
+    # whether the model was loaded and warmed up (or the inference server connected to), see load
+    loaded = QtCore.Signal(bool)
+    # a newly selected model couldn't be used and the one before it was selected again, see revert
+    reverted = QtCore.Signal()
+
+    def __init__(self, frames, cache, budget_ms=66.0, server=None, parent=None):
+        QtCore.QThread.__init__(self, parent)
+        self.frames = frames
+        self.cache = cache
+        # address of an inference server to run the model in instead of on this thread
+        self.server = server
+        # the InferenceClient for it once connected, False once it is lost
+        self.remote = None
+        # set while running on raw frames, to map their boxes onto the display, see setRaw
+        self.geometry = None
+        self.cond = threading.Condition()
+        # one-slot mailbox, a newer frame replaces one the worker hasn't started on yet
+        self.pending = None
+        self.running = True
+        # between detector keyframes the last boxes can be tracked instead, see setTracking
+        self.tracker = BoxTracker()
+        self.tracking = False
+        # keeps inference within a per-frame latency budget when on, see setBudgeting
+        self.controller = LatencyController(budget_ms)
+        self.budgeting = False
+        # (model name, backend) of the last model that loaded, to go back to if a newly selected one doesn't
+        self.selection = None
+        self.count = 0
+        self.processed = 0
+        self.tracked = 0
+        self.superseded = 0
+
+    # hand the worker a new frame, superseding any frame still waiting
+    def submit(self, frame):
+        with self.cond:
+            if self.pending is not None:
+                self.superseded += 1
+                telemetry.pipeline.count("superseded")
+            self.pending = frame
+            self.cond.notify()
+
+    # turn detect-then-track on or off, running the detector only every 'interval' frames when on
+    def setTracking(self, tracking, interval=None):
+        if interval is not None:
+            self.tracker.interval = interval
+        self.tracking = tracking
+        self.tracker.reset()
+
+    # run on the raw frames of 'ring' and map their boxes with 'geometry', or on the displayed frames again
+    # of 'ring' with geometry None
+    def setRaw(self, ring, geometry):
+        with self.cond:
+            self.frames = ring
+            self.geometry = geometry
+            self.pending = None
+        model_registry.set_variant('raw' if geometry is not None else None)
+        self.tracker.reset()
+
+    # turn the latency controller on or off, going back to full detector settings either way
+    def setBudgeting(self, budgeting):
+        self.budgeting = budgeting
+        self.status.emit(self.controller.reset())
+
+    # ask the worker to exit and wait for the current inference to finish
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.wait()
+
+    # imports ai_testing and loads the model, then runs it on blank frames the size of the latest frame, so
+    # neither the window nor the first real frame waits for it; with a server it only connects to it
+    # returns False if the model can't be used
+    def load(self):
+        global ai_testing
+        registry = model_registry.registry
+        try:
+            if self.server is not None:
+                registry.check_artifacts = False
+                # frames are written straight into shared memory, where the server reads them
+                self.remote = InferenceClient(self.frames, self.server)
+            else:
+                import ai_testing
+                registry.active()
+                telemetry.pipeline.mark("model_loaded")
+                ring = self.frames.frames
+                ai_testing.warm_up(ring.shape[1:] if ring is not None else (480, 640, 4))
+        except Exception as e:
+            telemetry.pipeline.error(e)
+            self.status.emit("Could not {0} ({1}), predictions stopped".format(
+                "load the model" if self.server is None else "connect to the inference server",
+                str(e) or type(e).__name__))
+            self.loaded.emit(False)
+            return False
+        self.selection = (registry.model_name, registry.backend)
+        seconds = telemetry.pipeline.mark("model_ready")
+        self.status.emit("Model ready in {0:.1f} s".format(seconds))
+        self.loaded.emit(True)
+        return True
+
+    def run(self):
+        if not self.load():
+            return
+        while True:
+            with self.cond:
+                while self.pending is None and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    return
+                frame, self.pending = self.pending, None
+                ring, geometry = self.frames, self.geometry
+            # the latency controller may only have the detector run on every n-th frame
+            self.count += 1
+            if self.budgeting and self.count % self.controller.skip:
+                telemetry.pipeline.count("skipped")
+                continue
+            # a frame that was already seen (e.g. re-sent while frozen) costs no inference
+            if self.cache.get(frame.timestamp) is not None:
+                telemetry.pipeline.count("repeated")
+                continue
+            gray = self.tracker.gray(frame.data) if self.tracking else None
+            # move the boxes from the last keyframe if they can still be followed
+            objects = self.tracker.track(gray) if self.tracking else None
+            if objects is not None:
+                if not ring.is_live(frame.seq):
+                    telemetry.pipeline.count("lapped")
+                    continue
+                self.tracked += 1
+            else:
+                if self.remote is None:
+                    # a newly selected model is loaded here, so loading isn't counted as inference time
+                    try:
+                        model_registry.registry.active()
+                    except Exception as e:
+                        self.revert(e)
+                        continue
+                    self.selection = (model_registry.registry.model_name, model_registry.registry.backend)
+                # generate predictions from pretrained AI model, straight from the frame in the ring
+                start = time.perf_counter()
+                try:
+                    objects = self.predict(frame, ring)
+                except Exception as e:
+                    # the server refused the selected model, the last one it ran is selected again
+                    if isinstance(e, ServerError) and e.request == 'select':
+                        self.revert(e)
+                        continue
+                    # logged where it happened, by ai_testing here or in the server; scanning carries on
+                    telemetry.pipeline.count("failed")
+                    self.status.emit("Prediction failed ({0})".format(str(e) or type(e).__name__))
+                    continue
+                if self.remote:
+                    # the server accepted the selection sent with the frame
+                    self.selection = (model_registry.registry.model_name, model_registry.registry.backend)
+                telemetry.pipeline.record("inference", time.perf_counter() - start)
+                trace = telemetry.pipeline.profile_step()
+                if trace is not None:
+                    self.status.emit("Profile written to {0}".format(trace))
+                # the callback lapped the ring while we were reading, a newer frame is already on its way
+                if objects is None:
+                    telemetry.pipeline.count("failed" if self.remote is False else "lapped")
+                    continue
+                if self.budgeting:
+                    message = self.controller.record(time.perf_counter() - start)
+                    if message is not None:
+                        self.status.emit(message)
+                objects = objects[0]
+                if self.tracking:
+                    self.tracker.update(gray, objects)
+                self.processed += 1
+            if geometry is not None:
+                # tracking stays in raw coordinates, only what is drawn is moved onto the display
+                objects = geometry.map(objects)
+                if objects is None:
+                    continue
+            self.cache.put(frame.timestamp, objects)
+            self.predictions.emit(frame.timestamp, objects)
+
+    # the selected model failed to load here or in the server (e.g. a broken artifact or a missing runtime), so
+    # the last one that did, which is still loaded, is selected again and scanning carries on with it
+    def revert(self, e):
+        telemetry.pipeline.error(e)
+        registry = model_registry.registry
+        failed = "{0} ({1})".format(registry.model_name, registry.backend)
+        registry.select(*self.selection)
+        self.tracker.reset()
+        self.reverted.emit()
+        self.status.emit("Could not load {0}: {1}, back to {2} ({3})".format(
+            failed, str(e) or type(e).__name__, *self.selection))
+
+    # predictions for a frame in a ring as numpy arrays, or None if it was overwritten while being read
+    def predict(self, frame, ring):
+        if self.remote is None:
+            outputs = ai_testing.predict_with_frame(frame.data, lambda: ring.is_live(frame.seq))
+            return None if outputs is None else [{k: v.numpy() for k, v in outputs[0].items()}]
+        if self.remote is False:
+            return None
+        try:
+            return self.remote.predict(frame, ring)
+        except TimeoutError:
+            # a busy or slow server only costs this frame, the next one is sent as usual
+            raise
+        except (EOFError, OSError) as e:
+            # the scanning carries on without predictions, restart the server and the viewer to get them back
+            telemetry.pipeline.error(e)
+            self.remote.close()
+            self.remote = False
+            self.status.emit("Lost the inference server ({0}), predictions stopped".format(str(e) or type(e).__name__))
+            return None
 
 
 # draws the ultrasound image
@@ -81,18 +421,43 @@ class ImageView(QtWidgets.QGraphicsView):
         QtWidgets.QGraphicsView.__init__(self)
         self.cast = cast
         self.setScene(QtWidgets.QGraphicsScene())
-        self.init = True
         self.n_objects = 2
+        self.timestamp = None
+        self.objects = None
+        self.predictions = PredictionCache()
+        # pipeline timings drawn over the image, see telemetry.py
+        self.stats = False
+        # shown over the image until the model is ready
+        self.loading = "Loading model..."
+        # saved images are written one at a time off the GUI thread
+        self.saver = ThreadPoolExecutor(max_workers=1)
 
     # set the new image and redraw
-    def updateImage(self, img):
+    def updateImage(self, img, timestamp):
         self.image = img
+        self.timestamp = timestamp
+        self.scene().invalidate()
+
+    # set the latest predictions from the inference worker and redraw
+    def updatePredictions(self, timestamp, objects):
+        self.objects = objects
         self.scene().invalidate()
 
-    # saves a local image
+    # saves the displayed image with its predictions to a new file, returning its path
+    # the image is copied out of the ring and drawn on here, the PNG is encoded and written in the background
     def saveImage(self):
-       self.image.save(str(Path.home() / "pysidecaster images/Mar-12-2024"))
-    #   PNGSavePath = os.path.join( "cast-master", "examples", "python", "pysidecaster images", "Mar-12-2024")
+        image = self.image.copy()
+        painter = QtGui.QPainter(image)
+        self.drawPredictions(painter, image.rect())
+        painter.end()
+        path = Path.home() / "pysidecaster images" / datetime.now().strftime("image-%Y%m%d-%H%M%S-%f.png")
+        self.saver.submit(self.writeImage, image, path)
+        return path
+
+    def writeImage(self, image, path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if not image.save(str(path)):
+            print("could not save {0}".format(path))
 
     # resize the scan converter, image, and scene
     def resizeEvent(self, evt):
@@ -102,55 +467,67 @@ class ImageView(QtWidgets.QGraphicsView):
         self.image = QtGui.QImage(w, h, QtGui.QImage.Format_ARGB32)
         self.image.fill(QtCore.Qt.black)
         self.setSceneRect(0, 0, w, h)
+        # boxes were predicted in the old image coordinates
+        self.timestamp = None
+        self.objects = None
+        self.predictions.clear()
 
     # black background
     def drawBackground(self, painter, rect):
         painter.fillRect(rect, QtCore.Qt.black)
 
-    # draw bounding box-style predictions from the AI model 
+    # draw bounding box-style predictions from the AI model, using the ones cached for the displayed frame
+    # and falling back to the most recent ones while the worker catches up
     def drawPredictions(self, painter, rect):
+        objects = self.predictions.get(self.timestamp)
+        if objects is None:
+            objects = self.objects
+        else:
+            telemetry.pipeline.frame_drawn(self.timestamp)
+        if objects is None:
+            return
+        # get the top N scoring objects we detected
+        boxes = objects['boxes'][:self.n_objects, :].astype(int).tolist()
+        scores = objects['scores'][:self.n_objects]
+        object_types = objects['labels'][:self.n_objects] # only relevant if >1 type of object in your dataset
+
+        # draw N bounding boxes
+        painter.setPen(QtGui.QColor("yellow"))
+        painter.setFont(QtGui.QFont("Arial", 8))
+        for i, x in enumerate(scores):
+            painter.drawRect(boxes[i][0], boxes[i][1], (boxes[i][2] - boxes[i][0]), (boxes[i][3] - boxes[i][1]))
+
+    # rolling stage percentiles and drop counters in the top left corner
+    def drawStats(self, painter, rect):
+        painter.setPen(QtGui.QColor("lime"))
+        painter.setFont(QtGui.QFont("Courier", 8))
+        for i, line in enumerate(telemetry.pipeline.summary_lines()):
+            painter.drawText(rect.left() + 4, rect.top() + 12 * (i + 1), line)
+
+    def drawForeground(self, painter, rect):
         if not self.image.isNull():
-            # convert image to PIL format 
-            image_for_input = Image.fromarray(self.QImageToCVMat(self.image), mode="RGBA").convert("RGB")
-            # generate predictions from pretrained AI model 
-            objects = ai_testing.predict_with_model2(image_for_input)
-            # get the top N scoring objects we detected
-            boxes = objects[0]['boxes'][:self.n_objects, :].detach().int()
-            scores = objects[0]['scores'][:self.n_objects].detach()
-            object_types = objects[0]['labels'][:self.n_objects].detach() # only relevant if >1 type of object in your dataset 
-            
-            # draw N bounding boxes
-            painter.setPen(QtGui.QColor("yellow"))
-            painter.setFont(QtGui.QFont("Arial", 8))
-            for i, x in enumerate(scores):
-                painter.drawRect(boxes[i, 0], boxes[i, 1], (boxes[i, 2] - boxes[i, 0]), (boxes[i, 3] - boxes[i, 1]))
-
-    def drawForeground(self, painter, rect): 
-        if not self.image.isNull():
-            painter.drawImage(rect, self.image)
-            # if we're not on the startup screen (AKA we're streaming some images)
-            if not self.init:
+            with telemetry.pipeline.timed("draw"):
+                painter.drawImage(rect, self.image)
                 self.drawPredictions(painter, rect) # draw AI predictions
-            else: self.init = False
-
-
-    def QImageToCVMat(self, image):
-        # temp = copy.deepcopy(self.image)
-        incoming_image = image.convertToFormat(QtGui.QImage.Format.Format_RGB32)
-        width = incoming_image.width()
-        height = incoming_image.height()
-        ptr = incoming_image.bits()
-        arr = np.frombuffer(ptr, dtype=np.uint8).reshape(height, width, 4)
-        # print("array size: ", arr.shape)
-        return arr
+            if self.stats:
+                self.drawStats(painter, rect)
+            if self.loading:
+                painter.setPen(QtGui.QColor("yellow"))
+                painter.setFont(QtGui.QFont("Arial", 10))
+                painter.drawText(rect, QtCore.Qt.AlignBottom | QtCore.Qt.AlignHCenter, self.loading)
 
 
 # main widget with controls and ui
 class MainWidget(QtWidgets.QMainWindow):
-    def __init__(self, cast, parent=None):
+    # a local recording has been written out, emitted from its writer thread
+    recorded = QtCore.Signal(object)
+
+    def __init__(self, cast, budget_ms=66.0, server=None, startRaw=False, record_overflow="drop", parent=None):
         QtWidgets.QMainWindow.__init__(self, parent)
 
         self.cast = cast
+        # local recording in progress, see tryRecord
+        self.recorder = None
 
         self.setWindowTitle("Clarius Cast Demo")
 
@@ -173,8 +550,29 @@ class MainWidget(QtWidgets.QMainWindow):
         captureImage = QtWidgets.QPushButton("Capture Image")
         captureCine = QtWidgets.QPushButton("Capture Movie")
         saveImage = QtWidgets.QPushButton("Save Local")
+        record = QtWidgets.QPushButton("Record")
+        record.setToolTip("record the displayed frames and predictions locally, off the GUI thread")
         bMode = QtWidgets.QPushButton("B Mode")
         cfiMode = QtWidgets.QPushButton("Color Mode")
+        # the model choices are filled in once the model is ready, see modelLoaded
+        model = QtWidgets.QComboBox()
+        backend = QtWidgets.QComboBox()
+        track = QtWidgets.QCheckBox("Track")
+        track.setToolTip("run the detector every few frames and track its boxes in between")
+        budget = QtWidgets.QCheckBox("Budget")
+        budget.setToolTip("turn detector settings down automatically to keep up with a {0:.0f} ms frame budget"
+                          .format(budget_ms))
+        stats = QtWidgets.QCheckBox("Stats")
+        stats.setToolTip("show per-stage latency percentiles and dropped frame counts over the image")
+        profile = QtWidgets.QPushButton("Profile")
+        raw = QtWidgets.QCheckBox("Raw")
+        raw.setToolTip("detect on the raw pre scan-conversion frames (needs raw streaming), using '<model>.raw' "
+                       "weights where there are any")
+        profile.setToolTip("capture a torch.profiler trace of the next 30 inferences, for chrome://tracing")
+        # controls that need the model, disabled while it loads
+        modelControls = [model, backend, track, budget, raw]
+        for widget in modelControls:
+            widget.setEnabled(False)
 
         # try to connect/disconnect to/from the probe
         def tryConnect():
@@ -228,7 +626,22 @@ class MainWidget(QtWidgets.QMainWindow):
 
         # try to save a local image
         def trySaveImage():
-            self.img.saveImage()
+            path = self.img.saveImage()
+            self.statusBar().showMessage("Saving {0}".format(path))
+
+        # start or stop recording the displayed frames and the predictions locally
+        def tryRecord():
+            if self.recorder is None:
+                path = Path.home() / "pysidecaster recordings" / datetime.now().strftime("scan-%Y%m%d-%H%M%S.cine")
+                self.recorder = Recorder(str(path), overflow=record_overflow, finished=self.recorded.emit)
+                record.setText("Stop Recording")
+                self.statusBar().showMessage("Recording to {0}".format(path))
+            else:
+                recorder, self.recorder = self.recorder, None
+                # the writer finishes the queued frames in the background and reports back, see recordingFinished
+                recorder.close()
+                record.setText("Record")
+                self.statusBar().showMessage("Finishing {0}".format(recorder.path))
 
         # try b mode
         def tryBMode():
@@ -240,6 +653,85 @@ class MainWidget(QtWidgets.QMainWindow):
             if cast.isConnected():
                 cast.userFunction(CMD_CFI_MODE, 0)
 
+        # switch the AI model, it is loaded in the background on its first prediction
+        def trySetModel(name):
+            try:
+                model_registry.set_model(name)
+            except FileNotFoundError as e:
+                showSelection()
+                self.statusBar().showMessage(str(e))
+                return
+            self.img.predictions.clear()
+            self.worker.tracker.reset()
+            if self.worker.budgeting:
+                self.worker.controller.reset(restore=False)
+            self.statusBar().showMessage("Model: {0}".format(name))
+
+        # switch how the AI model is run, non-eager backends need the artifacts from export_models.py
+        def trySetBackend(name):
+            try:
+                model_registry.set_backend(name)
+            except FileNotFoundError as e:
+                showSelection()
+                self.statusBar().showMessage(str(e))
+                return
+            self.img.predictions.clear()
+            self.worker.tracker.reset()
+            self.statusBar().showMessage("Backend: {0}".format(name))
+
+        # detect-then-track, trading some box accuracy for a higher overlay rate
+        def trySetTracking(state):
+            self.worker.setTracking(track.isChecked())
+            self.statusBar().showMessage("Tracking {0}".format("on" if track.isChecked() else "off"))
+
+        # adapt detector settings to the latency budget, the controller's decisions show in the status bar
+        def trySetBudgeting(state):
+            self.worker.setBudgeting(budget.isChecked())
+
+        # switch inference between the displayed frames and the raw ones
+        def trySetRaw(state):
+            self.raw = raw.isChecked()
+            self.worker.setRaw(raw_frames if self.raw else frames, raw_geometry if self.raw else None)
+            self.img.predictions.clear()
+            self.statusBar().showMessage("Detecting on {0} frames".format("raw" if self.raw else "displayed"))
+
+        # draw the pipeline telemetry over the image
+        def trySetStats(state):
+            self.img.stats = stats.isChecked()
+            self.img.scene().invalidate()
+
+        # profile the next inferences, the worker reports where the trace was written
+        def tryProfile():
+            path = Path.home() / "pysidecaster profiles" / time.strftime("trace-%Y%m%d-%H%M%S.json")
+            telemetry.pipeline.request_profile(str(path))
+            self.statusBar().showMessage("Profiling the next inferences")
+
+        # show the selected model and backend, e.g. after a selection was refused
+        def showSelection():
+            for widget in (model, backend):
+                widget.blockSignals(True)
+            model.setCurrentText(model_registry.registry.model_name)
+            backend.setCurrentText(model_registry.registry.backend)
+            for widget in (model, backend):
+                widget.blockSignals(False)
+
+        # the model is loaded and warmed up in the background, its controls are enabled once it is ready
+        def modelLoaded(ok):
+            self.img.loading = None
+            self.img.scene().invalidate()
+            if not ok:
+                return
+            for widget in (model, backend):
+                widget.blockSignals(True)
+            model.addItems(list(model_registry.input_sizes))
+            backend.addItems(model_registry.backends)
+            for widget in (model, backend):
+                widget.blockSignals(False)
+            showSelection()
+            for widget in modelControls:
+                widget.setEnabled(True)
+            raw.setChecked(startRaw)
+
         conn.clicked.connect(tryConnect)
         self.run.clicked.connect(tryFreeze)
         quit.clicked.connect(self.shutdown)
@@ -250,8 +742,16 @@ class MainWidget(QtWidgets.QMainWindow):
         captureImage.clicked.connect(tryCaptureImage)
         captureCine.clicked.connect(tryCaptureCine)
         saveImage.clicked.connect(trySaveImage)
+        record.clicked.connect(tryRecord)
         bMode.clicked.connect(tryBMode)
         cfiMode.clicked.connect(tryCfiMode)
+        model.currentTextChanged.connect(trySetModel)
+        backend.currentTextChanged.connect(trySetBackend)
+        track.stateChanged.connect(trySetTracking)
+        budget.stateChanged.connect(trySetBudgeting)
+        stats.stateChanged.connect(trySetStats)
+        raw.stateChanged.connect(trySetRaw)
+        profile.clicked.connect(tryProfile)
 
         # add widgets to layout
         self.img = ImageView(cast)
@@ -282,16 +782,36 @@ class MainWidget(QtWidgets.QMainWindow):
         caplayout.addWidget(captureImage)
         caplayout.addWidget(captureCine)
         caplayout.addWidget(saveImage)
+        caplayout.addWidget(record)
 
         modelayout = QtWidgets.QHBoxLayout()
         layout.addLayout(modelayout)
         modelayout.addWidget(bMode)
         modelayout.addWidget(cfiMode)
+        modelayout.addWidget(model)
+        modelayout.addWidget(backend)
+        modelayout.addWidget(track)
+        modelayout.addWidget(budget)
+        modelayout.addWidget(raw)
+        modelayout.addWidget(stats)
+        modelayout.addWidget(profile)
 
         # connect signals
         signaller.freeze.connect(self.freeze)
         signaller.button.connect(self.button)
         signaller.image.connect(self.image)
+        signaller.raw.connect(self.rawImage)
+        self.recorded.connect(self.recordingFinished)
+
+        # run the AI model in the background, keeping the GUI thread free for drawing
+        self.worker = InferenceWorker(frames, self.img.predictions, budget_ms, server)
+        self.worker.predictions.connect(self.predictions)
+        self.worker.status.connect(self.statusBar().showMessage)
+        self.worker.loaded.connect(modelLoaded)
+        self.worker.reverted.connect(showSelection)
+        self.latencies = []
+        self.raw = False
+        self.worker.start()
 
         # get home path
         path = os.path.expanduser("~/")
@@ -316,17 +836,71 @@ class MainWidget(QtWidgets.QMainWindow):
         self.statusBar().showMessage("Button {0} pressed w/ {1} clicks".format(btn, clicks))
 
     # handles new images
-    @Slot(QtGui.QImage)
-    def image(self, img):
-        self.img.updateImage(img)
+    @Slot(object)
+    def image(self, frame):
+        # the callback reuses the frame's slot a few frames later, so it is copied into an image the GUI owns
+        # rather than drawn from the ring; a frame lapped before it was copied is dropped, a newer one is queued
+        if not frames.is_live(frame.seq):
+            return
+        img, pixels = frameToQImage(frame.data)
+        if not frames.is_live(frame.seq):
+            return
+        telemetry.pipeline.mark("first_frame")
+        self.img.updateImage(img, frame.timestamp)
+        if self.recorder is not None:
+            self.recorder.add_frame(frame.timestamp, pixels)
+        if not self.raw:
+            self.worker.submit(frame)
+
+    # handles new raw images, which are only used for inference
+    @Slot(object)
+    def rawImage(self, frame):
+        if self.raw:
+            self.worker.submit(frame)
+
+    # handles new predictions from the inference worker
+    @Slot(object, object)
+    def predictions(self, timestamp, objects):
+        if telemetry.pipeline.mark("first_prediction") is not None:
+            self.statusBar().showMessage("Startup: " + telemetry.pipeline.startup_line())
+            print("startup: " + telemetry.pipeline.startup_line())
+        self.img.updatePredictions(timestamp, objects)
+        if self.recorder is not None:
+            self.recorder.add_predictions(timestamp, objects)
+        # replayed frames are timestamped with the wall clock, so the frame-to-overlay latency is known
+        if isinstance(self.cast, ReplayCaster):
+            self.latencies.append((time.time_ns() - timestamp) / 1e6)
+
+    # handles a local recording being written out, including any write that failed after recording stopped
+    @Slot(object)
+    def recordingFinished(self, recorder):
+        self.statusBar().showMessage("Recorded {0} ({1} frames, {2} dropped{3})".format(
+            recorder.path, recorder.frames, recorder.dropped,
+            ", write failed: {0}".format(recorder.error) if recorder.error else ""))
 
     # handles shutdown
     @Slot()
     def shutdown(self):
-        if sys.platform.startswith("linux"):
+        self.worker.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        self.img.saver.shutdown()
+        if isinstance(self.cast, ReplayCaster):
+            stats = self.cast.stats()
+            print("replayed {0} frames ({1} skipped, callback {2:.2f} ms), {3} inferences, {4} tracked, "
+                  "{5} frames superseded".format(stats["sent"], stats["skipped"], stats["mean_callback_ms"],
+                                                 self.worker.processed, self.worker.tracked, self.worker.superseded))
+            if self.latencies:
+                p50, p95 = np.percentile(self.latencies, [50, 95])
+                print("frame to overlay latency: p50 {0:.1f} ms, p95 {1:.1f} ms".format(p50, p95))
+        elif libcast_handle is not None:
             # unload the shared library before destroying the cast object
             ctypes.CDLL("libc.so.6").dlclose(libcast_handle)
         self.cast.destroy()
+        if self.worker.remote:
+            self.worker.remote.close()
+        frames.close()
+        raw_frames.close()
         QtWidgets.QApplication.quit()
 
 
@@ -340,15 +914,17 @@ class MainWidget(QtWidgets.QMainWindow):
 # @param angle acquisition angle for volumetric data
 # @param imu inertial data tagged with the frame
 def newProcessedImage(image, width, height, sz, micronsPerPixel, timestamp, angle, imu):
-    bpp = sz / (width * height)
-    if bpp == 4:
-        img = QtGui.QImage(image, width, height, QtGui.QImage.Format_ARGB32)
-    else:
-        img = QtGui.QImage(image, width, height, QtGui.QImage.Format_Grayscale8)
-    # a deep copy is important here, as the memory from 'image' won't be valid after the event posting
-    signaller.usimage = img.copy()
-    evt = ImageEvent()
-    QtCore.QCoreApplication.postEvent(signaller, evt)
+    start = time.perf_counter()
+    telemetry.pipeline.count("frames")
+    telemetry.pipeline.frame_started(timestamp, start)
+    bpp = sz // (width * height)
+    # copying into the ring is important here, as the memory from 'image' won't be valid after the event posting
+    # the model input is read straight from the ring, the GUI copies the frame out once it picks it up
+    frame = frames.write(image, width, height, bpp, timestamp)
+    raw_geometry.updateDisplay(width, micronsPerPixel)
+    telemetry.pipeline.record("conversion", time.perf_counter() - start)
+    QtCore.QCoreApplication.postEvent(signaller, ImageEvent(frame))
+    telemetry.pipeline.record("callback", time.perf_counter() - start)
     return
 
 
@@ -364,6 +940,17 @@ def newProcessedImage(image, width, height, sz, micronsPerPixel, timestamp, angl
 # @param rf flag for if the image received is radiofrequency data
 # @param angle acquisition angle for volumetric data
 def newRawImage(image, lines, samples, bps, axial, lateral, timestamp, jpg, rf, angle):
+    # only 8-bit envelope data can be detected on, not rf
+    if rf or bps != 8:
+        return
+    # the data is line by line, it is turned depth down as it is copied into the ring
+    if jpg:
+        raw = np.asarray(Image.open(io.BytesIO(np.frombuffer(image, dtype=np.uint8, count=jpg).tobytes())).convert("L"))
+    else:
+        raw = np.frombuffer(image, dtype=np.uint8, count=lines * samples).reshape(lines, samples)
+    frame = raw_frames.write_array(raw.T, timestamp)
+    raw_geometry.updateRaw(lines, axial, lateral)
+    QtCore.QCoreApplication.postEvent(signaller, RawImageEvent(frame))
     return
 
 
@@ -399,11 +986,47 @@ def buttonsFn(button, clicks):
 
 ## main function
 def main():
-    cast = pyclariuscast.Caster(newProcessedImage, newRawImage, newSpectrumImage, freezeFn, buttonsFn)
-    app = QtWidgets.QApplication(sys.argv)
-    widget = MainWidget(cast)
+    global frames, raw_frames
+    parser = argparse.ArgumentParser(description="Clarius Cast viewer with AI lesion detection.")
+    parser.add_argument("--replay", help="stream recorded frames (a directory of frames or a video) instead of a probe")
+    parser.add_argument("--fps", type=float, default=30.0, help="replay frame rate")
+    parser.add_argument("--size", help="fixed replay image size WxH, otherwise it follows the window")
+    parser.add_argument("--bpp", type=int, default=4, choices=[1, 4], help="replay bytes per pixel")
+    parser.add_argument("--raw", action="store_true",
+                        help="detect on raw frames from the start; replays then also stream raw frames")
+    parser.add_argument("--budget", type=float, default=66.0, help="per-frame latency budget in ms for Budget mode")
+    parser.add_argument("--server", nargs="?", const=default_address,
+                        help="run the AI model in inference_server.py at this address instead of in the viewer")
+    parser.add_argument("--record-overflow", default="drop", choices=["drop", "block"],
+                        help="when local recording falls behind, drop frames or hold up the viewer until it catches up")
+    parser.add_argument("--telemetry", help="periodically dump pipeline telemetry here, a Prometheus textfile "
+                                            "if it ends in .prom and CSV otherwise")
+    parser.add_argument("--telemetry-interval", type=float, default=10.0, help="seconds between telemetry dumps")
+    args, qtargs = parser.parse_known_args()
+
+    telemetry.pipeline.launched = launched
+    if args.telemetry:
+        telemetry.pipeline.start_dump(args.telemetry, args.telemetry_interval)
+
+    if args.server is not None:
+        # frames are written straight into shared memory, where the server reads them
+        frames = SharedFrameRing()
+        raw_frames = SharedFrameRing()
+
+    if args.replay:
+        size = tuple(int(x) for x in args.size.lower().split("x")) if args.size else None
+        cast = ReplayCaster(newProcessedImage, newRawImage, newSpectrumImage, freezeFn, buttonsFn,
+                            source=args.replay, fps=args.fps, size=size, bpp=args.bpp,
+                            rawSize=(128, 512) if args.raw else None)
+    elif pyclariuscast is not None:
+        cast = pyclariuscast.Caster(newProcessedImage, newRawImage, newSpectrumImage, freezeFn, buttonsFn)
+    else:
+        sys.exit("the Clarius Cast API could not be loaded, use --replay to stream recorded frames")
+    app = QtWidgets.QApplication(sys.argv[:1] + qtargs)
+    widget = MainWidget(cast, args.budget, args.server, args.raw, args.record_overflow)
     widget.resize(640, 480)
     widget.show()
+    telemetry.pipeline.mark("window")
     sys.exit(app.exec())
 
 
@@ -0,0 +1,204 @@
+import glob
+import json
+import os
+import queue
+import threading
+import zipfile
+import numpy as np
+
+# a recording is a directory '<name>.cine' holding 'recording.json' and numbered chunks 'chunk-00000.npz', each a
+# zip of .npy arrays:
+# - timestamps (n,) int64 and frames (n, height, width[, 4]) uint8 of the frames displayed during the chunk
+# - prediction_timestamps (m,) int64 of the frames predictions arrived for during the chunk, with their boxes,
+#   scores and labels concatenated, prediction i having rows offsets[i]:offsets[i + 1]
+# a chunk only appears under its name once it is complete, so a recording cut short keeps every chunk before
+version = 1
+
+
+# records frames and predictions off the GUI thread: they are queued, and a writer thread batches them into
+# compressed chunks; the queue is bounded, when it is full new items are dropped (and counted) with
+# overflow='drop', or the caller waits for room with overflow='block'
+class Recorder:
+    # @param chunk_frames frames per chunk, a chunk is also started whenever the frame size changes
+    # @param grayscale keep only the green channel of ARGB32 frames, enough for plain B-mode at a quarter of the
+    # size but losing colour Doppler and coloured overlays, so full frames are kept by default
+    # @param compresslevel deflate level, the lowest keeps up with a probe's frame rate
+    # @param finished called with the recorder from the writer thread once it has written everything queued before
+    # close, or given up after a failed write (see error)
+    def __init__(self, path, chunk_frames=64, max_queue=128, overflow='drop', grayscale=False, compresslevel=1,
+                 finished=None):
+        if overflow not in ('drop', 'block'):
+            raise ValueError(f"unknown overflow '{overflow}', expected 'drop' or 'block'")
+        self.path = path
+        self.chunk_frames = chunk_frames
+        self.overflow = overflow
+        self.grayscale = grayscale
+        self.compresslevel = compresslevel
+        self.finished = finished
+        self.queue = queue.Queue(max_queue)
+        self.stopping = threading.Event()
+        self.frames = 0
+        self.dropped = 0
+        self.chunks = 0
+        self.error = None
+        os.makedirs(path, exist_ok=True)
+        # 'channels' are those stored for ARGB32 frames (BGRA in memory), frames streamed as grayscale are 2-D
+        with open(os.path.join(path, 'recording.json'), 'w') as f:
+            json.dump({'version': version, 'grayscale': grayscale, 'channels': 'G' if grayscale else 'BGRA'}, f)
+        # not a daemon, so the last chunk is still written when the app quits while recording
+        self.thread = threading.Thread(target=self.write_loop)
+        self.thread.start()
+
+    # queue a frame, copied since the ring will reuse its slot
+    def add_frame(self, timestamp, data):
+        frame = data[..., 1].copy() if self.grayscale and data.ndim == 3 else data.copy()
+        self._put(('frame', timestamp, frame))
+
+    # queue the predictions for a frame
+    def add_predictions(self, timestamp, objects):
+        self._put(('predictions', timestamp, np.asarray(objects['boxes'], dtype=np.float32).reshape(-1, 4),
+                   np.asarray(objects['scores'], dtype=np.float32), np.asarray(objects['labels'], dtype=np.int64)))
+
+    def _put(self, item):
+        if self.overflow == 'block':
+            self.queue.put(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    # stop recording; the queued items are written in the background unless wait is True
+    # never blocks on a full queue, so stopping doesn't stall the caller just when the writer is behind
+    def close(self, wait=False):
+        self.stopping.set()
+        try:
+            # wakes the writer straight away, with a full queue it sees 'stopping' once it has emptied it
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        if wait:
+            self.thread.join()
+
+    def write_loop(self):
+        chunk = self.empty_chunk()
+        while True:
+            try:
+                item = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.stopping.is_set():
+                    break
+                continue
+            if item is None:
+                break
+            if item[0] == 'frame':
+                _, timestamp, frame = item
+                if chunk['frames'] and chunk['frames'][0].shape != frame.shape:
+                    chunk = self.flush(chunk)
+                chunk['timestamps'].append(timestamp)
+                chunk['frames'].append(frame)
+                self.frames += 1
+                if len(chunk['frames']) >= self.chunk_frames:
+                    chunk = self.flush(chunk)
+            else:
+                _, timestamp, boxes, scores, labels = item
+                chunk['prediction_timestamps'].append(timestamp)
+                chunk['boxes'].append(boxes)
+                chunk['scores'].append(scores)
+                chunk['labels'].append(labels)
+        if chunk['frames'] or chunk['prediction_timestamps']:
+            self.flush(chunk)
+        if self.finished is not None:
+            self.finished(self)
+
+    def empty_chunk(self):
+        return {'timestamps': [], 'frames': [], 'prediction_timestamps': [], 'boxes': [], 'scores': [], 'labels': []}
+
+    # writes a chunk and returns an empty one; after a failed write (e.g. a full disk) the rest of the
+    # recording is discarded, so the queue keeps draining and callers never block on it
+    def flush(self, chunk):
+        if self.error is not None:
+            return self.empty_chunk()
+        counts = [len(s) for s in chunk['scores']]
+        arrays = {
+            'timestamps': np.asarray(chunk['timestamps'], dtype=np.int64),
+            'frames': np.stack(chunk['frames']) if chunk['frames'] else np.zeros((0, 0, 0), dtype=np.uint8),
+            'prediction_timestamps': np.asarray(chunk['prediction_timestamps'], dtype=np.int64),
+            'offsets': np.concatenate([[0], np.cumsum(counts, dtype=np.int64)]),
+            'boxes': np.concatenate(chunk['boxes']) if counts else np.zeros((0, 4), dtype=np.float32),
+            'scores': np.concatenate(chunk['scores']) if counts else np.zeros(0, dtype=np.float32),
+            'labels': np.concatenate(chunk['labels']) if counts else np.zeros(0, dtype=np.int64),
+        }
+        path = os.path.join(self.path, "chunk-{0:05d}.npz".format(self.chunks))
+        try:
+            # a zip of .npy files like np.savez_compressed, at a faster compression level
+            with zipfile.ZipFile(path + '.tmp', 'w', zipfile.ZIP_DEFLATED, compresslevel=self.compresslevel) as z:
+                for name, array in arrays.items():
+                    with z.open(name + '.npy', 'w', force_zip64=True) as f:
+                        np.lib.format.write_array(f, array, allow_pickle=False)
+            os.replace(path + '.tmp', path)
+            self.chunks += 1
+        except OSError as e:
+            self.error = e
+        return self.empty_chunk()
+
+
+# true if a path is a recording made by Recorder
+def is_recording(path):
+    return os.path.isfile(os.path.join(path, 'recording.json'))
+
+
+# reads a recording back, chunk by chunk
+class Recording:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'recording.json')) as f:
+            self.info = json.load(f)
+        self.chunks = sorted(glob.glob(os.path.join(path, 'chunk-*.npz')))
+
+    def __len__(self):
+        return sum(len(self.timestamps(i)) for i in range(len(self.chunks)))
+
+    # only the timestamps of a chunk, without decompressing its frames
+    def timestamps(self, i):
+        with np.load(self.chunks[i]) as f:
+            return f['timestamps']
+
+    def chunk(self, i):
+        with np.load(self.chunks[i]) as f:
+            return {name: f[name] for name in f.files}
+
+    # a recorded frame as (height, width, 3) RGB, whichever way it was recorded
+    def rgb(self, frame):
+        if frame.ndim == 2:
+            return np.repeat(frame[..., None], 3, axis=2)
+        return frame[..., [2, 1, 0]]
+
+    # (timestamp, frame) of every recorded frame, frames as they were recorded
+    def frames(self, chunks=None):
+        for i in range(len(self.chunks)) if chunks is None else chunks:
+            chunk = self.chunk(i)
+            yield from zip(chunk['timestamps'].tolist(), chunk['frames'])
+
+    # timestamps of the frames predictions were recorded for, in order, and the predictions as dicts of
+    # 'boxes', 'scores' and 'labels' arrays
+    def predictions(self):
+        timestamps, objects = [], []
+        for i in range(len(self.chunks)):
+            with np.load(self.chunks[i]) as f:
+                offsets, boxes, scores, labels = f['offsets'], f['boxes'], f['scores'], f['labels']
+                for j, timestamp in enumerate(f['prediction_timestamps'].tolist()):
+                    start, stop = offsets[j], offsets[j + 1]
+                    timestamps.append(timestamp)
+                    objects.append({'boxes': boxes[start:stop], 'scores': scores[start:stop],
+                                    'labels': labels[start:stop]})
+        order = np.argsort(timestamps, kind='stable')
+        return np.asarray(timestamps, dtype=np.int64)[order], [objects[i] for i in order]
+
+    # (timestamp, frame, objects) of every frame, with the predictions made for it or, failing that, the latest
+    # ones for an earlier frame, as the overlay shows them; None before the first predictions
+    def __iter__(self):
+        timestamps, objects = self.predictions()
+        for timestamp, frame in self.frames():
+            i = int(np.searchsorted(timestamps, timestamp, side='right')) - 1
+            yield timestamp, frame, objects[i] if i >= 0 else None
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+
+import glob
+import os.path
+import threading
+import time
+import numpy as np
+from PIL import Image
+
+CMD_FREEZE = 1
+
+
+# loads extracted frames (.jpg/.png) from a directory, or every frame of a video clip
+def load_clip(path, grayscale=False):
+    mode = "L" if grayscale else "RGB"
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, "*.jpg")) + glob.glob(os.path.join(path, "*.png")),
+                       key=lambda p: (len(p), p))
+        return [Image.open(p).convert(mode) for p in paths]
+    import cv2  # only needed to replay video clips
+    frames = []
+    video = cv2.VideoCapture(path)
+    ok, bgr = video.read()
+    while ok:
+        frames.append(Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)).convert(mode))
+        ok, bgr = video.read()
+    video.release()
+    return frames
+
+
+# drop-in stand-in for pyclariuscast.Caster that streams recorded frames instead of a live probe
+# frames are delivered through the same callbacks, from a background thread like the cast library does
+class ReplayCaster:
+    def __init__(self, newProcessedImage, newRawImage, newSpectrumImage, freezeFn, buttonsFn,
+                 source=None, fps=30.0, size=None, bpp=4, micronsPerPixel=100.0, loop=True, rawSize=None):
+        self.newProcessedImage = newProcessedImage
+        self.newRawImage = newRawImage
+        self.newSpectrumImage = newSpectrumImage
+        self.freezeFn = freezeFn
+        self.buttonsFn = buttonsFn
+        self.source = source
+        self.fps = fps
+        # a fixed output size, otherwise frames follow setOutputSize like the scan converter does
+        self.fixedSize = size
+        self.size = size or (640, 480)
+        self.bpp = bpp
+        self.micronsPerPixel = micronsPerPixel
+        self.loop = loop
+        # (lines, samples) to also stream each frame at as an 8-bit raw image, as if from a linear array
+        # spanning the displayed image
+        self.rawSize = rawSize
+        self.frames = []
+        self.connected = False
+        self.frozen = True
+        self.thread = None
+        self.cond = threading.Condition()
+        # counters for load testing
+        self.sent = 0
+        self.skipped = 0
+        self.callbackTime = 0.0
+
+    def init(self, path, width, height):
+        self.setOutputSize(width, height)
+        if self.source is None:
+            return False
+        self.frames = load_clip(self.source, grayscale=self.bpp == 1)
+        return len(self.frames) > 0
+
+    def connect(self, ip, port, cert):
+        if not self.frames:
+            return False
+        self.connected = True
+        self.thread = threading.Thread(target=self.stream, daemon=True)
+        self.thread.start()
+        # start imaging straight away, as a probe that is already scanning would
+        self.setFrozen(False)
+        return True
+
+    def disconnect(self):
+        with self.cond:
+            self.connected = False
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return True
+
+    def isConnected(self):
+        return self.connected
+
+    def destroy(self):
+        self.disconnect()
+
+    def setOutputSize(self, width, height):
+        if self.fixedSize is None:
+            self.size = (width, height)
+        return True
+
+    # only freeze is meaningful for a recording, other commands are accepted and ignored
+    def userFunction(self, cmd, val):
+        if cmd == CMD_FREEZE:
+            self.setFrozen(not self.frozen)
+        return True
+
+    # simulates a button press on the probe
+    def press(self, button, clicks):
+        self.buttonsFn(button, clicks)
+
+    def setFrozen(self, frozen):
+        with self.cond:
+            self.frozen = frozen
+            self.cond.notify()
+        self.freezeFn(frozen)
+
+    # renders a frame at the current output size as the callback's ARGB32 (B, G, R, A in memory) or 8-bit bytes
+    def render(self, index):
+        width, height = self.size
+        pixels = np.asarray(self.frames[index].resize((width, height)))
+        if self.bpp == 1:
+            return pixels.tobytes(), width, height
+        image = np.empty((height, width, 4), dtype=np.uint8)
+        image[..., 0] = pixels[..., 2]
+        image[..., 1] = pixels[..., 1]
+        image[..., 2] = pixels[..., 0]
+        image[..., 3] = 255
+        return image.tobytes(), width, height
+
+    # renders a frame as line by line 8-bit raw data, with the axial and lateral microns that scan convert
+    # it back onto the displayed image
+    def renderRaw(self, index):
+        width, height = self.size
+        lines, samples = self.rawSize
+        pixels = np.asarray(self.frames[index].convert("L").resize((lines, samples)))
+        axial = height * self.micronsPerPixel / samples
+        lateral = width * self.micronsPerPixel / lines
+        return np.ascontiguousarray(pixels.T).tobytes(), axial, lateral
+
+    # sends frames on a fixed schedule; when a callback overruns, frames whose slot has passed are skipped
+    # rather than sent late, as a probe keeps imaging regardless of how fast its client is
+    def stream(self):
+        period = 1.0 / self.fps
+        index = 0
+        start = None
+        tick = 0
+        while True:
+            with self.cond:
+                while self.frozen and self.connected:
+                    self.cond.wait()
+                    start = None
+                if not self.connected:
+                    return
+            if start is None:
+                start = time.perf_counter()
+                tick = 0
+            delay = start + tick * period - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -period:
+                missed = int(-delay / period)
+                self.skipped += missed
+                tick += missed
+                index += missed
+            if index >= len(self.frames):
+                if not self.loop:
+                    self.setFrozen(True)
+                    index = 0
+                    continue
+                index %= len(self.frames)
+            image, width, height = self.render(index)
+            timestamp = time.time_ns()
+            called = time.perf_counter()
+            self.newProcessedImage(image, width, height, len(image), self.micronsPerPixel, timestamp, 0.0, [])
+            self.callbackTime += time.perf_counter() - called
+            if self.rawSize is not None:
+                raw, axial, lateral = self.renderRaw(index)
+                self.newRawImage(raw, self.rawSize[0], self.rawSize[1], 8, axial, lateral, timestamp, 0, False, 0.0)
+            self.sent += 1
+            index += 1
+            tick += 1
+
+    # summary of the replay for load testing
+    def stats(self):
+        return {"sent": self.sent, "skipped": self.skipped,
+                "mean_callback_ms": 1000.0 * self.callbackTime / self.sent if self.sent else 0.0}
@@ -0,0 +1,285 @@
+import math
+import os
+import sys
+import threading
+import time
+import traceback
+import numpy as np
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# stages a frame is timed at between the cast callback and its boxes being drawn in pysidecaster.py
+# 'callback' is the whole cast callback and 'conversion' the copy into the ring within it, 'delivery' is the
+# wait for the GUI thread to pick up the image event, 'inference' is the worker's whole predict call around
+# 'preprocess' and 'forward' (which run in inference_server.py instead when it is used), and 'total' is from
+# the callback to the frame's own boxes being drawn
+stages = ["callback", "conversion", "delivery", "preprocess", "forward", "inference", "draw", "total"]
+
+# reasons a frame never gets predictions of its own, counted along with 'frames', every frame delivered
+drops = ["superseded", "skipped", "repeated", "lapped", "failed"]
+
+# log-linear buckets like HdrHistogram: durations under sub_buckets microseconds get 1 us buckets, above that
+# every power of two is split into sub_buckets, so each duration is kept to within 1/sub_buckets of itself
+sub_buckets = 16
+# enough powers of two for over an hour
+n_buckets = sub_buckets * 29
+
+
+# bucket a duration in seconds falls in
+def bucket(seconds):
+    us = seconds * 1e6
+    if us < sub_buckets:
+        return max(int(us), 0)
+    # us = mantissa * 2**exponent with 0.5 <= mantissa < 1
+    mantissa, exponent = math.frexp(us)
+    return min(sub_buckets * (exponent - 4) + int((2 * mantissa - 1) * sub_buckets), n_buckets - 1)
+
+
+# duration in seconds in the middle of each bucket
+def _bucket_values():
+    index = np.arange(n_buckets)
+    exponent = index // sub_buckets + 4
+    us = (1 + (index % sub_buckets + 0.5) / sub_buckets) * 2.0 ** (exponent - 1)
+    return np.where(index < sub_buckets, index + 0.5, us) / 1e6
+
+bucket_values = _bucket_values()
+
+
+# rolling histogram of durations, covering the last 'window' to 2 * 'window' seconds
+# the counts since the start are kept too, for cumulative exports
+class Histogram:
+    def __init__(self, window=60.0):
+        self.window = window
+        self.current = np.zeros(n_buckets, dtype=np.int64)
+        self.previous = np.zeros(n_buckets, dtype=np.int64)
+        self.total = np.zeros(n_buckets, dtype=np.int64)
+        self.sum = 0.0
+        self.rotated = time.monotonic()
+
+    def record(self, seconds):
+        now = time.monotonic()
+        if now - self.rotated > self.window:
+            self.previous = self.current if now - self.rotated < 2 * self.window else np.zeros_like(self.current)
+            self.current = np.zeros_like(self.current)
+            self.rotated = now
+        i = bucket(seconds)
+        self.current[i] += 1
+        self.total[i] += 1
+        self.sum += seconds
+
+    # durations in seconds at percentiles 'q' (0-100) of the rolling window, nan when it is empty
+    def percentiles(self, q, cumulative=False):
+        counts = self.total if cumulative else self.current + self.previous
+        ranks = np.cumsum(counts)
+        if ranks[-1] == 0:
+            return np.full(len(q), np.nan)
+        wanted = np.maximum(np.ceil(np.asarray(q) / 100.0 * ranks[-1]), 1)
+        return bucket_values[np.searchsorted(ranks, wanted)]
+
+    def count(self, cumulative=False):
+        return int(self.total.sum() if cumulative else (self.current + self.previous).sum())
+
+
+# timings and drop counters of the whole scanning pipeline, shared by the threads that run it
+# besides being read directly they can be drawn over the image (ImageView), dumped periodically to a CSV or a
+# Prometheus textfile (start_dump), and a torch.profiler trace can be captured on demand (request_profile)
+class Telemetry:
+    def __init__(self, window=60.0):
+        self.lock = threading.Lock()
+        self.histograms = {stage: Histogram(window) for stage in stages}
+        self.counters = dict.fromkeys(["frames"] + drops, 0)
+        # callback time of recent frames by timestamp, until their boxes are drawn
+        self.started = OrderedDict()
+        self.errors = 0
+        self.last_error = None
+        # seconds from 'launched' to the first time each milestone was reached, see mark; a program can set
+        # 'launched' to when it started, otherwise it is when this was created
+        self.launched = time.perf_counter()
+        self.milestones = OrderedDict()
+        self.dump_path = None
+        # dumps come from the dump loop and from error(), one at a time
+        self.dump_lock = threading.Lock()
+        self.profile_request = None
+        self.profiler = None
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.histograms[stage].record(seconds)
+
+    # times the body of a with block as a stage
+    @contextmanager
+    def timed(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    # remember when a frame arrived in the callback, to time it end to end
+    def frame_started(self, timestamp, start):
+        with self.lock:
+            self.started[timestamp] = start
+            while len(self.started) > 64:
+                self.started.popitem(last=False)
+
+    # the frame's own boxes are being drawn, which ends its 'total' time; later redraws aren't counted
+    def frame_drawn(self, timestamp):
+        with self.lock:
+            start = self.started.pop(timestamp, None)
+            if start is not None:
+                self.histograms["total"].record(time.perf_counter() - start)
+
+    # the first time a startup milestone is reached, e.g. 'first_frame', returning the seconds since launch
+    # later marks of the same milestone are ignored and return None, so it can be marked on every frame
+    def mark(self, name):
+        if name in self.milestones:
+            return None
+        with self.lock:
+            if name in self.milestones:
+                return None
+            seconds = self.milestones[name] = time.perf_counter() - self.launched
+        return seconds
+
+    # the milestones reached so far, e.g. "window 0.4 s, model_ready 3.1 s"
+    def startup_line(self):
+        with self.lock:
+            return ", ".join("{0} {1:.1f} s".format(name, seconds) for name, seconds in self.milestones.items())
+
+    # an exception in the pipeline, logged with its traceback and written out with the next dump
+    def error(self, e):
+        text = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+        with self.lock:
+            self.errors += 1
+            self.last_error = text
+        print(text, file=sys.stderr)
+        if self.dump_path is not None:
+            self.dump()
+
+    # p50/p95/p99/max in ms and number of samples of every stage with any, over the rolling window
+    def snapshot(self, cumulative=False):
+        with self.lock:
+            stats = {}
+            for stage, histogram in self.histograms.items():
+                n = histogram.count(cumulative)
+                if n:
+                    p50, p95, p99, p100 = histogram.percentiles([50, 95, 99, 100], cumulative) * 1000.0
+                    stats[stage] = {"count": n, "p50_ms": p50, "p95_ms": p95, "p99_ms": p99, "max_ms": p100}
+            return stats, dict(self.counters, errors=self.errors)
+
+    # a line per timed stage and one for the counters, for drawing over the image
+    def summary_lines(self):
+        stats, counters = self.snapshot()
+        lines = ["{0:<10} p50 {1:6.1f}  p95 {2:6.1f}  p99 {3:6.1f} ms".format(stage, s["p50_ms"], s["p95_ms"],
+                                                                          s["p99_ms"]) for stage, s in stats.items()]
+        lines.append(", ".join("{0} {1}".format(name, value) for name, value in counters.items()))
+        if self.milestones:
+            lines.append("startup: " + self.startup_line())
+        return lines
+
+    # appends one row per stage with the rolling percentiles, one per counter, and one per startup milestone
+    # with its time in the p50_ms column
+    def write_csv(self, path):
+        stats, counters = self.snapshot()
+        with self.lock:
+            milestones = list(self.milestones.items())
+        now = time.time()
+        new = not os.path.exists(path)
+        with open(path, "a") as f:
+            if new:
+                f.write("time,name,count,p50_ms,p95_ms,p99_ms,max_ms\n")
+            for stage, s in stats.items():
+                f.write("{0:.3f},{1},{2},{3:.3f},{4:.3f},{5:.3f},{6:.3f}\n".format(
+                    now, stage, s["count"], s["p50_ms"], s["p95_ms"], s["p99_ms"], s["max_ms"]))
+            for name, value in counters.items():
+                f.write("{0:.3f},{1},{2},,,,\n".format(now, name, value))
+            for name, seconds in milestones:
+                f.write("{0:.3f},startup_{1},,{2:.3f},,,\n".format(now, name, seconds * 1000.0))
+
+    # replaces a Prometheus textfile (for node_exporter's textfile collector) with cumulative summaries
+    def write_prometheus(self, path):
+        with self.lock:
+            lines = ["# TYPE portable_bus_stage_seconds summary"]
+            for stage, histogram in self.histograms.items():
+                n = histogram.count(cumulative=True)
+                if not n:
+                    continue
+                for q, value in zip([0.5, 0.95, 0.99], histogram.percentiles([50, 95, 99], cumulative=True)):
+                    lines.append('portable_bus_stage_seconds{{stage="{0}",quantile="{1}"}} {2:.6f}'.format(
+                        stage, q, value))
+                lines.append('portable_bus_stage_seconds_sum{{stage="{0}"}} {1:.6f}'.format(stage, histogram.sum))
+                lines.append('portable_bus_stage_seconds_count{{stage="{0}"}} {1}'.format(stage, n))
+            lines.append("# TYPE portable_bus_frames_total counter")
+            for name, value in self.counters.items():
+                lines.append('portable_bus_frames_total{{reason="{0}"}} {1}'.format(name, value))
+            lines.append("# TYPE portable_bus_errors_total counter")
+            lines.append("portable_bus_errors_total {0}".format(self.errors))
+            if self.milestones:
+                lines.append("# TYPE portable_bus_startup_seconds gauge")
+                for name, seconds in self.milestones.items():
+                    lines.append('portable_bus_startup_seconds{{milestone="{0}"}} {1:.3f}'.format(name, seconds))
+        # written whole before it replaces the old file, so the collector never reads half of it
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+    # writes the dump file, a Prometheus textfile if it ends in .prom and CSV otherwise, with the last
+    # error's traceback next to it in '<path>.error.txt'; a failed write is logged and tried again next time
+    def dump(self):
+        path = self.dump_path
+        with self.dump_lock:
+            try:
+                if path.endswith(".prom"):
+                    self.write_prometheus(path)
+                else:
+                    self.write_csv(path)
+                if self.last_error is not None:
+                    with open(path + ".error.txt", "w") as f:
+                        f.write(self.last_error)
+            except OSError as e:
+                print("could not write telemetry to {0}: {1}".format(path, e), file=sys.stderr)
+
+    # dumps every 'interval' seconds from a background thread until the process exits
+    def start_dump(self, path, interval=10.0):
+        self.dump_path = path
+
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.dump()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    # asks for a torch.profiler trace of the next 'steps' inferences, exported as a Chrome trace to 'path'
+    def request_profile(self, path, steps=30):
+        with self.lock:
+            self.profile_request = (path, steps)
+
+    # called by the thread running inference after each inference, starting and stopping a requested capture
+    # returns the path of the trace when one has just been written
+    def profile_step(self):
+        if self.profiler is None:
+            with self.lock:
+                request, self.profile_request = self.profile_request, None
+            if request is not None:
+                import torch.profiler  # only needed to capture a profile
+                self.profiler = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU],
+                                                       record_shapes=True, with_stack=True)
+                self.profiler.start()
+                self.profile_path, self.profile_steps = request
+            return None
+        self.profile_steps -= 1
+        if self.profile_steps > 0:
+            return None
+        self.profiler.stop()
+        os.makedirs(os.path.dirname(self.profile_path) or ".", exist_ok=True)
+        self.profiler.export_chrome_trace(self.profile_path)
+        self.profiler = None
+        return self.profile_path
+
+
+# telemetry of the scanning pipeline in this process
+pipeline = Telemetry()
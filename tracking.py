@@ -0,0 +1,98 @@
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+
+# downsampled float grayscale of a ring frame, (height, width) grayscale or (height, width, 4) ARGB32
+def grayscale(frame, step=4):
+    # the green channel is enough for the grayscale ultrasound image
+    lum = frame[::step, ::step, 1] if frame.ndim == 3 else frame[::step, ::step]
+    return lum.astype(np.float32)
+
+
+# normalized cross-correlation of a template against every position in a search region
+# returns the best (x, y) offset into the region and its score in [-1, 1]
+def match_template(region, template):
+    th, tw = template.shape
+    windows = sliding_window_view(region, (th, tw))
+    t = template - template.mean()
+    w = windows - windows.mean(axis=(2, 3), keepdims=True)
+    ncc = (w * t).sum(axis=(2, 3)) / (np.sqrt((w * w).sum(axis=(2, 3)) * (t * t).sum()) + 1e-6)
+    y, x = np.unravel_index(np.argmax(ncc), ncc.shape)
+    return int(x), int(y), float(ncc[y, x])
+
+
+# moves the boxes of the last detection between detector keyframes by matching each box's keyframe patch
+# in the new frame around a constant-velocity prediction of where it went
+# a new detection is asked for every 'interval' frames, when the scene changes or when a box is lost
+class BoxTracker:
+    # @param interval frames between detections, counting the keyframe
+    # @param step downsampling of the grayscale frames matching runs on
+    # @param search how far a box may move per frame, in downsampled pixels
+    # @param min_score lowest match score a box is still considered tracked at
+    # @param max_change mean absolute grayscale change from the keyframe treated as a new scene
+    # @param max_boxes number of top scoring boxes that are tracked
+    def __init__(self, interval=5, step=4, search=6, min_score=0.6, max_change=20.0, max_boxes=5):
+        self.interval = interval
+        self.step = step
+        self.search = search
+        self.min_score = min_score
+        self.max_change = max_change
+        self.max_boxes = max_boxes
+        self.reset()
+
+    # forget the last detection, the next frame is a keyframe
+    def reset(self):
+        self.objects = None
+
+    def gray(self, frame):
+        return grayscale(frame, self.step)
+
+    # start tracking the objects detected on a keyframe
+    # @param gray the keyframe from gray()
+    # @param objects the detector output for the keyframe, boxes sorted by score
+    def update(self, gray, objects):
+        boxes = objects['boxes'][:self.max_boxes]
+        self.keyframe = gray
+        self.boxes = np.asarray(boxes, dtype=np.float32)
+        self.templates = []
+        for x0, y0, x1, y1 in (self.boxes / self.step).astype(int):
+            x0, y0 = max(x0, 0), max(y0, 0)
+            template = gray[y0:y1, x0:x1]
+            # too small or flat to match, it stays where it was detected
+            self.templates.append(template if min(template.shape) >= 4 and template.std() > 0 else None)
+        self.origins = (self.boxes[:, :2] / self.step).astype(int).clip(min=0)
+        self.positions = self.origins.copy()
+        self.velocities = np.zeros_like(self.positions, dtype=np.float32)
+        self.since = 0
+        self.objects = {k: v[:self.max_boxes] for k, v in objects.items()}
+
+    # the tracked objects on a new frame, or None when the detector should run on it instead
+    # @param gray the frame from gray()
+    def track(self, gray):
+        objects = self.objects
+        if objects is None or self.since + 1 >= self.interval or gray.shape != self.keyframe.shape:
+            return None
+        if np.abs(gray - self.keyframe).mean() > self.max_change:
+            return None
+        positions = self.positions.copy()
+        for i, template in enumerate(self.templates):
+            if template is None:
+                continue
+            th, tw = template.shape
+            # search around where the box would be if it kept moving as it has been
+            x, y = (self.positions[i] + np.rint(self.velocities[i])).astype(int)
+            sx0, sy0 = max(x - self.search, 0), max(y - self.search, 0)
+            region = gray[sy0:min(y + self.search + th, gray.shape[0]), sx0:min(x + self.search + tw, gray.shape[1])]
+            if region.shape[0] < th or region.shape[1] < tw:
+                return None
+            dx, dy, score = match_template(region, template)
+            if score < self.min_score:
+                return None
+            positions[i] = sx0 + dx, sy0 + dy
+        self.velocities = 0.5 * self.velocities + 0.5 * (positions - self.positions)
+        self.positions = positions
+        self.since += 1
+        # boxes keep their keyframe size and move with their patch
+        shift = (positions - self.origins) * self.step
+        boxes = self.boxes + np.concatenate([shift, shift], axis=1)
+        return {'boxes': boxes, 'scores': objects['scores'], 'labels': objects['labels']}